@@ -4,6 +4,7 @@ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import vtkSegmentationCore
 import logging
+import time
 
 #
 # PETIndiC
@@ -43,9 +44,19 @@ class PETIndiCWidget(ScriptedLoadableModuleWidget):
     self.logic = PETIndiCLogic()
 
     self.moduleVisible = True
-    self._segmentationObserverTag = None
+    self._segmentationObserverTags = []
     self._observedSegmentation = None
-    self._debounceTimer = None
+    self._observedSegmentationNodeID = None
+    self._sceneObserverTags = [
+      slicer.mrmlScene.AddObserver(slicer.mrmlScene.NodeRemovedEvent, self._onNodeRemoved),
+      slicer.mrmlScene.AddObserver(slicer.mrmlScene.EndCloseEvent, self._onSceneEndClose)]
+    self._debounceTimer = qt.QTimer()
+    self._debounceTimer.setSingleShot(True)
+    self._debounceTimer.timeout.connect(self.calculateIndicesForCurrentSegment)
+    self._debounceInterval = 500
+    self._averageLatency = None
+    self._calculation = None
+    self.useIncrementalEngine = True
     self.items = []
 
     #
@@ -242,8 +253,14 @@ class PETIndiCWidget(ScriptedLoadableModuleWidget):
     self.layout.addStretch(1)
 
   def cleanup(self):
+    self._debounceTimer.stop()
+    self._cancelCalculation()
     self.segmentEditorWidget.disconnect('currentSegmentIDChanged(QString)', self.onCurrentSegmentChanged)
     self._removeSegmentationObserver()
+    for tag in self._sceneObserverTags:
+      slicer.mrmlScene.RemoveObserver(tag)
+    self._sceneObserverTags = []
+    self.logic.resetIncrementalState()
     self.segmentEditorWidget.setMRMLScene(None)
     self.items = []
 
@@ -280,40 +297,70 @@ class PETIndiCWidget(ScriptedLoadableModuleWidget):
     self._removeSegmentationObserver()
     segmentation = segmentationNode.GetSegmentation()
     self._observedSegmentation = segmentation
-    self._segmentationObserverTag = segmentation.AddObserver(
-        vtkSegmentationCore.vtkSegmentation.SegmentModified,
-        self._onSegmentModified)
+    self._observedSegmentationNodeID = segmentationNode.GetID()
+    self._segmentationObserverTags = [
+      segmentation.AddObserver(vtkSegmentationCore.vtkSegmentation.SegmentModified, self._onSegmentModified),
+      segmentation.AddObserver(vtkSegmentationCore.vtkSegmentation.SegmentRemoved, self._onSegmentRemoved)]
 
   def _removeSegmentationObserver(self):
-    if self._segmentationObserverTag is not None and self._observedSegmentation is not None:
-      self._observedSegmentation.RemoveObserver(self._segmentationObserverTag)
-    self._segmentationObserverTag = None
+    if self._observedSegmentation is not None:
+      for tag in self._segmentationObserverTags:
+        self._observedSegmentation.RemoveObserver(tag)
+    self._segmentationObserverTags = []
     self._observedSegmentation = None
+    self._observedSegmentationNodeID = None
+
+  @vtk.calldata_type(vtk.VTK_STRING)
+  def _onSegmentRemoved(self, caller, event, segmentID):
+    """Forget the incremental state of a removed segment"""
+    self.logic.resetIncrementalState(self._observedSegmentationNodeID, segmentID)
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def _onNodeRemoved(self, caller, event, node):
+    """Forget the incremental state of the segments of a removed volume or segmentation"""
+    if node.IsA('vtkMRMLScalarVolumeNode') or node.IsA('vtkMRMLSegmentationNode'):
+      self.logic.resetIncrementalState(node.GetID())
+
+  def _onSceneEndClose(self, caller, event):
+    self.logic.resetIncrementalState()
 
   def _onSegmentModified(self, caller, event):
-    """Called when any segment is modified. Debounce to avoid running CLI on every paint stroke."""
+    """Called when any segment is modified. Debounce to avoid running CLI on every paint stroke.
+    A calculation still running is for an outdated segment, so it is cancelled."""
     self.resultsTable.visible = False
+    self._cancelCalculation()
     if not self.moduleVisible:
       return
-    if self._debounceTimer is not None:
-      self._debounceTimer.stop()
-    self._debounceTimer = qt.QTimer()
-    self._debounceTimer.setSingleShot(True)
-    self._debounceTimer.timeout.connect(self.calculateIndicesForCurrentSegment)
-    self._debounceTimer.start(500)
+    self._debounceTimer.start(self._debounceInterval)
+
+  def _updateDebounceInterval(self, latency):
+    """Adapt the debounce interval to a moving average of the latency of the recent
+    calculations: when they are slow, waiting longer between strokes avoids starting
+    calculations that the next stroke cancels anyway."""
+    if self._averageLatency is None:
+      self._averageLatency = latency
+    else:
+      self._averageLatency = 0.7*self._averageLatency + 0.3*latency
+    self._debounceInterval = int(min(2000, max(200, 1000*self._averageLatency)))
+
+  def _cancelCalculation(self):
+    """Cancel the calculation in progress, its results are discarded"""
+    if self._calculation is None:
+      return
+    cliNode = self._calculation['cliNode']
+    self._calculation = None
+    if cliNode and cliNode.IsBusy():
+      cliNode.Cancel()
+
+  def isCalculating(self):
+    """True while a calculation is pending or running"""
+    return self._debounceTimer.isActive() or self._calculation is not None
 
   def _exportSegmentToLabelMap(self, segmentationNode, segmentID, referenceVolumeNode):
-    """Export a single segment to a temporary label map node. Returns the node or None."""
-    labelNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'temp_petindic_label')
-    segmentIds = vtk.vtkStringArray()
-    segmentIds.InsertNextValue(segmentID)
-    success = slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(
-        segmentationNode, segmentIds, labelNode, referenceVolumeNode,
-        slicer.vtkSegmentation.EXTENT_REFERENCE_GEOMETRY)
-    if not success or not labelNode.GetImageData():
-      slicer.mrmlScene.RemoveNode(labelNode)
-      return None
-    return labelNode
+    """Export a single segment to a label map node of its own that is not added to the
+    scene, as it has to stay unchanged while the calculation runs. Returns the node or None."""
+    return self.logic.exportSegmentToLabelMap(referenceVolumeNode, segmentationNode, segmentID,
+                                              slicer.vtkMRMLLabelMapVolumeNode())
 
   def onVolumeSelect(self):
     """Set up segmentation for the selected volume."""
@@ -387,8 +434,17 @@ class PETIndiCWidget(ScriptedLoadableModuleWidget):
       self.calculateIndicesForCurrentSegment()
 
   def calculateIndicesForCurrentSegment(self):
-    """Calculate quantitative indices for the currently selected segment."""
+    """Calculate the quantitative indices for the currently selected segment. Results
+    cached for the same volume, segment voxels and indices are shown right away. With the
+    incremental engine, a small change since the last calculation of the segment is
+    processed right away and the results table is filled. Anything larger (the first
+    calculation of a large segment, a new image or most of the segment changed) would
+    block the GUI, so the CLI runs in the background instead and the results table is
+    filled when the calculation has completed, unless a newer calculation was started
+    in the meantime."""
     self.resultsTable.visible = False
+    self._debounceTimer.stop()
+    self._cancelCalculation()
     if not self.moduleVisible:
       return
     volumeNode = self.inputSelector.currentNode()
@@ -399,24 +455,48 @@ class PETIndiCWidget(ScriptedLoadableModuleWidget):
     segment = segmentationNode.GetSegmentation().GetSegment(segmentID)
     if not segment:
       return
+    indices = self.qiWidget.selectedIndices()
+    cacheKey, values = self.logic.getCachedResults(volumeNode, segmentationNode, segmentID, indices)
+    if values is not None:
+      self.populateResultsTableFromValues(values)
+      return
 
-    pd = qt.QProgressDialog('Calculating...', 'Cancel', 0, 100, slicer.util.mainWindow())
-    pd.setModal(True)
-    pd.setMinimumDuration(0)
-    pd.show()
-    pd.setValue(1)
-    slicer.app.processEvents()
-
-    # Export single segment to temporary label map
+    if self.useIncrementalEngine:
+      startTime = time.time()
+      try:
+        values = self.logic.calculateIncrementally(volumeNode, segmentationNode, segmentID, indices, limitWork=True)
+      except Exception as e:
+        values = None
+        print('WARNING: incremental calculation failed, running Quantitative Indices Calculator: ' + str(e))
+      if values is not None:
+        self._updateDebounceInterval(time.time() - startTime)
+        self.logic.cacheResults(cacheKey, values)
+        self.populateResultsTableFromValues(values)
+        return
+
+    # Export single segment to a label map, kept until the calculation has ended
     labelNode = self._exportSegmentToLabelMap(segmentationNode, segmentID, volumeNode)
-    if labelNode:
-      cliNode = self.calculateIndices(volumeNode, labelNode, None, 1) # label value is always 1
-      slicer.mrmlScene.RemoveNode(labelNode) # clean up temporary node
-      if cliNode:
+    if not labelNode:
+      return
+    calculation = {'cliNode': None, 'startTime': time.time()}
+    def onCalculationEnded(cliNode):
+      if self._calculation is not calculation:
+        slicer.mrmlScene.RemoveNode(cliNode) # superseded by a newer calculation
+        return
+      self._calculation = None
+      if cliNode.GetStatus() == cliNode.Completed:
+        self._updateDebounceInterval(time.time() - calculation['startTime'])
+        self.logic.cacheResults(cacheKey, self.logic.getResultsFromNode(cliNode))
         self.populateResultsTable(cliNode)
       else:
         print('ERROR: could not read output of Quantitative Indices Calculator')
-    pd.setValue(100)
+        slicer.mrmlScene.RemoveNode(cliNode)
+    self._calculation = calculation
+    try:
+      calculation['cliNode'] = self.calculateIndices(volumeNode, labelNode, None, 1, onCalculationEnded) # label value is always 1
+    except Exception:
+      self._calculation = None
+      raise
 
   def onFeatureSelectionChanged(self):
     self.recalculateButton.enabled = True
@@ -425,22 +505,37 @@ class PETIndiCWidget(ScriptedLoadableModuleWidget):
     self.recalculateButton.enabled = False
     self.calculateIndicesForCurrentSegment()
 
-  def calculateIndices(self, volumeNode, labelNode, cliNode, labelValue):
+  def calculateIndices(self, volumeNode, labelNode, cliNode, labelValue, callback=None):
     newNode = None
-    newNode = self.logic.calculateOnLabelModified(volumeNode, labelNode, cliNode, labelValue, self.MeanCheckBox.checked, self.StdDevCheckBox.checked, self.MinCheckBox.checked, self.MaxCheckBox.checked, self.Quart1CheckBox.checked, self.MedianCheckBox.checked, self.Quart3CheckBox.checked, self.UpperAdjacentCheckBox.checked, self.Q1CheckBox.checked, self.Q2CheckBox.checked, self.Q3CheckBox.checked, self.Q4CheckBox.checked, self.Gly1CheckBox.checked, self.Gly2CheckBox.checked, self.Gly3CheckBox.checked, self.Gly4CheckBox.checked, self.TLGCheckBox.checked, self.SAMCheckBox.checked, self.SAMBGCheckBox.checked, self.RMSCheckBox.checked, self.PeakCheckBox.checked, self.VolumeCheckBox.checked)
+    newNode = self.logic.calculateOnLabelModified(volumeNode, labelNode, cliNode, labelValue, callback, self.MeanCheckBox.checked, self.StdDevCheckBox.checked, self.MinCheckBox.checked, self.MaxCheckBox.checked, self.Quart1CheckBox.checked, self.MedianCheckBox.checked, self.Quart3CheckBox.checked, self.UpperAdjacentCheckBox.checked, self.Q1CheckBox.checked, self.Q2CheckBox.checked, self.Q3CheckBox.checked, self.Q4CheckBox.checked, self.Gly1CheckBox.checked, self.Gly2CheckBox.checked, self.Gly3CheckBox.checked, self.Gly4CheckBox.checked, self.TLGCheckBox.checked, self.SAMCheckBox.checked, self.SAMBGCheckBox.checked, self.RMSCheckBox.checked, self.PeakCheckBox.checked, self.VolumeCheckBox.checked)
     return newNode
 
   def populateResultsTable(self, vtkMRMLCommandLineModuleNode):
     """Reads the output of QuantitativeIndicesCLI and populates the results table"""
     newNode = vtkMRMLCommandLineModuleNode
     resultArray = []
-    self.items = []
     for i in range(0,newNode.GetNumberOfParametersInGroup(3)):
       newResult = newNode.GetParameterDefault(3,i)
       if (newResult != '--'):
         feature = newNode.GetParameterName(3,i)
         feature = feature.replace('_s','').replace('_',' ')
         resultArray.append([feature,newResult])
+    self._fillResultsTable(resultArray)
+    slicer.mrmlScene.RemoveNode(newNode)
+
+  def populateResultsTableFromValues(self, values):
+    """Populates the results table from a dict of values by CLI parameter name, in the
+    order and format of the CLI outputs. The table stays hidden for an empty segment."""
+    from QuantitativeIndicesTool import QuantitativeIndicesNumPyEngine
+    if not any(value == value for value in values.values()): # all NaN
+      return
+    resultArray = [[name.replace('_',' '), '%g' % values[name]]
+                   for name in QuantitativeIndicesNumPyEngine.outputNames if name in values]
+    self._fillResultsTable(resultArray)
+
+  def _fillResultsTable(self, resultArray):
+    """Shows the [feature, value] rows of resultArray in the results table"""
+    self.items = []
     numRows = len(resultArray)
     self.resultsTable.setRowCount(numRows)
     for i in range(0,numRows):
@@ -473,7 +568,6 @@ class PETIndiCWidget(ScriptedLoadableModuleWidget):
     rowHeight = self.resultsTable.rowHeight(0)
     self.resultsTable.setFixedHeight(rowHeight*(numRows+1)+1)
     self.resultsTable.visible = True
-    slicer.mrmlScene.RemoveNode(newNode)
 
 #
 # PETIndiCLogic
@@ -531,17 +625,59 @@ class PETIndiCLogic(ScriptedLoadableModuleLogic):
       units =  imageNode.GetVoxelValueUnits().GetCodeValue()
     return units
 
-  def calculateOnLabelModified(self, scalarVolume, labelVolume, cliNode, labelValue, meanFlag, stddevFlag, minFlag,
+  def calculateOnLabelModified(self, scalarVolume, labelVolume, cliNode, labelValue, callback, meanFlag, stddevFlag, minFlag,
                         maxFlag, quart1Flag, medianFlag, quart3Flag, upperAdjacentFlag, q1Flag, q2Flag, q3Flag,
                         q4Flag, gly1Flag, gly2Flag, gly3Flag, gly4Flag, TLGFlag, SAMFlag, SAMBGFlag, RMSFlag,
                         PeakFlag, VolumeFlag):
+    """Run the calculation, in the background if callback is given (called with the
+    CLI node when the run has ended)"""
     qiLogic = slicer.modules.QuantitativeIndicesToolWidget.logic
     node = qiLogic.run(scalarVolume,labelVolume,cliNode,labelValue,meanFlag, stddevFlag, minFlag,
                         maxFlag, quart1Flag, medianFlag, quart3Flag, upperAdjacentFlag, q1Flag, q2Flag, q3Flag,
                         q4Flag, gly1Flag, gly2Flag, gly3Flag, gly4Flag, TLGFlag, SAMFlag, SAMBGFlag, RMSFlag,
-                        PeakFlag, VolumeFlag)
+                        PeakFlag, VolumeFlag, callback)
     return node
 
+  def exportSegmentToLabelMap(self, scalarVolume, segmentationNode, segmentID, labelNode=None):
+    """Export a segment to a label map node (label value 1) on the grid of scalarVolume,
+    without adding it to the scene. See QuantitativeIndicesToolLogic.exportSegmentsToLabelmap."""
+    qiLogic = slicer.modules.QuantitativeIndicesToolWidget.logic
+    return qiLogic.exportSegmentsToLabelmap(scalarVolume, segmentationNode, [segmentID], labelNode)
+
+  def calculateIncrementally(self, scalarVolume, segmentationNode, segmentID, indices, limitWork=False):
+    """Calculate the indices of a segment in process, only processing the voxels that
+    changed since its last calculation. Returns a dict of the values by CLI parameter name,
+    or None with limitWork if the calculation would process too many voxels."""
+    qiLogic = slicer.modules.QuantitativeIndicesToolWidget.logic
+    return qiLogic.computeIndicesIncrementally(scalarVolume, segmentationNode, segmentID, indices, limitWork)
+
+  def resetIncrementalState(self, nodeID=None, segmentID=None):
+    """Forget the incremental state of the segments of a volume or segmentation node (only
+    of segmentID if given), or of all segments if nodeID is None"""
+    qiWidget = getattr(slicer.modules, 'QuantitativeIndicesToolWidget', None)
+    if qiWidget is None:
+      return # not set up, or already cleaned up
+    qiLogic = qiWidget.logic
+    if nodeID is None:
+      qiLogic.incrementalEngine.reset()
+    else:
+      qiLogic.incrementalEngine.resetNode(nodeID, segmentID)
+
+  def getCachedResults(self, scalarVolume, segmentationNode, segmentID, indices):
+    """Key of the results of a segment in the result cache of QuantitativeIndicesTool,
+    and the cached values (None if they are not cached)"""
+    qiLogic = slicer.modules.QuantitativeIndicesToolWidget.logic
+    key = qiLogic.getResultCacheKey(scalarVolume, segmentationNode, segmentID, indices)
+    return key, qiLogic.resultCache.get(key)
+
+  def cacheResults(self, key, values):
+    qiLogic = slicer.modules.QuantitativeIndicesToolWidget.logic
+    qiLogic.resultCache.put(key, values)
+
+  def getResultsFromNode(self, cliNode):
+    qiLogic = slicer.modules.QuantitativeIndicesToolWidget.logic
+    return qiLogic.getResultsFromNode(cliNode)
+
   def getUnitsForIndex(self, imageUnits, indexName):
     """Attempt to interpret units"""
     if imageUnits not in ['{SUVbw}g/ml','{SUVlbm}g/ml','{SUVibw}g/ml']: # TODO '{SUVbsa}cm2/ml'
@@ -623,6 +759,9 @@ class PETIndiCTest(ScriptedLoadableModuleTest):
     self.setUp()
     self.test_PETIndiC()
     self.tearDown()
+    self.setUp()
+    self.test_PETIndiC_Background()
+    self.tearDown()
 
   def setUp(self):
     """ Open temporary DICOM database
@@ -721,6 +860,7 @@ class PETIndiCTest(ScriptedLoadableModuleTest):
 
         self.delayDisplay('Producing segmentation')
         self._applyThreshold(widget, 30, upperThreshold)
+        self._waitForCalculation(widget)
 
         self.delayDisplay('Checking initial measurement results')
         t = widget.resultsTable
@@ -730,6 +870,7 @@ class PETIndiCTest(ScriptedLoadableModuleTest):
         self.delayDisplay('Updating measurements for selecting all features and verifying results')
         widget.qiWidget.selectAllButton.click()
         widget.recalculateButton.click()
+        self._waitForCalculation(widget)
         self.assertTrue(t.rowCount==22)
         values = {'Mean':(57.1303,'SUVbw'), \
           'Peak':(84.8634,'SUVbw'),\
@@ -741,6 +882,7 @@ class PETIndiCTest(ScriptedLoadableModuleTest):
 
         self.delayDisplay('Updating segmentation and verifying results')
         self._applyThreshold(widget, 25, upperThreshold)
+        self._waitForCalculation(widget)
         self._verifyResults(t, {'Mean':(53.8255,'SUVbw')})
 
         self.delayDisplay('Creating segmentation with new segment')
@@ -749,22 +891,125 @@ class PETIndiCTest(ScriptedLoadableModuleTest):
         widget.segmentEditorWidget.setCurrentSegmentID(segmentID2)
         self.assertFalse(t.visible)
         self._applyThreshold(widget, 50, upperThreshold)
+        self._waitForCalculation(widget)
         self._verifyResults(t, {'Mean':(68.0497,'SUVbw')})
         self._applyThreshold(widget, 60, upperThreshold)
+        self._waitForCalculation(widget)
         self._verifyResults(t, {'Mean':(72.8926,'SUVbw')})
 
         self.delayDisplay('Testing undo/redo')
+        resultCache = slicer.modules.QuantitativeIndicesToolWidget.logic.resultCache
+        cacheHits = resultCache.hits
         widget.segmentEditorWidget.undo()
+        self._waitForCalculation(widget)
         self._verifyResults(t, {'Mean':(68.0497,'SUVbw')})
+        self.assertGreater(resultCache.hits, cacheHits) # same segment as before the last threshold
         widget.segmentEditorWidget.redo()
+        self._waitForCalculation(widget)
         self._verifyResults(t, {'Mean':(72.8926,'SUVbw')})
 
+        self.delayDisplay('Running changes too large for the incremental engine in the background')
+        engine = slicer.modules.QuantitativeIndicesToolWidget.logic.incrementalEngine
+        engine.maximumLimitedVoxels = 0
+        try:
+          self._applyThreshold(widget, 55, upperThreshold)
+          widget.calculateIndicesForCurrentSegment() # start right away instead of after the debounce
+          self.assertTrue(widget.isCalculating()) # not calculated in the GUI thread
+          self._waitForCalculation(widget)
+          self.assertTrue(t.visible)
+        finally:
+          del engine.maximumLimitedVoxels
+
+        self.delayDisplay('Test passed!')
+
+    except Exception as e:
+      import traceback
+      traceback.print_exc()
+      self.delayDisplay('Test caused exception!\n' + str(e),self.delayMs*2)
+      raise
+
+  def test_PETIndiC_Background(self):
+    """ test the calculation with the CLI in the background: a calculation that is
+    superseded by an edit of the segment must not reach the results table
+    """
+    widget = None
+    try:
+      with DICOMUtils.TemporaryDICOMDatabase(self.tempDicomDatabaseDir) as db:
+        self.assertTrue(db.isOpen)
+
+        self.delayDisplay('Loading PET DICOM dataset (including download if necessary)')
+        petNode = self.loadTestData()
+        m = slicer.util.mainWindow()
+        m.moduleSelector().selectModule('PETIndiC')
+        widget = slicer.modules.PETIndiCWidget
+        widget.useIncrementalEngine = False
+        widget._averageLatency = None
+        slicer.modules.QuantitativeIndicesToolWidget.logic.resultCache.clear()
+        widget.inputSelector.setCurrentNode(petNode)
+        self._waitForCalculation(widget)
+        t = widget.resultsTable
+        upperThreshold = 89.85
+
+        # record the CLI nodes that are started and those that fill the results table
+        startedNodes = []
+        populatingNodes = []
+        calculateIndices = widget.calculateIndices
+        populateResultsTable = widget.populateResultsTable
+        def recordStarted(*args):
+          cliNode = calculateIndices(*args)
+          startedNodes.append(cliNode)
+          return cliNode
+        def recordPopulating(cliNode):
+          populatingNodes.append(cliNode)
+          populateResultsTable(cliNode)
+        widget.calculateIndices = recordStarted
+        widget.populateResultsTable = recordPopulating
+
+        self.delayDisplay('Starting a calculation and editing the segment while it runs')
+        self._applyThreshold(widget, 35, upperThreshold)
+        widget.calculateIndicesForCurrentSegment() # start right away instead of after the debounce
+        self.assertEqual(len(startedNodes), 1)
+        self.assertTrue(widget.isCalculating())
+        self._applyThreshold(widget, 50, upperThreshold)
+        self.assertFalse(t.visible)
+        self.assertTrue(widget._debounceTimer.isActive()) # the newer calculation waits for the debounce
+        self._waitForCalculation(widget)
+        startTime = time.time()
+        while startedNodes[0].IsBusy() and time.time()-startTime < 60:
+          slicer.app.processEvents()
+          time.sleep(0.01)
+        slicer.app.processEvents()
+
+        self.delayDisplay('Checking that only the newer calculation reached the results table')
+        self.assertEqual(len(startedNodes), 2)
+        self.assertEqual(populatingNodes, [startedNodes[1]])
+        self.assertTrue(t.visible)
+        self._verifyResults(t, {'Mean':(68.0497,'SUVbw')})
+
+        self.delayDisplay('Checking the adaptive debounce interval')
+        self.assertIsNotNone(widget._averageLatency)
+        self.assertTrue(200 <= widget._debounceInterval <= 2000)
+
         self.delayDisplay('Test passed!')
 
     except Exception as e:
       import traceback
       traceback.print_exc()
       self.delayDisplay('Test caused exception!\n' + str(e),self.delayMs*2)
+      raise
+    finally:
+      if widget:
+        widget.useIncrementalEngine = True
+        widget.__dict__.pop('calculateIndices', None)
+        widget.__dict__.pop('populateResultsTable', None)
+
+  def _waitForCalculation(self, widget, timeout=60):
+    """Process events until the calculation in the background has ended"""
+    startTime = time.time()
+    while widget.isCalculating() and time.time()-startTime < timeout:
+      slicer.app.processEvents()
+      time.sleep(0.01)
+    self.assertFalse(widget.isCalculating())
 
   def _verifyResults(self, table, referenceMeasurements={}):
     self.assertTrue(table.columnCount==3)
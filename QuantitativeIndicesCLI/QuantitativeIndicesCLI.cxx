@@ -4,8 +4,19 @@
 #include "itkImageFileReader.h"
 #include "itkConstantPadImageFilter.h"
 #include "itkResampleImageFilter.h"
-#include <itkImageRegionConstIterator.h>
+#include "itkRegionOfInterestImageFilter.h"
+#include "itkNearestNeighborInterpolateImageFunction.h"
+#include "itkImageRegionConstIteratorWithIndex.h"
+#include "itkMultiThreaderBase.h"
+#include "itksys/SystemTools.hxx"
+#include <algorithm>
+#include <cmath>
 #include <iostream>
+#include <list>
+#include <sstream>
+#include <string>
+#include <utility>
+#include <vector>
 
 // make isnan available for older Visual Studio compilers
 #if defined(_MSC_VER) && (_MSC_VER<1800)
@@ -18,6 +29,7 @@
 #endif
 
 #include "itkQuantitativeIndicesComputationFilter.h"
+#include "itkMemoryMappedImageFileReader.h"
 #include "itkPluginUtilities.h"
 
 //versioning info
@@ -25,31 +37,334 @@
 
 using namespace std;
 
-int main( int argc, char * argv[] )
+// grayscale images the server keeps loaded
+#define QI_SERVER_CACHED_IMAGES 4
+
+namespace
+{
+
+//----------------------------------------------------------------------------
+// Caps the threads of a filter. The global ITK limits are left alone: when
+// built as a shared library the CLI runs inside the Slicer process, where
+// other filters may be running.
+void SetNumberOfThreads( itk::ProcessObject* filter, int numberOfThreads )
+{
+  if(numberOfThreads > 0)
+  {
+    filter->SetNumberOfWorkUnits( numberOfThreads );
+    filter->GetMultiThreader()->SetMaximumNumberOfThreads( numberOfThreads );
+    filter->GetMultiThreader()->SetNumberOfWorkUnits( numberOfThreads );
+  }
+}
+
+//----------------------------------------------------------------------------
+// Number of voxels kept around a label: the 2 voxel SAM boundary or the reach
+// of the 1cc peak sphere, whichever is larger
+itk::IndexValueType GetLabelMargin( double spacing )
+{
+  const double peakRadius = std::pow(1000*0.75/itk::Math::pi, 1.0/3.0);
+  return std::max<itk::IndexValueType>(2, std::ceil(peakRadius/spacing) + 1);
+}
+
+//----------------------------------------------------------------------------
+// Bounding box of the selected label, or of all non-zero labels. Returns
+// false if the label is not found.
+template <class TLabelImage>
+bool GetLabelBoundingBox( const TLabelImage* labelImage, bool allLabels, int labelValue,
+                          typename TLabelImage::RegionType& box )
+{
+  const unsigned int Dimension = TLabelImage::ImageDimension;
+  typename TLabelImage::IndexType lowerIndex;
+  typename TLabelImage::IndexType upperIndex;
+  lowerIndex.Fill(itk::NumericTraits<itk::IndexValueType>::max());
+  upperIndex.Fill(itk::NumericTraits<itk::IndexValueType>::NonpositiveMin());
+  bool labelFound = false;
+  using LabelIteratorType = itk::ImageRegionConstIteratorWithIndex<TLabelImage>;
+  LabelIteratorType lit(labelImage, labelImage->GetLargestPossibleRegion());
+  for(lit.GoToBegin(); !lit.IsAtEnd(); ++lit)
+  {
+    int value = lit.Get();
+    if( allLabels ? value != 0 : value == labelValue )
+    {
+      labelFound = true;
+      auto index = lit.GetIndex();
+      for(unsigned int i=0; i<Dimension; ++i)
+      {
+        lowerIndex[i] = std::min(lowerIndex[i], index[i]);
+        upperIndex[i] = std::max(upperIndex[i], index[i]);
+      }
+    }
+  }
+  if(labelFound)
+  {
+    box.SetIndex(lowerIndex);
+    for(unsigned int i=0; i<Dimension; ++i)
+    {
+      box.SetSize(i, upperIndex[i] - lowerIndex[i] + 1);
+    }
+  }
+  return labelFound;
+}
+
+//----------------------------------------------------------------------------
+// Region of the image covering the bounding box of the label (on any grid)
+// plus the margins of the calculations. Returns false if the whole image
+// should be read.
+template <class TImage, class TLabelImage>
+bool GetImageStreamRegion( const TImage* image, const TLabelImage* labelImage, bool allLabels, int labelValue,
+                           typename TImage::RegionType& region )
+{
+  const unsigned int Dimension = TImage::ImageDimension;
+  typename TLabelImage::RegionType box;
+  if(!GetLabelBoundingBox(labelImage, allLabels, labelValue, box))
+  {
+    return false;
+  }
+  // map the corners of the box to the image grid
+  std::vector<double> lower(Dimension, itk::NumericTraits<double>::max());
+  std::vector<double> upper(Dimension, itk::NumericTraits<double>::NonpositiveMin());
+  for(unsigned int corner=0; corner < (1u<<Dimension); ++corner)
+  {
+    typename TLabelImage::IndexType cornerIndex = box.GetIndex();
+    for(unsigned int i=0; i<Dimension; ++i)
+    {
+      if(corner & (1u<<i)) cornerIndex[i] += box.GetSize(i) - 1;
+    }
+    typename TLabelImage::PointType point;
+    labelImage->TransformIndexToPhysicalPoint(cornerIndex, point);
+    itk::ContinuousIndex<double, TImage::ImageDimension> imageIndex;
+    image->TransformPhysicalPointToContinuousIndex(point, imageIndex);
+    for(unsigned int i=0; i<Dimension; ++i)
+    {
+      lower[i] = std::min(lower[i], imageIndex[i]);
+      upper[i] = std::max(upper[i], imageIndex[i]);
+    }
+  }
+  // The margin is taken in physical units, as the larger of the margins on
+  // the image grid (label mapped onto the image) and on the label grid (label
+  // cropped and the image resampled onto it). The label axes may be rotated
+  // against the image axes, so the largest label margin is used for all.
+  // One more image voxel is kept for the interpolation.
+  auto spacing = image->GetSpacing();
+  auto labelSpacing = labelImage->GetSpacing();
+  double labelMargin = 0.0;
+  for(unsigned int i=0; i<Dimension; ++i)
+  {
+    labelMargin = std::max(labelMargin, GetLabelMargin(labelSpacing[i])*labelSpacing[i]);
+  }
+  for(unsigned int i=0; i<Dimension; ++i)
+  {
+    const double physicalMargin = std::max(GetLabelMargin(spacing[i])*spacing[i], labelMargin);
+    auto margin = static_cast<itk::IndexValueType>(std::ceil(physicalMargin/spacing[i])) + 1;
+    auto first = static_cast<itk::IndexValueType>(std::floor(lower[i])) - margin;
+    auto last = static_cast<itk::IndexValueType>(std::ceil(upper[i])) + margin;
+    region.SetIndex(i, first);
+    region.SetSize(i, last - first + 1);
+  }
+  return region.Crop(image->GetLargestPossibleRegion());
+}
+
+//----------------------------------------------------------------------------
+// Image kept by the server between requests, with the length and modification
+// time of its file when it was read
+template <class TImage>
+struct CachedImage
+{
+  std::string FileName;
+  unsigned long Length;
+  long int ModifiedTime;
+  typename TImage::Pointer Image;
+};
+
+//----------------------------------------------------------------------------
+// Images kept by the server, the most recently used first
+template <class TImage>
+std::list<CachedImage<TImage> >& GetImageCache()
+{
+  static std::list<CachedImage<TImage> > cache;
+  return cache;
+}
+
+//----------------------------------------------------------------------------
+// Image of the file kept by the server, or null. Images whose file was
+// deleted are released, as are those whose file changed length or
+// modification time. Clients give each version of a volume a file of its own
+// (QuantitativeIndicesTool names them by node and modification counter, and
+// deletes the previous file), so a rewrite is not missed within the one
+// second resolution of the modification time.
+template <class TImage>
+typename TImage::Pointer FindCachedImage( const std::string& fileName )
+{
+  auto& cache = GetImageCache<TImage>();
+  cache.remove_if([](const CachedImage<TImage>& cached)
+    { return !itksys::SystemTools::FileExists(cached.FileName, true); });
+  for(auto it = cache.begin(); it != cache.end(); ++it)
+  {
+    if(it->FileName != fileName)
+    {
+      continue;
+    }
+    if(it->Length != itksys::SystemTools::FileLength(fileName) ||
+       it->ModifiedTime != itksys::SystemTools::ModifiedTime(fileName))
+    {
+      cache.erase(it);
+      return nullptr;
+    }
+    cache.splice(cache.begin(), cache, it);
+    return it->Image;
+  }
+  return nullptr;
+}
+
+//----------------------------------------------------------------------------
+// Keeps the image of the file for later requests, releasing the least
+// recently used images beyond QI_SERVER_CACHED_IMAGES
+template <class TImage>
+void CacheImage( const std::string& fileName, unsigned long length, long int modifiedTime, TImage* image )
+{
+  auto& cache = GetImageCache<TImage>();
+  cache.remove_if([&fileName](const CachedImage<TImage>& cached) { return cached.FileName == fileName; });
+  cache.push_front(CachedImage<TImage>{ fileName, length, modifiedTime, image });
+  while(cache.size() > QI_SERVER_CACHED_IMAGES)
+  {
+    cache.pop_back();
+  }
+}
+
+//----------------------------------------------------------------------------
+template <class TPixel, class TLabelPixel>
+int DoIt( int argc, char * argv[], std::ostream* resultStream )
 {
   PARSE_ARGS;
-  using PixelType = float;
-	const unsigned int Dimension = 3;
+
+  using PixelType = TPixel;
+  using LabelPixelType = TLabelPixel;
+  const unsigned int Dimension = 3;
 
   using ImageType = itk::Image< PixelType, Dimension >;
-  using LabelImageType = itk::Image< int, Dimension >;
-
-	//image reader
-  using ReaderType =  itk::ImageFileReader< ImageType >;
-  using LabelReaderType = itk::ImageFileReader< LabelImageType >;
-	auto ptImageReader = ReaderType::New();
-	//itk::PluginFilterWatcher watchReader(ptImage, "Read Scalar Volume", CLPProcessInformation);
-	//ptImage->ReleaseDataFlagOn();
-  auto labelImageReader = LabelReaderType::New();
-  //itk::PluginFilterWatcher watchLabelReader(labelImage, "Read Label Image", CLPProcessInformation);
-  //labelImage->ReleaseDataFlagOn();
-
-  ptImageReader->SetFileName( Grayscale_Image );
-  labelImageReader->SetFileName( Label_Image );
-  ptImageReader->Update();
-  labelImageReader->Update();
-  auto ptImage = ptImageReader->GetOutput();
-  auto labelImage = labelImageReader->GetOutput();
+  using LabelImageType = itk::Image< LabelPixelType, Dimension >;
+
+  // Uncompressed files can be mapped into memory instead of read. The mapped
+  // voxels are only valid while the mappers exist, so they outlive the images.
+  using MapperType = itk::MemoryMappedImageFileReader< ImageType >;
+  using LabelMapperType = itk::MemoryMappedImageFileReader< LabelImageType >;
+  auto ptImageMapper = MapperType::New();
+  auto labelImageMapper = LabelMapperType::New();
+  ptImageMapper->SetFileName( Grayscale_Image );
+  labelImageMapper->SetFileName( Label_Image );
+
+  // Every intermediate image is held only by the pointers below: the filters
+  // are scoped and their outputs disconnected, so each image is released as
+  // soon as the next one replaces it.
+  typename ImageType::Pointer ptImage;
+  typename LabelImageType::Pointer labelImage;
+  {
+    //image reader
+    using ReaderType = itk::ImageFileReader< ImageType >;
+    using LabelReaderType = itk::ImageFileReader< LabelImageType >;
+    auto ptImageReader = ReaderType::New();
+    //itk::PluginFilterWatcher watchReader(ptImage, "Read Scalar Volume", CLPProcessInformation);
+    auto labelImageReader = LabelReaderType::New();
+    SetNumberOfThreads( ptImageReader, Number_Of_Threads );
+    SetNumberOfThreads( labelImageReader, Number_Of_Threads );
+    //itk::PluginFilterWatcher watchLabelReader(labelImage, "Read Label Image", CLPProcessInformation);
+
+    ptImageReader->SetFileName( Grayscale_Image );
+    labelImageReader->SetFileName( Label_Image );
+    if(Memory_Map_Input && labelImageMapper->Map())
+    {
+      labelImage = labelImageMapper->GetOutput();
+      cout << "Mapped label image" << endl;
+    }
+    else
+    {
+      labelImageReader->Update();
+      labelImage = labelImageReader->GetOutput();
+      labelImage->DisconnectPipeline();
+    }
+
+    // Only read the part of the image around the label. Readers that cannot
+    // stream (e.g. compressed files) read the whole image and the region is
+    // cropped from it. Of a mapped image only the pages of the region are read.
+    // The server keeps the images it read whole for later requests.
+    bool streamed = false;
+    typename ImageType::RegionType streamRegion;
+    // taken before reading, so that a file changed meanwhile is read again
+    const unsigned long fileLength = itksys::SystemTools::FileLength(Grayscale_Image);
+    const long int modifiedTime = itksys::SystemTools::ModifiedTime(Grayscale_Image);
+    if(resultStream)
+    {
+      ptImage = FindCachedImage<ImageType>(Grayscale_Image);
+    }
+    if(ptImage)
+    {
+      cout << "Reusing grayscale image" << endl;
+      if(Stream_Image_Region)
+      {
+        streamed = GetImageStreamRegion(ptImage.GetPointer(), labelImage.GetPointer(), returnCSV, Label_Value, streamRegion);
+      }
+    }
+    else if(!resultStream && Memory_Map_Input && ptImageMapper->Map())
+    {
+      ptImage = ptImageMapper->GetOutput();
+      cout << "Mapped grayscale image" << endl;
+      if(Stream_Image_Region)
+      {
+        streamed = GetImageStreamRegion(ptImage.GetPointer(), labelImage.GetPointer(), returnCSV, Label_Value, streamRegion);
+      }
+    }
+    else
+    {
+      if(Stream_Image_Region)
+      {
+        ptImageReader->UpdateOutputInformation();
+        streamed = GetImageStreamRegion(ptImageReader->GetOutput(), labelImage.GetPointer(), returnCSV, Label_Value, streamRegion);
+      }
+      if(streamed)
+      {
+        ptImageReader->GetOutput()->SetRequestedRegion(streamRegion);
+      }
+      ptImageReader->Update();
+      ptImage = ptImageReader->GetOutput();
+      ptImage->DisconnectPipeline();
+      if(resultStream && !streamed)
+      {
+        CacheImage<ImageType>(Grayscale_Image, fileLength, modifiedTime, ptImage);
+      }
+    }
+
+    if(streamed)
+    {
+      // The region becomes an image of its own. A label on the same grid is
+      // cropped the same way, so both stay on one grid.
+      bool labelOnImageGrid = labelImage->GetLargestPossibleRegion() == ptImage->GetLargestPossibleRegion();
+      for(unsigned int i=0; i<Dimension; ++i)
+      {
+        if(abs(ptImage->GetSpacing()[i]-labelImage->GetSpacing()[i]) > 1e-6) labelOnImageGrid = false;
+        if(abs(ptImage->GetOrigin()[i]-labelImage->GetOrigin()[i]) > 1e-6) labelOnImageGrid = false;
+      }
+      using CropperType = itk::RegionOfInterestImageFilter<ImageType, ImageType>;
+      auto cropper = CropperType::New();
+      SetNumberOfThreads( cropper, Number_Of_Threads );
+      cropper->SetInput(ptImage);
+      cropper->SetRegionOfInterest(streamRegion);
+      cropper->Update();
+      ptImage = cropper->GetOutput();
+      ptImage->DisconnectPipeline();
+      if(labelOnImageGrid)
+      {
+        using LabelCropperType = itk::RegionOfInterestImageFilter<LabelImageType, LabelImageType>;
+        auto labelCropper = LabelCropperType::New();
+        SetNumberOfThreads( labelCropper, Number_Of_Threads );
+        labelCropper->SetInput(labelImage);
+        labelCropper->SetRegionOfInterest(streamRegion);
+        labelCropper->Update();
+        labelImage = labelCropper->GetOutput();
+        labelImage->DisconnectPipeline();
+      }
+      cout << "Read image region: " << streamRegion.GetIndex() << " " << streamRegion.GetSize() << endl;
+    }
+  }
   
   // check if image and label occupy about the same space
   bool sameSpace = true;
@@ -66,23 +381,43 @@ int main( int argc, char * argv[] )
     if(ptSize[i] != labelSize[i]) sameSpace = false;
   }
   
-  //resample the image to the resolution of the labelmap after padding the labelmap
-  using PadderType = itk::ConstantPadImageFilter<LabelImageType, LabelImageType>;
-  auto padder = PadderType::New();
-  using ResamplerType = itk::ResampleImageFilter<ImageType, ImageType>;
-  auto resampler = ResamplerType::New();
-  //itk::PluginFilterWatcher watchResampler(resampler, "Resample Image", CLPProcessInformation);
-  if(!sameSpace)
+  // When the grids differ, either the image is resampled onto the label grid
+  // (the default) or the label is mapped onto the image grid. In the first case
+  // only the part of the image around the label is resampled.
+  std::string geometryUsed = "Same";
+  if(!sameSpace && Geometry_Mode == "Image")
+  {
+    // nearest neighbour keeps the label values; the image is not touched
+    using LabelResamplerType = itk::ResampleImageFilter<LabelImageType, LabelImageType>;
+    auto labelResampler = LabelResamplerType::New();
+    SetNumberOfThreads( labelResampler, Number_Of_Threads );
+    using InterpolatorType = itk::NearestNeighborInterpolateImageFunction<LabelImageType, double>;
+    labelResampler->SetInput(labelImage);
+    labelResampler->SetInterpolator(InterpolatorType::New());
+    labelResampler->UseReferenceImageOn();
+    labelResampler->SetReferenceImage(ptImage);
+    labelResampler->SetDefaultPixelValue(0);
+    labelResampler->UpdateLargestPossibleRegion();
+    labelImage = labelResampler->GetOutput();
+    labelImage->DisconnectPipeline();
+    geometryUsed = "Image";
+  }
+  else if(!sameSpace)
   {
-    ImageType::SizeType extend;
+    typename ImageType::SizeType extend;
     extend.Fill(2); // for SAM calculation we need a 2 voxel boundary around the object
-    padder->SetInput(labelImage);
-    padder->SetPadLowerBound(extend);
-    padder->SetPadUpperBound(extend);
-    padder->SetConstant(0);
-    padder->Update();
-    labelImage = padder->GetOutput();
-    //labelImage->DisconnectPipeline();
+    {
+      using PadderType = itk::ConstantPadImageFilter<LabelImageType, LabelImageType>;
+      auto padder = PadderType::New();
+      SetNumberOfThreads( padder, Number_Of_Threads );
+      padder->SetInput(labelImage);
+      padder->SetPadLowerBound(extend);
+      padder->SetPadUpperBound(extend);
+      padder->SetConstant(0);
+      padder->Update();
+      labelImage = padder->GetOutput();
+      labelImage->DisconnectPipeline();
+    }
     // reset non-zero index
     auto r = labelImage->GetLargestPossibleRegion();
     auto idx = r.GetIndex();
@@ -100,19 +435,58 @@ int main( int argc, char * argv[] )
         break;       
       }
     }
-      
+
+    // crop the label grid to the bounding box of the label(s), keeping the
+    // 2 voxel SAM boundary and the reach of the peak sphere around it
+    typename LabelImageType::RegionType cropRegion;
+    if(GetLabelBoundingBox(labelImage.GetPointer(), returnCSV, Label_Value, cropRegion))
+    {
+      for(unsigned int i=0; i<Dimension; ++i)
+      {
+        auto margin = GetLabelMargin(labelSpacing[i]);
+        cropRegion.SetIndex(i, cropRegion.GetIndex(i) - margin);
+        cropRegion.SetSize(i, cropRegion.GetSize(i) + 2*margin);
+      }
+      cropRegion.Crop(labelImage->GetLargestPossibleRegion());
+      using LabelCropperType = itk::RegionOfInterestImageFilter<LabelImageType, LabelImageType>;
+      auto labelCropper = LabelCropperType::New();
+      SetNumberOfThreads( labelCropper, Number_Of_Threads );
+      labelCropper->SetInput(labelImage);
+      labelCropper->SetRegionOfInterest(cropRegion);
+      labelCropper->Update();
+      labelImage = labelCropper->GetOutput();
+      labelImage->DisconnectPipeline();
+    }
+
+    using ResamplerType = itk::ResampleImageFilter<ImageType, ImageType>;
+    auto resampler = ResamplerType::New();
+    SetNumberOfThreads( resampler, Number_Of_Threads );
+    //itk::PluginFilterWatcher watchResampler(resampler, "Resample Image", CLPProcessInformation);
     resampler->SetInput(ptImage);
     resampler->UseReferenceImageOn();
     resampler->SetReferenceImage(labelImage);
     resampler->UpdateLargestPossibleRegion();
     resampler->Update();
     ptImage = resampler->GetOutput();
+    ptImage->DisconnectPipeline();
+    geometryUsed = "Label";
   }
+  cout << "Geometry: " << geometryUsed << endl;
   using QIFilterType = itk::QuantitativeIndicesComputationFilter<ImageType,LabelImageType>;
 
+  // only the passes needed for the selected indices are run
+  unsigned int requestedFeatures = 0;
+  if(Mean||RMS||Std_Deviation||Max||Min||Volume||TLG){requestedFeatures |= QIFilterType::MomentsFeature;};
+  if(Glycolysis_Q1||Glycolysis_Q2||Glycolysis_Q3||Glycolysis_Q4||Q1_Distribution||Q2_Distribution||Q3_Distribution||Q4_Distribution){requestedFeatures |= QIFilterType::QuarterBinsFeature;};
+  if(First_Quartile||Median||Third_Quartile||Upper_Adjacent){requestedFeatures |= QIFilterType::QuartilesFeature;};
+  if(SAM||SAM_Background){requestedFeatures |= QIFilterType::SAMFeature;};
+  if(Peak){requestedFeatures |= QIFilterType::PeakFeature;};
+
   if(!returnCSV){
-    ofstream writeFile;
-    writeFile.open( returnParameterFile.c_str() );
+    // the server returns the results instead of writing them to a file
+    ofstream returnFile;
+    if(!resultStream){ returnFile.open( returnParameterFile.c_str() ); }
+    ostream& writeFile = resultStream ? *resultStream : returnFile;
     if(!Mean){writeFile << "Mean_s = --" << endl;};
     //if(!Variance){writeFile << "Variance_s = --" << endl;};
     if(!Std_Deviation){writeFile << "Std_Deviation_s = --" << endl;};
@@ -138,10 +512,17 @@ int main( int argc, char * argv[] )
     if(!Peak){writeFile << "Peak_s = --" << endl;};
 
     auto qiCompute = QIFilterType::New();
+    SetNumberOfThreads( qiCompute, Number_Of_Threads );
     //itk::PluginFilterWatcher watchFilter(qiCompute, "Quantitative Indices Computation", CLPProcessInformation);
     qiCompute->SetInputImage(ptImage);
     qiCompute->SetInputLabelImage(labelImage);
-    qiCompute->SetCurrentLabel( (int)Label_Value );
+    qiCompute->SetCurrentLabel( static_cast<LabelPixelType>(Label_Value) );
+    // the list of segmented values is only needed for the order statistics
+    qiCompute->SetUseStreamingMoments( Approximate_Quartiles || !(First_Quartile || Median || Third_Quartile || Upper_Adjacent) );
+    qiCompute->SetUseApproximateQuartiles( Approximate_Quartiles );
+    qiCompute->SetQuartileErrorBound( Quartile_Error_Bound );
+    qiCompute->SetRequestedFeatures( requestedFeatures );
+    qiCompute->SetPeakKernelCacheDirectory( Peak_Kernel_Cache_Directory );
     //qiCompute->Update();
 
     if(Mean||RMS||Std_Deviation||Max||Min||Volume||TLG||Glycolysis_Q1||Glycolysis_Q2||Glycolysis_Q3||Glycolysis_Q4||Q1_Distribution||Q2_Distribution||Q3_Distribution||Q4_Distribution)
@@ -292,6 +673,12 @@ int main( int argc, char * argv[] )
             cout << "Upper Adjacent: " << adj << endl;
           }
         }
+        // 0 for the exact calculation
+        double bound = qiCompute->GetAchievedQuartileErrorBound();
+        if(!isnan(bound)){
+          writeFile << "Quartile_Error_Bound_Achieved = " << bound << endl;
+          cout << "Achieved Quartile Error Bound: " << bound << endl;
+        }
       }
 
     if(SAM||SAM_Background)
@@ -320,15 +707,17 @@ int main( int argc, char * argv[] )
         cout << "Peak: " << (double) qiCompute->GetPeakValue() << endl;
       }
       
+    writeFile << "Geometry_Used = " << geometryUsed << endl;
     writeFile << "Software_Version = " << QuantitativeIndicesExt_WC_REVISION << endl;
 
-    writeFile.close();
+    returnFile.close();
   }
   else{ // create the csv file
     cout << "Writing to file " << CSVFile.c_str() << endl;
     
-    ofstream writeFile; // needed always?
-    writeFile.open( returnParameterFile.c_str() );
+    ofstream returnFile; // needed always?
+    if(!resultStream){ returnFile.open( returnParameterFile.c_str() ); }
+    ostream& writeFile = resultStream ? *resultStream : returnFile;
     writeFile << "Mean_s = --" << endl;
     //writeFile << "Variance_s = --" << endl;
     writeFile << "Std_Deviation_s = --" << endl;
@@ -352,29 +741,18 @@ int main( int argc, char * argv[] )
     writeFile << "SAM_s = --" << endl;
     writeFile << "SAM_Background_s = --" << endl;
     writeFile << "Peak_s = --" << endl;
-    writeFile.close();
+    writeFile << "Geometry_Used = " << geometryUsed << endl;
+    returnFile.close();
     
     ofstream csvFile;
     csvFile.open( CSVFile.c_str() );
     
-    // get the label values
-    using IteratorType = itk::ImageRegionConstIterator<LabelImageType>;
-    IteratorType it(labelImage, labelImage->GetLargestPossibleRegion());
-    it.GoToBegin();
-    std::set<int> regionLabels;
-
-    while(!it.IsAtEnd())
-    {
-      int labelValue = it.Get();
-      if(labelValue > 0)
-      {
-        if(regionLabels.find(labelValue)==regionLabels.end())
-        {
-          regionLabels.insert(labelValue);
-        }
-      }
-      ++it;
-    }
+    // gather the bounding box and moments of every label in one sweep. The
+    // values themselves are only kept if exact order statistics are requested.
+    bool storeValues = !Approximate_Quartiles && (First_Quartile || Median || Third_Quartile || Upper_Adjacent);
+    typename QIFilterType::LabelStatisticsMapType regionLabels;
+    QIFilterType::ComputeLabelStatistics(ptImage, labelImage, storeValues, regionLabels,
+                                         static_cast<unsigned int>(Number_Of_Threads));
     
     // create the column header
     csvFile << "Label_Value,";
@@ -401,39 +779,31 @@ int main( int argc, char * argv[] )
     if(Q4_Distribution){csvFile << "Q4_Distribution,";};
     if(SAM){csvFile << "SAM,";};
     if(SAM_Background){csvFile << "SAM_Background,";};
+    bool reportQuartileErrorBound = Approximate_Quartiles && (First_Quartile || Median || Third_Quartile || Upper_Adjacent);
+    if(reportQuartileErrorBound){csvFile << "Quartile_Error_Bound,";};
     
     
     
     // calculate indices for each non-zero label value
-    for (std::set<int>::iterator sit=regionLabels.begin(); sit!=regionLabels.end(); ++sit)
+    for (auto sit=regionLabels.begin(); sit!=regionLabels.end(); ++sit)
     {
       csvFile << endl;
-      int labelValue = *sit;
+      int labelValue = sit->first;
       csvFile << labelValue << ",";
       
-      QIFilterType::Pointer qiCompute = QIFilterType::New();
+      typename QIFilterType::Pointer qiCompute = QIFilterType::New();
+      SetNumberOfThreads( qiCompute, Number_Of_Threads );
       //itk::PluginFilterWatcher watchFilter(qiCompute, "Quantitative Indices Computation", CLPProcessInformation);
       qiCompute->SetInputImage(ptImage);
       qiCompute->SetInputLabelImage(labelImage);
-      qiCompute->SetCurrentLabel( labelValue );
+      qiCompute->SetCurrentLabel( sit->first );
+      qiCompute->SetLabelStatistics( std::move(sit->second) );
+      qiCompute->SetUseStreamingMoments( !storeValues );
+      qiCompute->SetUseApproximateQuartiles( Approximate_Quartiles );
+      qiCompute->SetQuartileErrorBound( Quartile_Error_Bound );
+      qiCompute->SetRequestedFeatures( requestedFeatures );
+      qiCompute->SetPeakKernelCacheDirectory( Peak_Kernel_Cache_Directory );
       qiCompute->Update();
-      
-      if(Mean||RMS||Std_Deviation||Max||Min||Volume||TLG||Glycolysis_Q1||Glycolysis_Q2||Glycolysis_Q3||Glycolysis_Q4||Q1_Distribution||Q2_Distribution||Q3_Distribution||Q4_Distribution)
-      {
-        qiCompute->CalculateMean();
-      }
-      if(First_Quartile || Median || Third_Quartile || Upper_Adjacent)
-      {
-        qiCompute->CalculateQuartiles();
-      }
-      if(SAM||SAM_Background)
-      {
-        qiCompute->CalculateSAM();
-      }
-      if(Peak)
-      {
-        qiCompute->CalculatePeak();
-      }
 
       if(Mean){csvFile << qiCompute->GetAverageValue() << ",";};
       if(Min){csvFile << qiCompute->GetMinimumValue() << ",";};
@@ -458,6 +828,7 @@ int main( int argc, char * argv[] )
       if(Q4_Distribution){csvFile << 100*(qiCompute->GetQ4()) << ",";};
       if(SAM){csvFile << 0.001*(qiCompute->GetSAMValue()) << ",";};
       if(SAM_Background){csvFile << qiCompute->GetSAMBackground() << ",";};
+      if(reportQuartileErrorBound){csvFile << qiCompute->GetAchievedQuartileErrorBound() << ",";};
       
     }
     csvFile.close();
@@ -465,3 +836,127 @@ int main( int argc, char * argv[] )
   
   return EXIT_SUCCESS;
 }
+
+//----------------------------------------------------------------------------
+// true if the label value can be stored in the label pixel type
+template <class TLabelPixel>
+bool LabelValueFits( int labelValue )
+{
+  return labelValue >= 0 && labelValue <= static_cast<int>(itk::NumericTraits<TLabelPixel>::max());
+}
+
+//----------------------------------------------------------------------------
+// Picks the pixel types from the files and runs one calculation. The results
+// are written to resultStream if given, otherwise to the return parameter file.
+int Run( int argc, char * argv[], std::ostream* resultStream )
+{
+  PARSE_ARGS;
+
+  // Pick the pixel types from the files. The label keeps an 8 or 16 bit
+  // unsigned type when it is stored so (and the selected label value fits);
+  // the image is read as float unless it is stored as double, converting any
+  // other type on reading.
+  itk::IOPixelEnum pixelType;
+  itk::IOComponentEnum imageComponentType;
+  itk::IOComponentEnum labelComponentType;
+  try
+  {
+    itk::GetImageType(Grayscale_Image, pixelType, imageComponentType);
+    itk::GetImageType(Label_Image, pixelType, labelComponentType);
+    const bool doublePrecision = imageComponentType == itk::IOComponentEnum::DOUBLE;
+    if(labelComponentType == itk::IOComponentEnum::UCHAR && (returnCSV || LabelValueFits<unsigned char>(Label_Value)))
+    {
+      return doublePrecision ? DoIt<double, unsigned char>( argc, argv, resultStream ) : DoIt<float, unsigned char>( argc, argv, resultStream );
+    }
+    if(labelComponentType == itk::IOComponentEnum::USHORT && (returnCSV || LabelValueFits<unsigned short>(Label_Value)))
+    {
+      return doublePrecision ? DoIt<double, unsigned short>( argc, argv, resultStream ) : DoIt<float, unsigned short>( argc, argv, resultStream );
+    }
+    return doublePrecision ? DoIt<double, int>( argc, argv, resultStream ) : DoIt<float, int>( argc, argv, resultStream );
+  }
+  catch( itk::ExceptionObject & excep )
+  {
+    cerr << argv[0] << ": exception caught !" << endl;
+    cerr << excep << endl;
+    return EXIT_FAILURE;
+  }
+}
+
+//----------------------------------------------------------------------------
+// Server mode: every line read from stdin is one calculation, given as the
+// command line arguments separated by tabs. The results are written to
+// stdout as in the return parameter file, followed by "QI_END <status>".
+// Other output goes to stderr. The grayscale images and peak kernels stay
+// loaded between requests.
+int RunServer( char * program )
+{
+  std::ostream protocol(cout.rdbuf());
+  cout.rdbuf(cerr.rdbuf());
+  protocol << "QI_SERVER_READY " << QuantitativeIndicesExt_WC_REVISION << endl;
+
+  std::string request;
+  while(std::getline(std::cin, request))
+  {
+    if(!request.empty() && request.back() == '\r')
+    {
+      request.pop_back();
+    }
+    if(request.empty())
+    {
+      continue;
+    }
+    if(request == "QUIT")
+    {
+      break;
+    }
+    std::vector<std::string> arguments(1, program);
+    std::string::size_type start = 0;
+    while(start <= request.size())
+    {
+      auto end = request.find('\t', start);
+      if(end == std::string::npos)
+      {
+        end = request.size();
+      }
+      arguments.push_back(request.substr(start, end - start));
+      start = end + 1;
+    }
+    std::vector<char*> requestArgv;
+    for(auto& argument : arguments)
+    {
+      requestArgv.push_back(&argument[0]);
+    }
+    requestArgv.push_back(nullptr);
+
+    std::ostringstream results;
+    int status = EXIT_FAILURE;
+    try
+    {
+      status = Run(static_cast<int>(arguments.size()), requestArgv.data(), &results);
+    }
+    catch( std::exception & excep )
+    {
+      cerr << program << ": exception caught !" << endl;
+      cerr << excep.what() << endl;
+    }
+    protocol << results.str();
+    protocol << "QI_END " << status << endl;
+  }
+  cout.rdbuf(protocol.rdbuf());
+  return EXIT_SUCCESS;
+}
+
+} // end namespace
+
+int main( int argc, char * argv[] )
+{
+  // the server reads its requests from stdin and has no other arguments
+  for(int i=1; i<argc; ++i)
+  {
+    if(std::string(argv[i]) == "--server")
+    {
+      return RunServer(argv[0]);
+    }
+  }
+  return Run(argc, argv, nullptr);
+}
@@ -0,0 +1,227 @@
+#if defined(_MSC_VER)
+#pragma warning ( disable : 4786 )
+#endif
+
+#include "itkImage.h"
+#include "itkImageFileWriter.h"
+#include "itkImageRegionIteratorWithIndex.h"
+
+// STD includes
+#include <algorithm>
+#include <cmath>
+#include <cstdlib>
+#include <fstream>
+#include <iostream>
+#include <map>
+#include <string>
+#include <vector>
+
+#ifdef WIN32
+# define MODULE_IMPORT __declspec(dllimport)
+#else
+# define MODULE_IMPORT
+#endif
+
+extern "C" MODULE_IMPORT int ModuleEntryPoint(int, char* []);
+
+/*
+Compares the indices calculated with --streamImageRegion with those of a
+normal read. The label grid is coarser than the image grid (5 times the
+spacing), so the SAM boundary and the peak sphere on the label grid reach
+further than the image margins would; the streamed region must still cover
+them. Both geometry modes are checked, as well as a label on the image grid.
+*/
+
+namespace
+{
+
+constexpr unsigned int Dimension = 3;
+using ImageType = itk::Image<float, Dimension>;
+using LabelImageType = itk::Image<unsigned char, Dimension>;
+
+const char* Indices[] = { "Mean_s", "Std_Deviation_s", "Max_s", "Min_s", "Volume_s", "Median_s",
+                          "SAM_s", "SAM_Background_s", "Peak_s", "Geometry_Used" };
+
+void WriteImage( const std::string& fileName )
+{
+  ImageType::SizeType size;
+  size.Fill(100);
+  auto image = ImageType::New();
+  image->SetRegions(ImageType::RegionType(size));
+  image->Allocate();
+
+  // a background that changes over the whole image and a hot sphere in the
+  // middle, so that any voxel missing from the streamed region changes SAM
+  itk::ImageRegionIteratorWithIndex<ImageType> it(image, image->GetLargestPossibleRegion());
+  for(it.GoToBegin(); !it.IsAtEnd(); ++it)
+  {
+    const ImageType::IndexType index = it.GetIndex();
+    double distance2 = 0.0;
+    for(unsigned int i=0; i<Dimension; ++i)
+    {
+      distance2 += (index[i]-50.0)*(index[i]-50.0);
+    }
+    it.Set(static_cast<float>(10.0 + 0.1*index[0] + 0.05*index[1] + 0.02*index[2] + 100.0*std::exp(-distance2/50.0)));
+  }
+
+  using WriterType = itk::ImageFileWriter<ImageType>;
+  auto writer = WriterType::New();
+  writer->SetInput(image);
+  writer->SetFileName(fileName);
+  writer->UseCompressionOff();
+  writer->Update();
+}
+
+void WriteLabel( const std::string& fileName, double spacing, double originOffset )
+{
+  // a cube of about 12mm around the center of the image
+  const itk::SizeValueType labelSize = static_cast<itk::SizeValueType>(std::ceil(100.0/spacing));
+  LabelImageType::SizeType size;
+  size.Fill(labelSize);
+  LabelImageType::SpacingType labelSpacing;
+  labelSpacing.Fill(spacing);
+  LabelImageType::PointType origin;
+  origin.Fill(originOffset);
+  auto label = LabelImageType::New();
+  label->SetRegions(LabelImageType::RegionType(size));
+  label->SetSpacing(labelSpacing);
+  label->SetOrigin(origin);
+  label->Allocate();
+  label->FillBuffer(0);
+
+  itk::ImageRegionIteratorWithIndex<LabelImageType> it(label, label->GetLargestPossibleRegion());
+  for(it.GoToBegin(); !it.IsAtEnd(); ++it)
+  {
+    LabelImageType::PointType point;
+    label->TransformIndexToPhysicalPoint(it.GetIndex(), point);
+    bool inside = true;
+    for(unsigned int i=0; i<Dimension; ++i)
+    {
+      inside = inside && std::abs(point[i]-50.0) <= 6.0;
+    }
+    if(inside)
+    {
+      it.Set(1);
+    }
+  }
+
+  using WriterType = itk::ImageFileWriter<LabelImageType>;
+  auto writer = WriterType::New();
+  writer->SetInput(label);
+  writer->SetFileName(fileName);
+  writer->UseCompressionOff();
+  writer->Update();
+}
+
+bool RunCLI( const std::string& imageFile, const std::string& labelFile, const std::string& geometryMode,
+             bool stream, const std::string& returnFile, std::map<std::string, std::string>& results )
+{
+  std::vector<std::string> arguments = { "QuantitativeIndicesCLI", "--mean", "--stddev", "--max", "--min",
+                                         "--volume", "--median", "--sam", "--sambg", "--peak",
+                                         "--geometryMode", geometryMode,
+                                         "--returnparameterfile", returnFile };
+  if(stream)
+  {
+    arguments.push_back("--streamImageRegion");
+  }
+  arguments.push_back(imageFile);
+  arguments.push_back(labelFile);
+  arguments.push_back("1");
+  std::vector<char*> argv;
+  for(auto& argument : arguments)
+  {
+    argv.push_back(&argument[0]);
+  }
+  argv.push_back(nullptr);
+  if(ModuleEntryPoint(static_cast<int>(arguments.size()), argv.data()) != EXIT_SUCCESS)
+  {
+    return false;
+  }
+
+  std::ifstream file(returnFile.c_str());
+  std::string line;
+  while(std::getline(file, line))
+  {
+    auto separator = line.find(" = ");
+    if(separator != std::string::npos)
+    {
+      results[line.substr(0, separator)] = line.substr(separator + 3);
+    }
+  }
+  return true;
+}
+
+int CompareStreamedRun( const std::string& directory, const std::string& name, const std::string& imageFile,
+                        const std::string& labelFile, const std::string& geometryMode )
+{
+  std::map<std::string, std::string> readResults;
+  std::map<std::string, std::string> streamedResults;
+  if(!RunCLI(imageFile, labelFile, geometryMode, false, directory + "/" + name + "Read.params", readResults) ||
+     !RunCLI(imageFile, labelFile, geometryMode, true, directory + "/" + name + "Streamed.params", streamedResults))
+  {
+    std::cerr << name << ": the CLI failed" << std::endl;
+    return 1;
+  }
+
+  int failures = 0;
+  for(const char* index : Indices)
+  {
+    const std::string readValue = readResults[index];
+    const std::string streamedValue = streamedResults[index];
+    std::cout << name << " " << index << ": " << readValue << " / " << streamedValue << std::endl;
+    if(readValue.empty() || readValue == "--")
+    {
+      std::cerr << name << ": " << index << " was not calculated" << std::endl;
+      ++failures;
+      continue;
+    }
+    char* end = nullptr;
+    const double read = std::strtod(readValue.c_str(), &end);
+    if(*end != '\0')
+    {
+      // not a number, e.g. the geometry
+      if(streamedValue != readValue)
+      {
+        std::cerr << name << ": " << index << " " << streamedValue << " differs from " << readValue << std::endl;
+        ++failures;
+      }
+      continue;
+    }
+    const double streamed = std::strtod(streamedValue.c_str(), &end);
+    if(*end != '\0' || !(std::abs(streamed-read) <= 1e-5*std::max(1.0, std::abs(read))))
+    {
+      std::cerr << name << ": streamed " << index << " " << streamedValue << " differs from " << readValue << std::endl;
+      ++failures;
+    }
+  }
+  return failures;
+}
+
+} // end namespace
+
+int main( int argc, char* argv[] )
+{
+  if(argc < 2)
+  {
+    std::cerr << "Usage: " << argv[0] << " <temporary directory>" << std::endl;
+    return EXIT_FAILURE;
+  }
+  const std::string directory = argv[1];
+  const std::string imageFile = directory + "/QuantitativeIndicesCLIStreamImage.nrrd";
+  const std::string coarseLabelFile = directory + "/QuantitativeIndicesCLIStreamCoarseLabel.nrrd";
+  const std::string labelFile = directory + "/QuantitativeIndicesCLIStreamLabel.nrrd";
+  WriteImage(imageFile);
+  WriteLabel(coarseLabelFile, 5.0, 0.5);
+  WriteLabel(labelFile, 1.0, 0.0);
+
+  int failures = 0;
+  failures += CompareStreamedRun(directory, "CoarseLabel", imageFile, coarseLabelFile, "Label");
+  failures += CompareStreamedRun(directory, "CoarseImage", imageFile, coarseLabelFile, "Image");
+  failures += CompareStreamedRun(directory, "Same", imageFile, labelFile, "Label");
+  if(failures>0)
+  {
+    std::cerr << failures << " streamed indices differ" << std::endl;
+    return EXIT_FAILURE;
+  }
+  return EXIT_SUCCESS;
+}
@@ -0,0 +1,195 @@
+#if defined(_MSC_VER)
+#pragma warning ( disable : 4786 )
+#endif
+
+#include "itkImage.h"
+#include "itkImageFileReader.h"
+#include "itkImageFileWriter.h"
+#include "itkImageRegionConstIterator.h"
+#include "itkImageRegionIteratorWithIndex.h"
+#include "itkMemoryMappedImageFileReader.h"
+
+// STD includes
+#include <fstream>
+#include <iostream>
+#include <string>
+
+/*
+Maps raw NRRD and MetaImage files, with the data in the header file and
+detached, and compares the mapped images with those of ImageFileReader.
+Files that cannot be mapped must make Map() return false so that the
+caller falls back to ImageFileReader:
+ - another pixel type than the stored one
+ - compressed data
+ - MetaImage text data (BinaryData = False)
+*/
+
+namespace
+{
+
+constexpr unsigned int Dimension = 3;
+using ImageType = itk::Image<float, Dimension>;
+using ShortImageType = itk::Image<short, Dimension>;
+using MapperType = itk::MemoryMappedImageFileReader<ImageType>;
+
+ImageType::Pointer MakeImage()
+{
+  ImageType::SizeType size = {{ 13, 11, 7 }};
+  ImageType::SpacingType spacing;
+  spacing[0] = 0.8;
+  spacing[1] = 1.2;
+  spacing[2] = 2.5;
+  ImageType::PointType origin;
+  origin[0] = -10.0;
+  origin[1] = 4.5;
+  origin[2] = 100.0;
+  ImageType::DirectionType direction;
+  direction.SetIdentity();
+  direction[0][0] = 0.0;
+  direction[0][1] = 1.0;
+  direction[1][0] = -1.0;
+  direction[1][1] = 0.0;
+
+  auto image = ImageType::New();
+  image->SetRegions(ImageType::RegionType(size));
+  image->SetSpacing(spacing);
+  image->SetOrigin(origin);
+  image->SetDirection(direction);
+  image->Allocate();
+  itk::ImageRegionIteratorWithIndex<ImageType> it(image, image->GetLargestPossibleRegion());
+  for(it.GoToBegin(); !it.IsAtEnd(); ++it)
+  {
+    const ImageType::IndexType index = it.GetIndex();
+    it.Set(static_cast<float>(index[0] + 100*index[1] + 10000*index[2]) * 0.5f - 3.25f);
+  }
+  return image;
+}
+
+void WriteImage( const ImageType* image, const std::string& fileName, bool compress )
+{
+  using WriterType = itk::ImageFileWriter<ImageType>;
+  auto writer = WriterType::New();
+  writer->SetInput(image);
+  writer->SetFileName(fileName);
+  writer->SetUseCompression(compress);
+  writer->Update();
+}
+
+bool SameImages( const ImageType* mapped, const ImageType* read )
+{
+  if(mapped->GetLargestPossibleRegion() != read->GetLargestPossibleRegion() ||
+     mapped->GetSpacing() != read->GetSpacing() ||
+     mapped->GetOrigin() != read->GetOrigin() ||
+     mapped->GetDirection() != read->GetDirection())
+  {
+    return false;
+  }
+  itk::ImageRegionConstIterator<ImageType> mit(mapped, mapped->GetLargestPossibleRegion());
+  itk::ImageRegionConstIterator<ImageType> rit(read, read->GetLargestPossibleRegion());
+  for(mit.GoToBegin(), rit.GoToBegin(); !mit.IsAtEnd(); ++mit, ++rit)
+  {
+    if(mit.Get() != rit.Get())
+    {
+      return false;
+    }
+  }
+  return true;
+}
+
+int CheckMapped( const std::string& fileName )
+{
+  using ReaderType = itk::ImageFileReader<ImageType>;
+  auto reader = ReaderType::New();
+  reader->SetFileName(fileName);
+  reader->Update();
+
+  auto mapper = MapperType::New();
+  mapper->SetFileName(fileName);
+  if(!mapper->Map())
+  {
+    std::cerr << fileName << " was not mapped" << std::endl;
+    return 1;
+  }
+  if(!SameImages(mapper->GetOutput(), reader->GetOutput()))
+  {
+    std::cerr << fileName << ": the mapped image differs from the one read" << std::endl;
+    return 1;
+  }
+  std::cout << fileName << " mapped" << std::endl;
+  return 0;
+}
+
+template <class TImage>
+int CheckNotMapped( const std::string& fileName )
+{
+  // the file must still be readable normally
+  using ReaderType = itk::ImageFileReader<TImage>;
+  auto reader = ReaderType::New();
+  reader->SetFileName(fileName);
+  reader->Update();
+
+  using TypedMapperType = itk::MemoryMappedImageFileReader<TImage>;
+  auto mapper = TypedMapperType::New();
+  mapper->SetFileName(fileName);
+  if(mapper->Map() || mapper->GetOutput())
+  {
+    std::cerr << fileName << " was mapped but has to be read" << std::endl;
+    return 1;
+  }
+  std::cout << fileName << " not mapped" << std::endl;
+  return 0;
+}
+
+void WriteTextMetaImage( const std::string& fileName )
+{
+  std::ofstream file(fileName.c_str());
+  file << "ObjectType = Image" << std::endl;
+  file << "NDims = 3" << std::endl;
+  file << "BinaryData = False" << std::endl;
+  file << "BinaryDataByteOrderMSB = False" << std::endl;
+  file << "CompressedData = False" << std::endl;
+  file << "DimSize = 2 2 2" << std::endl;
+  file << "ElementType = MET_FLOAT" << std::endl;
+  file << "ElementDataFile = LOCAL" << std::endl;
+  file << "1 2 3 4 5 6 7 8" << std::endl;
+}
+
+} // end namespace
+
+int main( int argc, char* argv[] )
+{
+  if(argc < 2)
+  {
+    std::cerr << "Usage: " << argv[0] << " <temporary directory>" << std::endl;
+    return EXIT_FAILURE;
+  }
+  const std::string directory = std::string(argv[1]) + "/itkMemoryMappedImageFileReaderTest";
+  auto image = MakeImage();
+
+  int failures = 0;
+  // data in the header file and detached (.raw next to the header, so each
+  // file gets a name of its own)
+  for(const char* extension : { ".nrrd", ".nhdr", ".mha", ".mhd" })
+  {
+    const std::string fileName = directory + (extension + 1) + extension;
+    WriteImage(image, fileName, false);
+    failures += CheckMapped(fileName);
+    failures += CheckNotMapped<ShortImageType>(fileName);
+  }
+  for(const char* extension : { ".nrrd", ".mha" })
+  {
+    const std::string fileName = directory + "Compressed" + extension;
+    WriteImage(image, fileName, true);
+    failures += CheckNotMapped<ImageType>(fileName);
+  }
+  const std::string textFileName = directory + "Text.mha";
+  WriteTextMetaImage(textFileName);
+  failures += CheckNotMapped<ImageType>(textFileName);
+
+  if(failures>0)
+  {
+    std::cerr << failures << " memory mapping checks failed" << std::endl;
+    return EXIT_FAILURE;
+  }
+  return EXIT_SUCCESS;
+}
@@ -0,0 +1,200 @@
+#if defined(_MSC_VER)
+#pragma warning ( disable : 4786 )
+#endif
+
+#include "itkImage.h"
+#include "itkImageRegionIteratorWithIndex.h"
+#include "itkPeakIntensityFilter.h"
+
+// STD includes
+#include <cmath>
+#include <iostream>
+#include <random>
+
+/*
+Compares the peak found with the chord decomposition and the pruned search
+against the neighborhood operator evaluated at every placement. Two hot
+spots are placed in the label so that their kernel means tie in single
+precision:
+ - identical hot spots: the first placement in scan order must be kept
+ - the second hot spot has the center and a neighbor swapped (same kernel
+   mean, higher center value): the second placement must win
+A region of negative values must give its negative peak.
+*/
+
+namespace
+{
+
+constexpr unsigned int Dimension = 3;
+using ImageType = itk::Image<float, Dimension>;
+using LabelImageType = itk::Image<unsigned char, Dimension>;
+using PeakFilterType = itk::PeakIntensityFilter<ImageType, LabelImageType>;
+
+const ImageType::IndexType FirstSpot = {{ 12, 12, 12 }};
+const ImageType::IndexType SecondSpot = {{ 22, 20, 19 }};
+const itk::IndexValueType SpotRadius = 4;
+
+void MakeImages( bool swapCenter, ImageType::Pointer& image, LabelImageType::Pointer& label )
+{
+  ImageType::SizeType size;
+  size.Fill(36);
+  ImageType::RegionType region(size);
+  ImageType::SpacingType spacing;
+  spacing.Fill(2.0);
+
+  image = ImageType::New();
+  image->SetRegions(region);
+  image->SetSpacing(spacing);
+  image->Allocate();
+  label = LabelImageType::New();
+  label->SetRegions(region);
+  label->SetSpacing(spacing);
+  label->Allocate();
+  label->FillBuffer(0);
+
+  std::mt19937 generator(42);
+  std::uniform_real_distribution<float> background(0.0f, 10.0f);
+  std::uniform_real_distribution<float> noise(0.0f, 1.0f);
+  itk::ImageRegionIteratorWithIndex<ImageType> it(image, region);
+  for(it.GoToBegin(); !it.IsAtEnd(); ++it)
+  {
+    it.Set(background(generator));
+    const ImageType::IndexType index = it.GetIndex();
+    bool inside = true;
+    for(unsigned int i=0; i<Dimension; ++i)
+    {
+      inside = inside && index[i]>=4 && index[i]<32;
+    }
+    if(inside)
+    {
+      label->SetPixel(index, 1);
+    }
+  }
+
+  // the same hot spot at both locations, falling off from its center so
+  // that the peak is centered on it
+  ImageType::OffsetType offset;
+  for(offset[2]=-SpotRadius; offset[2]<=SpotRadius; ++offset[2])
+  {
+    for(offset[1]=-SpotRadius; offset[1]<=SpotRadius; ++offset[1])
+    {
+      for(offset[0]=-SpotRadius; offset[0]<=SpotRadius; ++offset[0])
+      {
+        const float value = 1000.0f - 20.0f*(offset[0]*offset[0]+offset[1]*offset[1]+offset[2]*offset[2])
+                            + noise(generator);
+        image->SetPixel(FirstSpot + offset, value);
+        image->SetPixel(SecondSpot + offset, value);
+      }
+    }
+  }
+
+  // center below its neighbor, so swapping them raises the center value
+  // without changing the kernel mean (both have weight 1)
+  ImageType::OffsetType neighbor = {{ 1, 0, 0 }};
+  image->SetPixel(FirstSpot, 980.0f);
+  image->SetPixel(FirstSpot + neighbor, 995.0f);
+  image->SetPixel(SecondSpot, swapCenter ? 995.0f : 980.0f);
+  image->SetPixel(SecondSpot + neighbor, swapCenter ? 980.0f : 995.0f);
+}
+
+int ComparePeakSearches( bool swapCenter )
+{
+  ImageType::Pointer image;
+  LabelImageType::Pointer label;
+  MakeImages(swapCenter, image, label);
+  const ImageType::IndexType expectedIndex = swapCenter ? SecondSpot : FirstSpot;
+
+  double referencePeak = 0.0;
+  PeakFilterType::PointType referenceLocation;
+  int failures = 0;
+  for(int configuration=0; configuration<4; ++configuration)
+  {
+    const bool useChords = configuration & 1;
+    const bool usePruned = configuration & 2;
+    auto peakFilter = PeakFilterType::New();
+    peakFilter->SetInputImage(image);
+    peakFilter->SetInputLabelImage(label);
+    peakFilter->SetCurrentLabel(1);
+    peakFilter->SetSphereVolume(1000);
+    peakFilter->SetUseChordDecomposition(useChords);
+    peakFilter->SetUsePrunedSearch(usePruned);
+    peakFilter->CalculatePeak();
+
+    const double peak = peakFilter->GetPeakValue();
+    const ImageType::IndexType peakIndex = peakFilter->GetPeakIndex();
+    const PeakFilterType::PointType peakLocation = peakFilter->GetPeakLocation();
+    if(configuration==0)
+    {
+      referencePeak = peak;
+      referenceLocation = peakLocation;
+    }
+    std::cout << "chords " << useChords << ", pruned " << usePruned
+              << ": Peak " << peak << " at " << peakIndex << std::endl;
+    if(std::isnan(peak) || (float)peak!=(float)referencePeak ||
+       std::abs(peak-referencePeak) > 1e-9*std::abs(referencePeak))
+    {
+      std::cerr << "Peak " << peak << " differs from the reference " << referencePeak << std::endl;
+      ++failures;
+    }
+    if(peakIndex!=expectedIndex)
+    {
+      std::cerr << "Peak index " << peakIndex << " differs from the expected " << expectedIndex << std::endl;
+      ++failures;
+    }
+    if(peakLocation!=referenceLocation)
+    {
+      std::cerr << "Peak location " << peakLocation << " differs from the reference " << referenceLocation << std::endl;
+      ++failures;
+    }
+  }
+  return failures;
+}
+
+int CheckNonPositivePeak()
+{
+  // a region of negative values must give its (negative) peak at a placement
+  // in the label, not the seed of the search
+  ImageType::Pointer image;
+  LabelImageType::Pointer label;
+  MakeImages(false, image, label);
+  image->FillBuffer(-5.0f);
+
+  int failures = 0;
+  for(int configuration=0; configuration<4; ++configuration)
+  {
+    auto peakFilter = PeakFilterType::New();
+    peakFilter->SetInputImage(image);
+    peakFilter->SetInputLabelImage(label);
+    peakFilter->SetCurrentLabel(1);
+    peakFilter->SetSphereVolume(1000);
+    peakFilter->SetUseChordDecomposition(configuration & 1);
+    peakFilter->SetUsePrunedSearch(configuration & 2);
+    peakFilter->CalculatePeak();
+
+    const double peak = peakFilter->GetPeakValue();
+    const ImageType::IndexType peakIndex = peakFilter->GetPeakIndex();
+    if(!(std::abs(peak+5.0) <= 1e-9) || !label->GetLargestPossibleRegion().IsInside(peakIndex) ||
+       label->GetPixel(peakIndex)!=1)
+    {
+      std::cerr << "Peak " << peak << " at " << peakIndex << " of a region of -5" << std::endl;
+      ++failures;
+    }
+  }
+  return failures;
+}
+
+} // end namespace
+
+int main( int, char* [] )
+{
+  int failures = 0;
+  failures += ComparePeakSearches(false);
+  failures += ComparePeakSearches(true);
+  failures += CheckNonPositivePeak();
+  if(failures>0)
+  {
+    std::cerr << failures << " peak comparisons failed" << std::endl;
+    return EXIT_FAILURE;
+  }
+  return EXIT_SUCCESS;
+}
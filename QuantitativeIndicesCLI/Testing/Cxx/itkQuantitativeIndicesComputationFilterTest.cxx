@@ -0,0 +1,135 @@
+#if defined(_MSC_VER)
+#pragma warning ( disable : 4786 )
+#endif
+
+#include "itkImage.h"
+#include "itkImageRegionIteratorWithIndex.h"
+#include "itkQuantitativeIndicesComputationFilter.h"
+
+// STD includes
+#include <cmath>
+#include <iostream>
+#include <random>
+
+/*
+Compares the approximate quartiles (histogram) with the exact ones (sorted
+list) on synthetic images: the first quartile, median and third quartile
+must be within the achieved error bound, which must not exceed the
+requested one. The label sizes cover both rules of the quartile ranks
+(count divisible by 4 or not).
+*/
+
+namespace
+{
+
+constexpr unsigned int Dimension = 3;
+using ImageType = itk::Image<float, Dimension>;
+using LabelImageType = itk::Image<unsigned char, Dimension>;
+using QIFilterType = itk::QuantitativeIndicesComputationFilter<ImageType, LabelImageType>;
+
+void MakeImages( unsigned int labelSize, ImageType::Pointer& image, LabelImageType::Pointer& label )
+{
+  ImageType::SizeType size;
+  size.Fill(24);
+  ImageType::RegionType region(size);
+
+  image = ImageType::New();
+  image->SetRegions(region);
+  image->Allocate();
+  label = LabelImageType::New();
+  label->SetRegions(region);
+  label->Allocate();
+  label->FillBuffer(0);
+
+  // skewed values, like the uptake in a lesion
+  std::mt19937 generator(labelSize);
+  std::gamma_distribution<float> values(2.0f, 3.0f);
+  itk::ImageRegionIteratorWithIndex<ImageType> it(image, region);
+  for(it.GoToBegin(); !it.IsAtEnd(); ++it)
+  {
+    it.Set(values(generator));
+    const ImageType::IndexType index = it.GetIndex();
+    bool inside = true;
+    for(unsigned int i=0; i<Dimension; ++i)
+    {
+      inside = inside && index[i]>=2 && index[i]<static_cast<itk::IndexValueType>(2+labelSize);
+    }
+    if(inside)
+    {
+      label->SetPixel(index, 1);
+    }
+  }
+}
+
+QIFilterType::Pointer CalculateQuartiles( const ImageType* image, const LabelImageType* label,
+                                          bool approximate, double errorBound )
+{
+  auto qiCompute = QIFilterType::New();
+  qiCompute->SetInputImage(image);
+  qiCompute->SetInputLabelImage(label);
+  qiCompute->SetCurrentLabel(1);
+  qiCompute->SetUseStreamingMoments(approximate);
+  qiCompute->SetUseApproximateQuartiles(approximate);
+  qiCompute->SetQuartileErrorBound(errorBound);
+  qiCompute->CalculateQuartiles();
+  return qiCompute;
+}
+
+int CompareQuartiles( unsigned int labelSize, double errorBound )
+{
+  ImageType::Pointer image;
+  LabelImageType::Pointer label;
+  MakeImages(labelSize, image, label);
+  auto exact = CalculateQuartiles(image, label, false, 0.0);
+  auto approximate = CalculateQuartiles(image, label, true, errorBound);
+
+  int failures = 0;
+  const double bound = approximate->GetAchievedQuartileErrorBound();
+  std::cout << "label size " << labelSize << ", requested bound " << errorBound
+            << ": achieved bound " << bound << std::endl;
+  if(exact->GetAchievedQuartileErrorBound()!=0.0)
+  {
+    std::cerr << "Exact quartiles report the bound " << exact->GetAchievedQuartileErrorBound() << std::endl;
+    ++failures;
+  }
+  if(std::isnan(bound) || bound<0.0 || (errorBound>0.0 && bound>errorBound))
+  {
+    std::cerr << "Achieved bound " << bound << " exceeds the requested " << errorBound << std::endl;
+    ++failures;
+  }
+  const double exactValues[3] = { exact->GetFirstQuartileValue(), exact->GetMedianValue(), exact->GetThirdQuartileValue() };
+  const double approximateValues[3] = { approximate->GetFirstQuartileValue(), approximate->GetMedianValue(),
+                                        approximate->GetThirdQuartileValue() };
+  const char* names[3] = { "First quartile", "Median", "Third quartile" };
+  for(int i=0; i<3; ++i)
+  {
+    // allow for the rounding of the bin centers
+    if(!(std::abs(approximateValues[i]-exactValues[i]) <= bound*(1.0+1e-9) + 1e-12))
+    {
+      std::cerr << names[i] << " " << approximateValues[i] << " differs from the exact "
+                << exactValues[i] << " by more than " << bound << std::endl;
+      ++failures;
+    }
+  }
+  return failures;
+}
+
+} // end namespace
+
+int main( int, char* [] )
+{
+  int failures = 0;
+  for(unsigned int labelSize : {7u, 8u, 13u})
+  {
+    for(double errorBound : {0.0, 0.001, 0.05, 0.5})
+    {
+      failures += CompareQuartiles(labelSize, errorBound);
+    }
+  }
+  if(failures>0)
+  {
+    std::cerr << failures << " quartile comparisons failed" << std::endl;
+    return EXIT_FAILURE;
+  }
+  return EXIT_SUCCESS;
+}
@@ -0,0 +1,367 @@
+#ifndef _itkMemoryMappedImageFileReader_cxx
+#define _itkMemoryMappedImageFileReader_cxx
+
+#include "itkMemoryMappedImageFileReader.h"
+#include "itkImageIOFactory.h"
+#include "itkByteSwapper.h"
+#include "itksys/SystemTools.hxx"
+
+#include <cstdlib>
+#include <fstream>
+
+#ifdef _WIN32
+#ifndef NOMINMAX
+#define NOMINMAX
+#endif
+#ifndef WIN32_LEAN_AND_MEAN
+#define WIN32_LEAN_AND_MEAN
+#endif
+#include <windows.h>
+#else
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <unistd.h>
+#endif
+
+
+namespace itk
+{
+
+//----------------------------------------------------------------------------
+template <class TImage>
+MemoryMappedImageFileReader<TImage>
+::~MemoryMappedImageFileReader()
+{
+  this->Unmap();
+}
+
+//----------------------------------------------------------------------------
+/*
+Map
+Maps the voxels of the file and creates the output image on them. The
+geometry is taken from the ImageIO that ImageFileReader would use, so the
+image is the same as the one read normally.
+
+*/
+template <class TImage>
+bool
+MemoryMappedImageFileReader<TImage>
+::Map()
+{
+  this->Unmap();
+
+  auto imageIO = ImageIOFactory::CreateImageIO(m_FileName.c_str(), IOFileModeEnum::ReadMode);
+  if(!imageIO)
+  {
+    return false;
+  }
+  imageIO->SetFileName(m_FileName);
+  imageIO->ReadImageInformation();
+  if( imageIO->GetNumberOfDimensions() != ImageDimension || imageIO->GetNumberOfComponents() != 1 ||
+      imageIO->GetComponentType() != ImageIOBase::MapPixelType<PixelType>::CType )
+  {
+    return false;
+  }
+
+  std::string dataFileName;
+  std::size_t dataOffset = 0;
+  bool bigEndian = false;
+  if(!this->FindDataFile(dataFileName, dataOffset, bigEndian))
+  {
+    return false;
+  }
+  if( (sizeof(PixelType) > 1 && bigEndian != ByteSwapper<PixelType>::SystemIsBigEndian()) ||
+      dataOffset % alignof(PixelType) != 0 )
+  {
+    return false;
+  }
+
+  typename ImageType::RegionType region;
+  typename ImageType::SpacingType spacing;
+  typename ImageType::PointType origin;
+  typename ImageType::DirectionType direction;
+  for(unsigned int i=0; i<ImageDimension; ++i)
+  {
+    region.SetSize(i, imageIO->GetDimensions(i));
+    spacing[i] = imageIO->GetSpacing(i);
+    origin[i] = imageIO->GetOrigin(i);
+    std::vector<double> axis = imageIO->GetDirection(i);
+    for(unsigned int j=0; j<ImageDimension; ++j)
+    {
+      direction[j][i] = axis[j];
+    }
+  }
+  const SizeValueType numberOfPixels = region.GetNumberOfPixels();
+  const std::size_t length = dataOffset + numberOfPixels*sizeof(PixelType);
+  if(itksys::SystemTools::FileLength(dataFileName) < length)
+  {
+    return false;
+  }
+  const void* data = this->MapFile(dataFileName, length);
+  if(!data)
+  {
+    return false;
+  }
+
+  m_Output = ImageType::New();
+  m_Output->SetRegions(region);
+  m_Output->SetSpacing(spacing);
+  m_Output->SetOrigin(origin);
+  m_Output->SetDirection(direction);
+  auto buffer = reinterpret_cast<const PixelType*>(static_cast<const char*>(data) + dataOffset);
+  m_Output->GetPixelContainer()->SetImportPointer(const_cast<PixelType*>(buffer), numberOfPixels, false);
+  return true;
+}
+
+//----------------------------------------------------------------------------
+/*
+FindDataFile
+Reads the header of the file to find where the voxels are stored and in
+which byte order. Returns false for anything but one raw block of voxels.
+
+*/
+template <class TImage>
+bool
+MemoryMappedImageFileReader<TImage>
+::FindDataFile( std::string& dataFileName, std::size_t& dataOffset, bool& bigEndian ) const
+{
+  std::ifstream header(m_FileName.c_str(), std::ios::in | std::ios::binary);
+  if(!header)
+  {
+    return false;
+  }
+  auto trim = [](const std::string& text)
+  {
+    auto first = text.find_first_not_of(" \t\r");
+    auto last = text.find_last_not_of(" \t\r");
+    return first == std::string::npos ? std::string() : text.substr(first, last - first + 1);
+  };
+  auto relativeToHeader = [this](const std::string& fileName)
+  {
+    if(itksys::SystemTools::FileIsFullPath(fileName))
+    {
+      return fileName;
+    }
+    return itksys::SystemTools::GetFilenamePath(m_FileName) + "/" + fileName;
+  };
+
+  std::string line;
+  std::getline(header, line);
+  bigEndian = ByteSwapper<PixelType>::SystemIsBigEndian();
+  long skip = 0;
+  bool local = true;
+  if(line.compare(0, 4, "NRRD") == 0)
+  {
+    bool raw = false;
+    // the header ends with an empty line, or the file when the data is detached
+    while(std::getline(header, line))
+    {
+      line = trim(line);
+      if(line.empty())
+      {
+        break;
+      }
+      if(line[0] == '#')
+      {
+        continue;
+      }
+      auto separator = line.find(':');
+      if(separator == std::string::npos || line.compare(separator, 2, ":=") == 0)
+      {
+        continue;
+      }
+      std::string key = trim(line.substr(0, separator));
+      std::string value = trim(line.substr(separator + 1));
+      if(key == "encoding")
+      {
+        raw = value == "raw";
+      }
+      else if(key == "endian")
+      {
+        bigEndian = value == "big";
+      }
+      else if(key == "byte skip" || key == "byteskip")
+      {
+        skip = std::atol(value.c_str());
+      }
+      else if(key == "line skip" || key == "lineskip")
+      {
+        if(std::atol(value.c_str()) != 0) return false;
+      }
+      else if(key == "data file" || key == "datafile")
+      {
+        // lists and numbered file patterns are split data
+        if(value.find(' ') != std::string::npos) return false;
+        dataFileName = relativeToHeader(value);
+        local = false;
+      }
+    }
+    if(!raw || skip < 0)
+    {
+      return false;
+    }
+  }
+  else
+  {
+    std::string extension = itksys::SystemTools::LowerCase(itksys::SystemTools::GetFilenameLastExtension(m_FileName));
+    if(extension != ".mha" && extension != ".mhd")
+    {
+      return false;
+    }
+    // the header ends with the ElementDataFile line; text data (BinaryData
+    // missing or False) cannot be mapped
+    bool binary = false;
+    bool dataFileFound = false;
+    do
+    {
+      auto separator = line.find('=');
+      if(separator == std::string::npos)
+      {
+        continue;
+      }
+      std::string key = trim(line.substr(0, separator));
+      std::string value = trim(line.substr(separator + 1));
+      if(key == "BinaryData")
+      {
+        binary = value == "True";
+      }
+      else if(key == "CompressedData")
+      {
+        if(value == "True") return false;
+      }
+      else if(key == "BinaryDataByteOrderMSB" || key == "ElementByteOrderMSB")
+      {
+        bigEndian = value == "True";
+      }
+      else if(key == "HeaderSize")
+      {
+        skip = std::atol(value.c_str());
+      }
+      else if(key == "ElementDataFile")
+      {
+        if(value != "LOCAL")
+        {
+          // lists and numbered file patterns are split data
+          if(value.find(' ') != std::string::npos || value.find('%') != std::string::npos) return false;
+          dataFileName = relativeToHeader(value);
+          local = false;
+        }
+        dataFileFound = true;
+        break;
+      }
+    } while(std::getline(header, line));
+    if(!dataFileFound || !binary || skip < 0)
+    {
+      return false;
+    }
+  }
+
+  if(local)
+  {
+    if(!header)
+    {
+      return false;
+    }
+    dataFileName = m_FileName;
+    dataOffset = static_cast<std::size_t>(header.tellg()) + skip;
+  }
+  else
+  {
+    dataOffset = skip;
+  }
+  return true;
+}
+
+//----------------------------------------------------------------------------
+/*
+MapFile
+Maps the first bytes of a file read-only. Returns null on failure.
+
+*/
+template <class TImage>
+const void*
+MemoryMappedImageFileReader<TImage>
+::MapFile( const std::string& fileName, std::size_t length )
+{
+#ifdef _WIN32
+  HANDLE file = CreateFileA(fileName.c_str(), GENERIC_READ, FILE_SHARE_READ, nullptr, OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL, nullptr);
+  if(file == INVALID_HANDLE_VALUE)
+  {
+    return nullptr;
+  }
+  HANDLE mapping = CreateFileMappingA(file, nullptr, PAGE_READONLY, 0, 0, nullptr);
+  if(!mapping)
+  {
+    CloseHandle(file);
+    return nullptr;
+  }
+  const void* data = MapViewOfFile(mapping, FILE_MAP_READ, 0, 0, length);
+  if(!data)
+  {
+    CloseHandle(mapping);
+    CloseHandle(file);
+    return nullptr;
+  }
+  m_FileHandle = file;
+  m_MappingHandle = mapping;
+#else
+  int file = open(fileName.c_str(), O_RDONLY);
+  if(file < 0)
+  {
+    return nullptr;
+  }
+  void* data = mmap(nullptr, length, PROT_READ, MAP_SHARED, file, 0);
+  close(file);
+  if(data == MAP_FAILED)
+  {
+    return nullptr;
+  }
+#endif
+  m_MappedData = data;
+  m_MappedLength = length;
+  return data;
+}
+
+//----------------------------------------------------------------------------
+/*
+Unmap
+Releases the output image and the mapping.
+
+*/
+template <class TImage>
+void
+MemoryMappedImageFileReader<TImage>
+::Unmap()
+{
+  m_Output = nullptr;
+  if(!m_MappedData)
+  {
+    return;
+  }
+#ifdef _WIN32
+  UnmapViewOfFile(m_MappedData);
+  CloseHandle(m_MappingHandle);
+  CloseHandle(m_FileHandle);
+  m_MappingHandle = nullptr;
+  m_FileHandle = nullptr;
+#else
+  munmap(const_cast<void*>(m_MappedData), m_MappedLength);
+#endif
+  m_MappedData = nullptr;
+  m_MappedLength = 0;
+}
+
+//----------------------------------------------------------------------------
+template <class TImage>
+void
+MemoryMappedImageFileReader<TImage>
+::PrintSelf(std::ostream& os, Indent indent) const
+{
+  Superclass::PrintSelf(os,indent);
+  os << indent << "FileName: " << m_FileName << std::endl;
+  os << indent << "Mapped: " << (m_MappedData != nullptr) << std::endl;
+}
+
+} // namespace
+
+#endif
@@ -0,0 +1,90 @@
+#ifndef __itkMemoryMappedImageFileReader_h
+#define __itkMemoryMappedImageFileReader_h
+
+#include "itkObject.h"
+#include "itkObjectFactory.h"
+#include "itkImage.h"
+
+#include <string>
+#include <vector>
+
+namespace itk
+{
+
+/** \class MemoryMappedImageFileReader
+ * Maps the voxels of an uncompressed NRRD or MetaImage file into memory and
+ * uses them as the buffer of the output image, without copying. Only the
+ * pages that are accessed are read, and several processes reading the same
+ * file share the page cache.
+ *
+ * Map() returns false when the file cannot be used as it is (compressed,
+ * text or split data, another pixel type, other byte order or misaligned
+ * data); the file should then be read with ImageFileReader.
+ *
+ * The output buffer is read-only and only valid while the reader exists.
+ */
+template <class TImage>
+class ITK_EXPORT MemoryMappedImageFileReader : public Object
+{
+public:
+  /** Standard class type aliases. */
+  using Self = MemoryMappedImageFileReader;
+  using Superclass = Object;
+  using Pointer = SmartPointer<Self>;
+  using ConstPointer = SmartPointer<const Self>;
+
+  /** Useful class type aliases*/
+  using ImageType = TImage;
+  using ImagePointer = typename ImageType::Pointer;
+  using PixelType = typename ImageType::PixelType;
+
+  ITK_DISALLOW_COPY_AND_ASSIGN(MemoryMappedImageFileReader);
+
+  itkNewMacro( Self );
+
+  /** Dimension of the underlying image. */
+  static constexpr unsigned int ImageDimension = ImageType::ImageDimension;
+
+  /** Run-time type information (and related methods). */
+  itkTypeMacro(MemoryMappedImageFileReader, Object);
+
+  itkSetStringMacro(FileName);
+  itkGetStringMacro(FileName);
+
+  /** Maps the file, returns false if it has to be read normally */
+  bool Map();
+  /** Image using the mapped voxels, null if the file is not mapped */
+  ImageType* GetOutput() { return m_Output.GetPointer(); }
+
+protected:
+  MemoryMappedImageFileReader() = default;
+  ~MemoryMappedImageFileReader() override;
+  void PrintSelf(std::ostream& os, Indent indent) const override;
+
+  bool FindDataFile( std::string& dataFileName, std::size_t& dataOffset, bool& bigEndian ) const;
+  const void* MapFile( const std::string& fileName, std::size_t length );
+  void Unmap();
+
+private:
+  /** File to read */
+  std::string m_FileName;
+  /** Image using the mapped voxels */
+  ImagePointer m_Output;
+  /** Start and length of the mapping */
+  const void* m_MappedData{ nullptr };
+  std::size_t m_MappedLength{ 0 };
+#ifdef _WIN32
+  /** Handles of the file and its mapping */
+  void* m_FileHandle{ nullptr };
+  void* m_MappingHandle{ nullptr };
+#endif
+
+};
+
+} // end namespace itk
+
+#ifndef ITK_MANUAL_INSTANTIATION
+#include "itkMemoryMappedImageFileReader.cxx"
+#endif
+
+#endif
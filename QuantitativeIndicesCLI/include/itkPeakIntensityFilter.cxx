@@ -3,13 +3,42 @@
 
 #include "itkPeakIntensityFilter.h"
 #include "itkImageRegionIteratorWithIndex.h"
+#include "itkImageRegionConstIterator.h"
+#include "itkImageLinearConstIteratorWithIndex.h"
 #include "itkExtractImageFilter.h"
+#include "itkImageRegionSplitterSlowDimension.h"
+#include "itkGrayscaleDilateImageFilter.h"
+#include "itkFlatStructuringElement.h"
+#include "itkBinaryThresholdImageFilter.h"
+#include "itkBinaryErodeImageFilter.h"
+#include <algorithm>
+#include <chrono>
+#include <cmath>
+#include <cstdio>
+#include <functional>
 #include <math.h>
+#include <thread>
+#include <vector>
 
 #define PI 3.14159265359
 
+// the candidate placements are evaluated in at most this many chunks
+#define QI_PEAK_NUMBER_OF_CHUNKS 64
+
+// kernel weights closer than this (relative) are merged into one chord
+#define QI_PEAK_CHORD_TOLERANCE 1e-12
+
+// relative widening of the peak upper bounds, far above the rounding error
+// of the kernel sums and far below single precision
+#define QI_PEAK_BOUND_TOLERANCE 1e-9
+// placements evaluated in parallel between two checks of the bounds
+#define QI_PEAK_SEARCH_BATCH_SIZE 256
+
 #include "itkImageFileWriter.h"
+#include "itkImageFileReader.h"
 #include "math.h"
+#include <iomanip>
+#include <sstream>
 
 
 namespace itk
@@ -74,6 +103,23 @@ PeakIntensityFilter<TImage, TLabelImage>
   this->Modified();
 }
 
+//----------------------------------------------------------------------------
+/*
+SetLabelRegion
+Sets the bounding box of the current label. ExtractLabelRegion uses it
+instead of scanning the whole label image.
+
+*/
+template <class TImage, class TLabelImage>
+void
+PeakIntensityFilter<TImage, TLabelImage>
+::SetLabelRegion( const RegionType& region )
+{
+  m_LabelRegion = region;
+  m_LabelRegionSet = true;
+  this->Modified();
+}
+
 //----------------------------------------------------------------------------
 /*
 SetInputImage
@@ -173,9 +219,6 @@ PeakIntensityFilter<TImage, TLabelImage>
   m_CroppedLabelImage = LabelImageType::New();
   
   // determine extent of label
-  using LabelIteratorType = itk::ImageRegionConstIteratorWithIndex<LabelImageType>;
-  LabelIteratorType lit(inputLabel,inputLabel->GetLargestPossibleRegion());
-  lit.GoToBegin();
   IndexType lowerIndex;
   IndexType upperIndex;
 
@@ -185,19 +228,34 @@ PeakIntensityFilter<TImage, TLabelImage>
     upperIndex[i] = itk::NumericTraits<int>::min();
   }
   bool labelFound = false;
-  while(!lit.IsAtEnd())
+  if(m_LabelRegionSet)
   {
-    if(lit.Get() == m_CurrentLabel)
+    // extent is already known, no need to scan the label image
+    labelFound = m_LabelRegion.GetNumberOfPixels() > 0;
+    lowerIndex = m_LabelRegion.GetIndex();
+    for(unsigned int i=0; i<ImageDimension; ++i)
+    {
+      upperIndex[i] = lowerIndex[i] + m_LabelRegion.GetSize(i) - 1;
+    }
+  }
+  else{
+    using LabelIteratorType = itk::ImageRegionConstIteratorWithIndex<LabelImageType>;
+    LabelIteratorType lit(inputLabel,inputLabel->GetLargestPossibleRegion());
+    lit.GoToBegin();
+    while(!lit.IsAtEnd())
     {
-      labelFound = true;
-      auto idx = lit.GetIndex();
-      for(unsigned int i=0; i<ImageDimension; ++i)
+      if(lit.Get() == m_CurrentLabel)
       {
-        if(idx[i]<lowerIndex[i]) lowerIndex[i]=idx[i];
-        if(idx[i]>upperIndex[i]) upperIndex[i]=idx[i];
+        labelFound = true;
+        auto idx = lit.GetIndex();
+        for(unsigned int i=0; i<ImageDimension; ++i)
+        {
+          if(idx[i]<lowerIndex[i]) lowerIndex[i]=idx[i];
+          if(idx[i]>upperIndex[i]) upperIndex[i]=idx[i];
+        }
       }
+      ++lit;
     }
-    ++lit;
   }
   if(!labelFound)
   {
@@ -232,6 +290,11 @@ PeakIntensityFilter<TImage, TLabelImage>
   auto labelExtractor = LabelExtractorType::New();
   imageExtractor->SetInput(inputImage);
   labelExtractor->SetInput(inputLabel);
+  // same thread limits as this filter
+  imageExtractor->SetMultiThreader(this->GetMultiThreader());
+  labelExtractor->SetMultiThreader(this->GetMultiThreader());
+  imageExtractor->SetNumberOfWorkUnits(this->GetNumberOfWorkUnits());
+  labelExtractor->SetNumberOfWorkUnits(this->GetNumberOfWorkUnits());
   imageExtractor->SetExtractionRegion(region);
   labelExtractor->SetExtractionRegion(region);
 #if ITK_VERSION_MAJOR >= 4 // This is required.
@@ -247,6 +310,207 @@ PeakIntensityFilter<TImage, TLabelImage>
 }
 
 
+//----------------------------------------------------------------------------
+/*
+LoadPeakKernel
+Sets the peak kernel for the current spacing, sphere radius and kernel type.
+It is taken from the in-process cache, else from the cache directory (if
+set), and only built if neither has it. Newly built kernels are added to
+both caches.
+
+*/
+template <class TImage, class TLabelImage>
+void
+PeakIntensityFilter<TImage, TLabelImage>
+::LoadPeakKernel()
+{
+  const std::string key = this->GetKernelCacheKey();
+  {
+    std::lock_guard<std::mutex> lock(GetKernelCacheMutex());
+    auto cached = GetKernelCache().find(key);
+    if(cached != GetKernelCache().end())
+    {
+      m_KernelImage = cached->second.KernelImage;
+      m_KernelRadius = cached->second.KernelRadius;
+      return;
+    }
+  }
+
+  bool loaded = false;
+  const std::string fileName = m_KernelCacheDirectory + "/" + key + ".nrrd";
+  if(!m_KernelCacheDirectory.empty())
+  {
+    using KernelReaderType = itk::ImageFileReader<InternalImageType>;
+    auto reader = KernelReaderType::New();
+    reader->SetFileName(fileName);
+    try
+    {
+      reader->Update();
+      auto kernelImage = reader->GetOutput();
+      kernelImage->DisconnectPipeline();
+      if(IsValidPeakKernel(kernelImage))
+      {
+        m_KernelImage = kernelImage;
+        for(unsigned int i=0; i<ImageDimension; ++i)
+        {
+          m_KernelRadius[i] = (m_KernelImage->GetLargestPossibleRegion().GetSize(i)-1)/2;
+        }
+        loaded = true;
+      }
+      else{
+        itkWarningMacro(<< "Ignoring the invalid peak kernel in " << fileName);
+      }
+    }
+    catch(itk::ExceptionObject &)
+    {
+      // not cached yet
+    }
+  }
+
+  if(!loaded)
+  {
+    if(m_UseApproximateKernel)
+    {
+      this->ApproximatePeakKernel();
+    }
+    else{
+      this->BuildPeakKernel();
+    }
+    if(!m_KernelCacheDirectory.empty())
+    {
+      // write to a file of our own and rename it into place, so that other
+      // processes never read a partly written kernel and an interrupted
+      // write leaves no truncated kernel behind
+      std::ostringstream suffix;
+      suffix << std::hex << std::hash<std::thread::id>()(std::this_thread::get_id())
+             << "_" << std::chrono::steady_clock::now().time_since_epoch().count();
+      const std::string temporaryFileName = m_KernelCacheDirectory + "/" + key + ".tmp" + suffix.str() + ".nrrd";
+      using KernelWriterType = itk::ImageFileWriter<InternalImageType>;
+      auto writer = KernelWriterType::New();
+      writer->SetFileName(temporaryFileName);
+      writer->SetInput(m_KernelImage);
+      try
+      {
+        writer->Update();
+        if(std::rename(temporaryFileName.c_str(), fileName.c_str()) != 0)
+        {
+          // another process may have put its kernel in place first
+          std::remove(temporaryFileName.c_str());
+        }
+      }
+      catch(itk::ExceptionObject & e)
+      {
+        std::remove(temporaryFileName.c_str());
+        itkWarningMacro(<< "Could not write the peak kernel to " << fileName << ": " << e.GetDescription());
+      }
+    }
+  }
+
+  std::lock_guard<std::mutex> lock(GetKernelCacheMutex());
+  KernelCacheEntry& entry = GetKernelCache()[key];
+  entry.KernelImage = m_KernelImage;
+  entry.KernelRadius = m_KernelRadius;
+}
+
+//----------------------------------------------------------------------------
+/*
+IsValidPeakKernel
+Checks a kernel read from the cache directory against the one that would be
+built: its size along every dimension must be that of BuildPeakKernel for
+the sphere radius and voxel spacing, and all weights must be finite and
+non-negative with a positive sum.
+
+*/
+template <class TImage, class TLabelImage>
+bool
+PeakIntensityFilter<TImage, TLabelImage>
+::IsValidPeakKernel( const InternalImageType* kernelImage ) const
+{
+  auto voxelSize = this->GetInputImage()->GetSpacing();
+  const SizeType size = kernelImage->GetLargestPossibleRegion().GetSize();
+  for(unsigned int i=0; i<ImageDimension; ++i)
+  {
+    const SizeValueType expectedSize = ceil((m_SphereRadius[i]/voxelSize[i])-0.5)*2+1;
+    if(size[i] != expectedSize)
+    {
+      return false;
+    }
+  }
+  double sum = 0.0;
+  itk::ImageRegionConstIterator<InternalImageType> kit(kernelImage, kernelImage->GetLargestPossibleRegion());
+  for(kit.GoToBegin(); !kit.IsAtEnd(); ++kit)
+  {
+    const double weight = kit.Get();
+    if(!std::isfinite(weight) || weight < 0.0)
+    {
+      return false;
+    }
+    sum += weight;
+  }
+  return sum > 0.0;
+}
+
+//----------------------------------------------------------------------------
+/*
+GetKernelCacheKey
+Returns the name the kernel is cached under. It identifies the kernel type,
+the sphere radius and the voxel spacing; doubles are written in full
+precision so different grids never share a kernel.
+
+*/
+template <class TImage, class TLabelImage>
+std::string
+PeakIntensityFilter<TImage, TLabelImage>
+::GetKernelCacheKey() const
+{
+  auto voxelSize = this->GetInputImage()->GetSpacing();
+  std::ostringstream key;
+  key << std::setprecision(17) << "PeakKernel_";
+  if(m_UseApproximateKernel)
+  {
+    key << "approx" << m_SamplingFactor;
+  }
+  else{
+    key << "exact";
+  }
+  key << "_r";
+  for(unsigned int i=0; i<ImageDimension; ++i)
+  {
+    key << (i>0 ? "x" : "") << m_SphereRadius[i];
+  }
+  key << "_s";
+  for(unsigned int i=0; i<ImageDimension; ++i)
+  {
+    key << (i>0 ? "x" : "") << voxelSize[i];
+  }
+  return key.str();
+}
+
+//----------------------------------------------------------------------------
+/*
+GetKernelCache
+Returns the in-process kernel cache shared by all instances.
+
+*/
+template <class TImage, class TLabelImage>
+typename PeakIntensityFilter<TImage, TLabelImage>::KernelCacheType&
+PeakIntensityFilter<TImage, TLabelImage>
+::GetKernelCache()
+{
+  static KernelCacheType cache;
+  return cache;
+}
+
+//----------------------------------------------------------------------------
+template <class TImage, class TLabelImage>
+std::mutex&
+PeakIntensityFilter<TImage, TLabelImage>
+::GetKernelCacheMutex()
+{
+  static std::mutex mutex;
+  return mutex;
+}
+
 //----------------------------------------------------------------------------
 /*
 BuildPeakKernel
@@ -620,13 +884,7 @@ PeakIntensityFilter<TImage, TLabelImage>
 ::CalculatePeak()
 {
 
-  if(m_UseApproximateKernel)
-  {
-    this->ApproximatePeakKernel();
-  }
-  else{
-    this->BuildPeakKernel();
-  }
+  this->LoadPeakKernel();
   this->ExtractLabelRegion();
   
   if(!m_CroppedInputImage || !m_CroppedLabelImage)
@@ -640,64 +898,67 @@ PeakIntensityFilter<TImage, TLabelImage>
   auto maskOperator = LabelNeighborhoodOperatorImageFunctionType::New();
   maskOperator->SetInputImage(this->GetInputLabelImage());
   this->MakeKernelOperators(peakOperator,maskOperator);
+  if(m_UseChordDecomposition)
+  {
+    this->MakeKernelChords();
+    this->BuildRowSums();
+  }
+  if(m_UseInteriorOnly)
+  {
+    this->MakeInteriorMask();
+  }
   
 //std::cout << "  CalculatePeak()\n";
   
-  // convolve the kernel and evaluate at valid indices
-  using IteratorType = itk::ImageRegionIterator<ImageType>;
-  IteratorType it(m_CroppedInputImage,m_CroppedInputImage->GetRequestedRegion());
-//std::cout << "Mask Count: " << m_MaskCount << std::endl;
-  using LabelIteratorType = itk::ImageRegionIterator<LabelImageType>;
-  LabelIteratorType lit(m_CroppedLabelImage,m_CroppedLabelImage->GetRequestedRegion());
-  it.GoToBegin(); lit.GoToBegin(); 
-  double peak = itk::NumericTraits<double>::min();
-  double max_center_val = itk::NumericTraits<double>::min();
-  bool validPlacementFound = false;
-  IndexType peakIndex;
+  // find the valid kernel placements. The cropped region is split into chunks
+  // along its slowest dimension, which are searched in parallel; the chunks
+  // keep their placements in scan order.
+  const RegionType croppedRegion = m_CroppedInputImage->GetRequestedRegion();
+  auto splitter = ImageRegionSplitterSlowDimension::New();
+  const unsigned int numberOfChunks = splitter->GetNumberOfSplits(croppedRegion, QI_PEAK_NUMBER_OF_CHUNKS);
+  std::vector<PeakPlacementListType> placements(numberOfChunks);
   auto spacing = this->GetInputImage()->GetSpacing();
   auto imageSize = this->GetInputImage()->GetLargestPossibleRegion().GetSize();
-  while(!it.IsAtEnd())
+  this->GetMultiThreader()->ParallelizeArray(0, numberOfChunks, [&](SizeValueType chunk)
   {
-    if(lit.Get() == m_CurrentLabel)
+    RegionType chunkRegion = croppedRegion;
+    splitter->GetSplit(chunk, numberOfChunks, chunkRegion);
+    using IteratorType = itk::ImageRegionConstIterator<ImageType>;
+    IteratorType it(m_CroppedInputImage,chunkRegion);
+    using LabelIteratorType = itk::ImageRegionConstIterator<LabelImageType>;
+    LabelIteratorType lit(m_CroppedLabelImage,chunkRegion);
+    for(it.GoToBegin(), lit.GoToBegin(); !it.IsAtEnd(); ++it, ++lit)
     {
+      if(lit.Get() != m_CurrentLabel)
+      {
+        continue;
+      }
       IndexType currentIndex = lit.GetIndex();
       double xPosition = (currentIndex[0] + 0.5)*spacing[0];
       double yPosition = (currentIndex[1] + 0.5)*spacing[1];
       double zPosition = (currentIndex[2] + 0.5)*spacing[2];
       if ( !m_UseInteriorOnly ||
-	( xPosition - m_SphereRadius[0] >= 0 && xPosition + m_SphereRadius[0] < imageSize[0]*spacing[0] &&
-	  yPosition - m_SphereRadius[1] >= 0 && yPosition + m_SphereRadius[1] < imageSize[1]*spacing[1] &&
-	  zPosition - m_SphereRadius[2] >= 0 && zPosition + m_SphereRadius[2] < imageSize[2]*spacing[2] ) )
+        ( xPosition - m_SphereRadius[0] >= 0 && xPosition + m_SphereRadius[0] < imageSize[0]*spacing[0] &&
+          yPosition - m_SphereRadius[1] >= 0 && yPosition + m_SphereRadius[1] < imageSize[1]*spacing[1] &&
+          zPosition - m_SphereRadius[2] >= 0 && zPosition + m_SphereRadius[2] < imageSize[2]*spacing[2] ) )
       {
-	int labelSum = (maskOperator->EvaluateAtIndex(currentIndex))/m_CurrentLabel;
-	if( !m_UseInteriorOnly )
-        {
-          labelSum = m_MaskCount;
-        }
-        if( labelSum == m_MaskCount ) // valid kernel placement
+        if( !m_UseInteriorOnly || m_InteriorMask->GetPixel(currentIndex) ) // valid kernel placement
         {
-          validPlacementFound = true;
-          double center_val = it.Get();
-          double val = peakOperator->EvaluateAtIndex(currentIndex);
-          if( (float)val>(float)peak )
-          {
-            peak = val;
-            max_center_val = center_val;
-            peakIndex = currentIndex;
-          }
-          if((float)val==(float)peak)
-          {
-            if(center_val > max_center_val)
-            {
-              max_center_val = center_val;
-              peakIndex = currentIndex;
-            }
-          }
+          placements[chunk].push_back({currentIndex, (double) it.Get()});
         }
       }
     }
-    ++it; ++lit;
-  }
+  }, nullptr);
+
+  // convolve the kernel and evaluate at the valid placements
+  PeakCandidate best = m_UsePrunedSearch ? this->SearchPeakPruned(placements, peakOperator)
+                                         : this->SearchPeakExhaustive(placements, peakOperator);
+  bool validPlacementFound = best.Found;
+  double peak = best.Peak;
+  IndexType peakIndex = best.Index;
+  m_RowSums.clear();
+  m_RowSums.shrink_to_fit();
+  m_InteriorMask = nullptr;
   
   if(validPlacementFound)
   {
@@ -722,6 +983,189 @@ PeakIntensityFilter<TImage, TLabelImage>
 }
 
 
+//----------------------------------------------------------------------------
+/*
+UpdatePeakCandidate
+Considers a placement for the peak. The first placement is always taken;
+after that a higher value (compared in single precision) wins, among equal
+values the highest center value wins and the first placement is kept on a
+tie of both.
+
+*/
+template <class TImage, class TLabelImage>
+void
+PeakIntensityFilter<TImage, TLabelImage>
+::UpdatePeakCandidate( PeakCandidate& best, double value, double centerValue, const IndexType& index )
+{
+  if( !best.Found || (float)value>(float)best.Peak )
+  {
+    best.Found = true;
+    best.Peak = value;
+    best.CenterValue = centerValue;
+    best.Index = index;
+  }
+  if((float)value==(float)best.Peak)
+  {
+    if(centerValue > best.CenterValue)
+    {
+      best.CenterValue = centerValue;
+      best.Index = index;
+    }
+  }
+}
+
+//----------------------------------------------------------------------------
+/*
+EvaluatePeakKernel
+Returns the kernel-weighted mean at a placement.
+
+*/
+template <class TImage, class TLabelImage>
+double
+PeakIntensityFilter<TImage, TLabelImage>
+::EvaluatePeakKernel( const NeighborhoodOperatorImageFunctionType* peakOperator, const IndexType& index ) const
+{
+  if(m_UseChordDecomposition)
+  {
+    return this->EvaluateChords(index);
+  }
+  return peakOperator->EvaluateAtIndex(index);
+}
+
+//----------------------------------------------------------------------------
+/*
+SearchPeakExhaustive
+Evaluates the kernel at every valid placement. Every chunk finds its best
+placement in parallel and the chunk results are merged in chunk order with
+the same rule, so the result is that of a serial sweep.
+
+*/
+template <class TImage, class TLabelImage>
+typename PeakIntensityFilter<TImage, TLabelImage>::PeakCandidate
+PeakIntensityFilter<TImage, TLabelImage>
+::SearchPeakExhaustive( const std::vector<PeakPlacementListType>& placements,
+                        const NeighborhoodOperatorImageFunctionType* peakOperator )
+{
+  std::vector<PeakCandidate> chunkCandidates(placements.size());
+  this->GetMultiThreader()->ParallelizeArray(0, placements.size(), [&](SizeValueType chunk)
+  {
+    for(const auto& placement : placements[chunk])
+    {
+      UpdatePeakCandidate(chunkCandidates[chunk], this->EvaluatePeakKernel(peakOperator, placement.Index),
+                          placement.CenterValue, placement.Index);
+    }
+  }, nullptr);
+
+  PeakCandidate best;
+  for(const auto& candidate : chunkCandidates)
+  {
+    if(candidate.Found)
+    {
+      UpdatePeakCandidate(best, candidate.Peak, candidate.CenterValue, candidate.Index);
+    }
+  }
+  return best;
+}
+
+//----------------------------------------------------------------------------
+/*
+SearchPeakPruned
+Branch-and-bound version of SearchPeakExhaustive. The kernel weights are
+non-negative and sum to one, so the value at a placement is at most the
+maximum of the image over the bounding box of the kernel, which a box
+dilation of the cropped image gives for all placements at once. The
+placements are evaluated in batches by decreasing bound until no bound can
+reach the best value so far. All placements that can have the peak value
+are evaluated, and they are considered in scan order, so the peak value and
+location are those of the exhaustive search.
+
+*/
+template <class TImage, class TLabelImage>
+typename PeakIntensityFilter<TImage, TLabelImage>::PeakCandidate
+PeakIntensityFilter<TImage, TLabelImage>
+::SearchPeakPruned( const std::vector<PeakPlacementListType>& placements,
+                    const NeighborhoodOperatorImageFunctionType* peakOperator )
+{
+  std::vector<const PeakPlacement*> scanOrder;
+  for(const auto& chunkPlacements : placements)
+  {
+    for(const auto& placement : chunkPlacements)
+    {
+      scanOrder.push_back(&placement);
+    }
+  }
+  const SizeValueType numberOfPlacements = scanOrder.size();
+  PeakCandidate best;
+  if(numberOfPlacements==0)
+  {
+    return best;
+  }
+
+  // the kernel reaches past the cropped region, so the maximum is taken over
+  // the input image padded by the kernel radius
+  RegionType boundRegion = m_CroppedInputImage->GetRequestedRegion();
+  boundRegion.PadByRadius(m_KernelRadius);
+  boundRegion.Crop(this->GetInputImage()->GetLargestPossibleRegion());
+  using ImageExtractorType = itk::ExtractImageFilter<ImageType,ImageType>;
+  auto boundExtractor = ImageExtractorType::New();
+  boundExtractor->SetInput(this->GetInputImage());
+  boundExtractor->SetExtractionRegion(boundRegion);
+#if ITK_VERSION_MAJOR >= 4 // This is required.
+  boundExtractor->SetDirectionCollapseToIdentity();
+#endif
+  using StructuringElementType = itk::FlatStructuringElement<ImageDimension>;
+  using DilaterType = itk::GrayscaleDilateImageFilter<ImageType, ImageType, StructuringElementType>;
+  auto dilater = DilaterType::New();
+  dilater->SetInput(boundExtractor->GetOutput());
+  dilater->SetKernel(StructuringElementType::Box(m_KernelRadius));
+  dilater->Update();
+  auto boundImage = dilater->GetOutput();
+
+  // the bounds are widened slightly to cover the rounding of the weighted sum
+  std::vector<double> bounds(numberOfPlacements);
+  for(SizeValueType i=0; i<numberOfPlacements; ++i)
+  {
+    double bound = boundImage->GetPixel(scanOrder[i]->Index);
+    bounds[i] = bound + QI_PEAK_BOUND_TOLERANCE*std::abs(bound);
+  }
+  std::vector<SizeValueType> boundOrder(numberOfPlacements);
+  for(SizeValueType i=0; i<numberOfPlacements; ++i)
+  {
+    boundOrder[i] = i;
+  }
+  std::stable_sort(boundOrder.begin(), boundOrder.end(),
+                   [&bounds](SizeValueType a, SizeValueType b){ return bounds[a] > bounds[b]; });
+
+  std::vector<double> values(numberOfPlacements, 0.0);
+  std::vector<unsigned char> evaluated(numberOfPlacements, 0);
+  float bestValue = (float)best.Peak;
+  SizeValueType next = 0;
+  while(next<numberOfPlacements && (next==0 || (float)bounds[boundOrder[next]]>=bestValue))
+  {
+    const SizeValueType batchEnd = std::min<SizeValueType>(numberOfPlacements, next+QI_PEAK_SEARCH_BATCH_SIZE);
+    this->GetMultiThreader()->ParallelizeArray(next, batchEnd, [&](SizeValueType k)
+    {
+      const SizeValueType i = boundOrder[k];
+      values[i] = this->EvaluatePeakKernel(peakOperator, scanOrder[i]->Index);
+      evaluated[i] = 1;
+    }, nullptr);
+    for(SizeValueType k=next; k<batchEnd; ++k)
+    {
+      bestValue = std::max(bestValue, (float)values[boundOrder[k]]);
+    }
+    next = batchEnd;
+  }
+
+  for(SizeValueType i=0; i<numberOfPlacements; ++i)
+  {
+    if(evaluated[i])
+    {
+      UpdatePeakCandidate(best, values[i], scanOrder[i]->CenterValue, scanOrder[i]->Index);
+    }
+  }
+  return best;
+}
+
 //----------------------------------------------------------------------------
 /*
 MakeKernelOperators
@@ -739,7 +1183,7 @@ PeakIntensityFilter<TImage, TLabelImage>
 //std::cout << "  MakeKernelOperators()" << std::endl;
 
   // create the mask kernel
-  using LabelNeighborhoodType = itk::Neighborhood<LabelPixelType, ImageDimension>;
+  using LabelNeighborhoodType = typename LabelNeighborhoodOperatorImageFunctionType::NeighborhoodType;
   LabelNeighborhoodType labelNeighborhood;
   labelNeighborhood.SetRadius(m_KernelRadius);
   
@@ -790,6 +1234,214 @@ PeakIntensityFilter<TImage, TLabelImage>
 }
 
 
+//----------------------------------------------------------------------------
+/*
+MakeInteriorMask
+Marks the voxels of the cropped region where every non-zero coefficient of
+the kernel falls on the current label, by eroding the label with the kernel
+footprint. The erosion runs on the label image padded by the kernel radius
+so that the footprint never reaches past the data it is given; outside the
+image the label is taken as foreground, as the edge voxels are repeated
+when the kernel is evaluated there.
+
+*/
+template <class TImage, class TLabelImage>
+void
+PeakIntensityFilter<TImage, TLabelImage>
+::MakeInteriorMask()
+{
+  RegionType maskRegion = m_CroppedLabelImage->GetRequestedRegion();
+  maskRegion.PadByRadius(m_KernelRadius);
+  maskRegion.Crop(this->GetInputLabelImage()->GetLargestPossibleRegion());
+  using LabelExtractorType = itk::ExtractImageFilter<LabelImageType,LabelImageType>;
+  auto labelExtractor = LabelExtractorType::New();
+  labelExtractor->SetInput(this->GetInputLabelImage());
+  labelExtractor->SetExtractionRegion(maskRegion);
+#if ITK_VERSION_MAJOR >= 4 // This is required.
+  labelExtractor->SetDirectionCollapseToIdentity();
+#endif
+
+  using ThresholdType = itk::BinaryThresholdImageFilter<LabelImageType, MaskImageType>;
+  auto threshold = ThresholdType::New();
+  threshold->SetInput(labelExtractor->GetOutput());
+  threshold->SetLowerThreshold(m_CurrentLabel);
+  threshold->SetUpperThreshold(m_CurrentLabel);
+  threshold->SetInsideValue(1);
+  threshold->SetOutsideValue(0);
+
+  // the footprint holds the non-zero coefficients of the kernel
+  using StructuringElementType = itk::FlatStructuringElement<ImageDimension>;
+  StructuringElementType footprint;
+  footprint.SetRadius(m_KernelRadius);
+  using KernelIteratorType = itk::ImageRegionConstIterator<InternalImageType>;
+  KernelIteratorType kit(this->m_KernelImage,this->m_KernelImage->GetLargestPossibleRegion());
+  auto fit = footprint.Begin();
+  for(kit.GoToBegin(); !kit.IsAtEnd(); ++kit, ++fit)
+  {
+    *fit = kit.Get() > 0.0;
+  }
+
+  using ErodeType = itk::BinaryErodeImageFilter<MaskImageType, MaskImageType, StructuringElementType>;
+  auto erode = ErodeType::New();
+  erode->SetInput(threshold->GetOutput());
+  erode->SetKernel(footprint);
+  erode->SetForegroundValue(1);
+  erode->SetBackgroundValue(0);
+  erode->SetBoundaryToForeground(true);
+  erode->Update();
+  m_InteriorMask = erode->GetOutput();
+  m_InteriorMask->DisconnectPipeline();
+}
+
+//----------------------------------------------------------------------------
+/*
+MakeKernelChords
+Decomposes the normalized peak kernel into chords: along every row of the
+kernel the run of weights equal to the center weight (the voxels entirely
+inside the sphere) becomes one chord, every other non-zero weight a chord
+of length one. The weights are normalized exactly as in MakeKernelOperators.
+
+*/
+template <class TImage, class TLabelImage>
+void
+PeakIntensityFilter<TImage, TLabelImage>
+::MakeKernelChords()
+{
+  const auto kernelRegion = this->m_KernelImage->GetLargestPossibleRegion();
+  const OffsetValueType rowLength = kernelRegion.GetSize(0);
+  const OffsetValueType center = m_KernelRadius[0];
+
+  double kernelSum = 0.0;
+  using KernelIteratorType = itk::ImageRegionConstIterator<InternalImageType>;
+  KernelIteratorType kit(this->m_KernelImage, kernelRegion);
+  for(kit.GoToBegin(); !kit.IsAtEnd(); ++kit)
+  {
+    kernelSum += kit.Get();
+  }
+
+  m_KernelChords.clear();
+  using KernelLineIteratorType = itk::ImageLinearConstIteratorWithIndex<InternalImageType>;
+  KernelLineIteratorType lit(this->m_KernelImage, kernelRegion);
+  lit.SetDirection(0);
+  std::vector<double> weights(rowLength);
+  for(lit.GoToBegin(); !lit.IsAtEnd(); lit.NextLine())
+  {
+    KernelChord chord;
+    IndexType rowIndex = lit.GetIndex();
+    for(unsigned int i=1; i<ImageDimension; ++i)
+    {
+      chord.Start[i] = rowIndex[i] - m_KernelRadius[i];
+    }
+    for(OffsetValueType k=0; !lit.IsAtEndOfLine(); ++lit, ++k)
+    {
+      weights[k] = lit.Get()/kernelSum;
+    }
+
+    // the center weight is the largest of the row
+    const double centerWeight = weights[center];
+    OffsetValueType first = center+1;
+    OffsetValueType last = center;
+    if(centerWeight > 0.0)
+    {
+      const double tolerance = QI_PEAK_CHORD_TOLERANCE*centerWeight;
+      first = center;
+      last = center;
+      while(first>0 && std::abs(weights[first-1]-centerWeight)<=tolerance) --first;
+      while(last+1<rowLength && std::abs(weights[last+1]-centerWeight)<=tolerance) ++last;
+      chord.Start[0] = first - center;
+      chord.Length = last - first + 1;
+      chord.Weight = centerWeight;
+      m_KernelChords.push_back(chord);
+    }
+    for(OffsetValueType k=0; k<rowLength; ++k)
+    {
+      if((k<first || k>last) && weights[k]!=0.0)
+      {
+        chord.Start[0] = k - center;
+        chord.Length = 1;
+        chord.Weight = weights[k];
+        m_KernelChords.push_back(chord);
+      }
+    }
+  }
+}
+
+//----------------------------------------------------------------------------
+/*
+BuildRowSums
+Computes the prefix sums of every row of the cropped image. The rows are
+extended by the kernel radius on both ends by repeating the edge voxels,
+like the boundary condition of the neighborhood operator. The cropped image
+covers the kernel around every label voxel, except where it was clipped by
+the image, so its edges are those of the image.
+
+*/
+template <class TImage, class TLabelImage>
+void
+PeakIntensityFilter<TImage, TLabelImage>
+::BuildRowSums()
+{
+  const RegionType& region = m_CroppedInputImage->GetBufferedRegion();
+  const OffsetValueType rowSize = region.GetSize(0);
+  const OffsetValueType radius = m_KernelRadius[0];
+  const SizeValueType numberOfRows = region.GetNumberOfPixels()/rowSize;
+  m_RowSumsLength = rowSize + 2*radius + 1;
+  m_RowSums.assign(numberOfRows*m_RowSumsLength, 0.0);
+
+  const PixelType* buffer = m_CroppedInputImage->GetBufferPointer();
+  this->GetMultiThreader()->ParallelizeArray(0, numberOfRows, [&](SizeValueType row)
+  {
+    const PixelType* rowBuffer = buffer + row*rowSize;
+    double* rowSums = &m_RowSums[row*m_RowSumsLength];
+    double sum = 0.0;
+    for(SizeValueType j=0; j+1<m_RowSumsLength; ++j)
+    {
+      OffsetValueType x = (OffsetValueType)j - radius;
+      if(x<0) x = 0;
+      if(x>=rowSize) x = rowSize-1;
+      sum += rowBuffer[x];
+      rowSums[j+1] = sum;
+    }
+  }, nullptr);
+}
+
+//----------------------------------------------------------------------------
+/*
+EvaluateChords
+Returns the kernel-weighted mean at the given index of the cropped image,
+adding up one difference of row sums per chord.
+
+*/
+template <class TImage, class TLabelImage>
+double
+PeakIntensityFilter<TImage, TLabelImage>
+::EvaluateChords( const IndexType& index ) const
+{
+  const RegionType& region = m_CroppedInputImage->GetBufferedRegion();
+  const IndexType& start = region.GetIndex();
+  const SizeType& size = region.GetSize();
+  const OffsetValueType radius = m_KernelRadius[0];
+
+  double value = 0.0;
+  for(const auto& chord : m_KernelChords)
+  {
+    SizeValueType row = 0;
+    SizeValueType stride = 1;
+    for(unsigned int i=1; i<ImageDimension; ++i)
+    {
+      OffsetValueType pos = index[i] + chord.Start[i] - start[i];
+      if(pos<0) pos = 0;
+      if(pos>=(OffsetValueType)size[i]) pos = size[i]-1;
+      row += pos*stride;
+      stride *= size[i];
+    }
+    const double* rowSums = &m_RowSums[row*m_RowSumsLength];
+    const OffsetValueType first = index[0] + chord.Start[0] - start[0] + radius;
+    value += chord.Weight*(rowSums[first+chord.Length] - rowSums[first]);
+  }
+  return value;
+}
+
 //----------------------------------------------------------------------------
 /*
 GetKernelVolume
@@ -3,6 +3,11 @@
 
 #include "itkNeighborhoodOperatorImageFunction.h"
 
+#include <map>
+#include <mutex>
+#include <string>
+#include <vector>
+
 namespace itk
 {
 
@@ -25,12 +30,15 @@ public:
   using SpacingType = typename ImageType::SpacingType;
   using SizeType = typename ImageType::SizeType;
   using IndexType = typename ImageType::IndexType;
+  using OffsetType = typename ImageType::OffsetType;
+  using RegionType = typename ImageType::RegionType;
 
   using LabelImageType = TLabelImage;
   using LabelImagePointer = typename LabelImageType::Pointer;
   using LabelImageConstPointer = typename LabelImageType::ConstPointer;
   using LabelPixelType = typename LabelImageType::PixelType;
   using InternalImageType = typename itk::Image<double, ImageType::ImageDimension>;
+  using MaskImageType = typename itk::Image<unsigned char, ImageType::ImageDimension>;
 
   ITK_DISALLOW_COPY_AND_ASSIGN(PeakIntensityFilter);
 
@@ -60,8 +68,28 @@ public:
   itkSetMacro(SamplingFactor, int);
   itkSetMacro(UseInteriorOnly, bool);
   itkSetMacro(UseApproximateKernel, bool);
+  /** Set to false to evaluate the kernel with NeighborhoodOperatorImageFunction
+   * instead of the chord decomposition (row sums of the cropped image). */
+  itkSetMacro(UseChordDecomposition, bool);
+  itkGetMacro(UseChordDecomposition, bool);
+  itkBooleanMacro(UseChordDecomposition);
+  /** Set to false to evaluate the kernel at every valid placement instead of
+   * skipping placements whose upper bound cannot beat the best peak so far.
+   * Both searches give the same peak value and location. */
+  itkSetMacro(UsePrunedSearch, bool);
+  itkGetMacro(UsePrunedSearch, bool);
+  itkBooleanMacro(UsePrunedSearch);
   itkGetMacro(KernelImage, typename InternalImageType::Pointer);
 
+  /** Directory to keep the peak kernels in between runs. The kernels are
+   * always cached within the process; if the directory is set they are also
+   * read from and written to it. */
+  itkSetMacro(KernelCacheDirectory, std::string);
+  itkGetMacro(KernelCacheDirectory, std::string);
+
+  /** Set the bounding box of the current label to avoid scanning the label image for it. */
+  void SetLabelRegion( const RegionType& region );
+
   /** Set the radii of the peak kernel for all dimensions. */
   void SetSphereRadius(double r);
 
@@ -90,9 +118,40 @@ protected:
   using LabelNeighborhoodOperatorImageFunctionType = itk::NeighborhoodOperatorImageFunction<LabelImageType, int>;
 
   void ApproximatePeakKernel();
+  void LoadPeakKernel();
+  bool IsValidPeakKernel( const InternalImageType* kernelImage ) const;
+  std::string GetKernelCacheKey() const;
   void MakeKernelOperators( NeighborhoodOperatorImageFunctionType* neighborhoodOperator,
                             LabelNeighborhoodOperatorImageFunctionType* labelNeighborhoodOperator );
   void ExtractLabelRegion();
+  void MakeInteriorMask();
+  void MakeKernelChords();
+  void BuildRowSums();
+  double EvaluateChords( const IndexType& index ) const;
+
+  /** Valid placement of the kernel center */
+  struct PeakPlacement
+  {
+    IndexType Index;
+    double CenterValue;
+  };
+  using PeakPlacementListType = std::vector<PeakPlacement>;
+
+  /** Best placement among those considered so far */
+  struct PeakCandidate
+  {
+    bool Found{ false };
+    double Peak{ NumericTraits<double>::NonpositiveMin() };
+    double CenterValue{ NumericTraits<double>::NonpositiveMin() };
+    IndexType Index;
+  };
+
+  static void UpdatePeakCandidate( PeakCandidate& best, double value, double centerValue, const IndexType& index );
+  double EvaluatePeakKernel( const NeighborhoodOperatorImageFunctionType* peakOperator, const IndexType& index ) const;
+  PeakCandidate SearchPeakExhaustive( const std::vector<PeakPlacementListType>& placements,
+                                      const NeighborhoodOperatorImageFunctionType* peakOperator );
+  PeakCandidate SearchPeakPruned( const std::vector<PeakPlacementListType>& placements,
+                                  const NeighborhoodOperatorImageFunctionType* peakOperator );
   void CalculateSphereRadius();
 
   double FEdge( double r, double a, double b );
@@ -118,10 +177,16 @@ private:
   SizeType m_KernelRadius;
   /** Number of sub-samples to take along each dimension for the approximate peak kernel */
   int m_SamplingFactor{ 10 };
+  /** Bounding box of the current label, if known in advance */
+  RegionType m_LabelRegion;
+  /** Set to true when the bounding box of the label was provided */
+  bool m_LabelRegionSet{ false };
   /** Cropped version of the input image */
   ImagePointer m_CroppedInputImage;
   /** Cropped version of the label image */
   LabelImagePointer m_CroppedLabelImage;
+  /** Placements where the whole kernel lies within the current label */
+  typename MaskImageType::Pointer m_InteriorMask;
   /** Set to true to ignore when any part of the kernel is placed outside the label region */
   bool m_UseInteriorOnly{ true };
   /** Set to true to use an approximation of the peak kernel (follows Siemens' method) */
@@ -129,6 +194,39 @@ private:
   /** Image containing the coefficents of the peak kernel */
   typename InternalImageType::Pointer m_KernelImage;
 
+  /** Run of equal normalized weights along the first dimension of the kernel */
+  struct KernelChord
+  {
+    /** Offset of the first voxel of the run from the kernel center */
+    OffsetType Start;
+    /** Number of voxels in the run */
+    OffsetValueType Length;
+    double Weight;
+  };
+  /** Directory of the on-disk kernel cache (empty to keep the kernels in memory only) */
+  std::string m_KernelCacheDirectory;
+
+  /** Kernel and kernel radius cached for a spacing, sphere radius and kernel type */
+  struct KernelCacheEntry
+  {
+    typename InternalImageType::Pointer KernelImage;
+    SizeType KernelRadius;
+  };
+  using KernelCacheType = std::map<std::string, KernelCacheEntry>;
+  static KernelCacheType& GetKernelCache();
+  static std::mutex& GetKernelCacheMutex();
+
+  /** Set to true to evaluate the kernel as a sum of chords */
+  bool m_UseChordDecomposition{ true };
+  /** Set to true to skip placements that cannot contain the peak */
+  bool m_UsePrunedSearch{ true };
+  /** Chords making up the normalized peak kernel */
+  std::vector<KernelChord> m_KernelChords;
+  /** Prefix sums of every row of the cropped image, extended by the kernel radius */
+  std::vector<double> m_RowSums;
+  /** Length of one row of prefix sums */
+  SizeValueType m_RowSumsLength{ 0 };
+
 };
 
 } // end namespace itk
@@ -10,15 +10,25 @@
 #include <itkConstShapedNeighborhoodIterator.h>
 #include <itkNearestNeighborInterpolateImageFunction.h>
 #include <itkRegionOfInterestImageFilter.h>
-#include "itkDilateObjectMorphologyImageFilter.h"
 #include "itkBinaryBallStructuringElement.h"
 #include "itkPeakIntensityFilter.h"
+#include "itkImageRegionSplitterSlowDimension.h"
+
+#include <algorithm>
+#include <array>
+#include <utility>
+#include <vector>
 
 #define QI_PEAK_RADIUS 6.204//2.5
 #define QI_PEAK_RADIUS_SPACING_RATE 4.0
 
 #define INITIAL_MARGIN 3
 
+#define QI_MAX_QUARTILE_HISTOGRAM_BINS 65536
+
+// passes over the images are split into at most this many chunks
+#define QI_NUMBER_OF_CHUNKS 64
+
 
 namespace itk
 {
@@ -45,6 +55,7 @@ QuantitativeIndicesComputationFilter<TImage, TLabelImage>
 {
 // Process object is not const-correct so the const_cast is required here
   this->ProcessObject::SetNthInput(0, const_cast< ImageType * >(input));
+  this->ResetCalculatedValues();
 }
 
 //----------------------------------------------------------------------------
@@ -81,6 +92,7 @@ QuantitativeIndicesComputationFilter<TImage, TLabelImage>
 {
 // Process object is not const-correct so the const_cast is required here
   this->ProcessObject::SetNthInput(1, const_cast< LabelImageType * >(input));
+  this->ResetCalculatedValues();
 }
 
 //----------------------------------------------------------------------------
@@ -104,21 +116,406 @@ QuantitativeIndicesComputationFilter<TImage, TLabelImage>
 }
 
 //----------------------------------------------------------------------------
+/*
+SetCurrentLabel
+Sets the label to calculate indices for. Results of a previous label
+are discarded.
+
+*/
+template <class TImage, class TLabelImage>
+void
+QuantitativeIndicesComputationFilter<TImage, TLabelImage>
+::SetCurrentLabel( LabelType label )
+{
+  if(label != m_CurrentLabel)
+  {
+    m_CurrentLabel = label;
+    this->ResetCalculatedValues();
+    this->Modified();
+  }
+}
+
+//----------------------------------------------------------------------------
+/*
+ResetCalculatedValues
+Discards the bounding box, the list of values and all memoized results,
+so they are determined again for new inputs or a new label.
+
+*/
+template <class TImage, class TLabelImage>
+void
+QuantitativeIndicesComputationFilter<TImage, TLabelImage>
+::ResetCalculatedValues()
+{
+  m_LabelRegionComputed = false;
+  m_MomentsAccumulated = false;
+  m_SegmentedVoxelCount = 0;
+  m_SegmentedValueSum = 0.0;
+  m_ListGenerated = false;
+  m_SegmentedValues.clear();
+  m_MomentsCalculated = false;
+  m_QuarterBinsCalculated = false;
+  m_QuartilesCalculated = false;
+  m_SAMCalculated = false;
+  m_PeakCalculated = false;
+}
+
+//----------------------------------------------------------------------------
+/*
+GenerateData
+Runs only the calculations needed for the requested features.
+
+*/
 template <class TImage, class TLabelImage>
 void
 QuantitativeIndicesComputationFilter<TImage, TLabelImage>
 ::GenerateData()
 {
 //std::cout << "GenerateData()\n";
-  this->CalculateMean();
-  this->CalculateQuartiles();
-  this->CalculateSAM();
-  this->CalculatePeak();
+  if(m_RequestedFeatures & (MomentsFeature | QuarterBinsFeature))
+  {
+    this->CalculateMean();
+  }
+  if(m_RequestedFeatures & QuartilesFeature)
+  {
+    this->CalculateQuartiles();
+  }
+  if(m_RequestedFeatures & SAMFeature)
+  {
+    this->CalculateSAM();
+  }
+  if(m_RequestedFeatures & PeakFeature)
+  {
+    this->CalculatePeak();
+  }
+}
+
+//----------------------------------------------------------------------------
+/*
+SetLabelRegion
+Sets the bounding box of the current label, skipping the scan for it.
+
+*/
+template <class TImage, class TLabelImage>
+void
+QuantitativeIndicesComputationFilter<TImage, TLabelImage>
+::SetLabelRegion( const RegionType& region )
+{
+  m_LabelRegion = region;
+  m_LabelRegionComputed = true;
+}
+
+//----------------------------------------------------------------------------
+/*
+ComputeLabelStatistics
+Routes every voxel with a positive label to the statistics of its label,
+so all labels are handled with one sweep over the images. The sweep is
+split into chunks processed in parallel, whose statistics are merged in
+chunk order. Neighbouring voxels mostly share a label, so the last
+statistics found are reused before looking the label up.
+
+*/
+template <class TImage, class TLabelImage>
+void
+QuantitativeIndicesComputationFilter<TImage, TLabelImage>
+::ComputeLabelStatistics( const ImageType* image, const LabelImageType* labelImage,
+                          bool storeValues, LabelStatisticsMapType& statistics,
+                          unsigned int numberOfThreads )
+{
+  using InputIteratorType = itk::ImageRegionConstIterator<ImageType>;
+  using LabelIteratorType = itk::ImageRegionConstIteratorWithIndex<LabelImageType>;
+
+  std::vector<RegionType> chunks;
+  SplitRegion(labelImage->GetLargestPossibleRegion(), chunks);
+  std::vector<LabelStatisticsMapType> chunkStatistics(chunks.size());
+
+  auto threader = MultiThreaderBase::New();
+  if(numberOfThreads > 0)
+  {
+    threader->SetMaximumNumberOfThreads(numberOfThreads);
+    threader->SetNumberOfWorkUnits(numberOfThreads);
+  }
+  threader->ParallelizeArray(0, chunks.size(), [&](SizeValueType chunk)
+  {
+    LabelStatisticsMapType& localStatistics = chunkStatistics[chunk];
+    LabelIteratorType laIt(labelImage, chunks[chunk]);
+    InputIteratorType inIt(image, chunks[chunk]);
+    LabelStatistics* current = nullptr;
+    LabelType currentLabel = NumericTraits<LabelType>::ZeroValue();
+    for(laIt.GoToBegin(), inIt.GoToBegin(); !laIt.IsAtEnd(); ++laIt, ++inIt)
+    {
+      const LabelType labelValue = laIt.Get();
+      if(!(labelValue > NumericTraits<LabelType>::ZeroValue()))
+      {
+        continue;
+      }
+      if(current==nullptr || labelValue!=currentLabel)
+      {
+        current = &localStatistics[labelValue];
+        currentLabel = labelValue;
+      }
+      AddLabelValue(*current, laIt.GetIndex(), (double) inIt.Get(), storeValues);
+    }
+  }, nullptr);
+
+  for(auto& localStatistics : chunkStatistics)
+  {
+    for(auto& labelStatistics : localStatistics)
+    {
+      MergeLabelStatistics(statistics[labelStatistics.first], std::move(labelStatistics.second));
+    }
+    localStatistics.clear();
+  }
+}
+
+//----------------------------------------------------------------------------
+/*
+SplitRegion
+Splits a region into chunks along its slowest dimension. The number of
+chunks depends on the region only, never on the number of threads, so
+partial results merged in chunk order do not change with it.
+
+*/
+template <class TImage, class TLabelImage>
+void
+QuantitativeIndicesComputationFilter<TImage, TLabelImage>
+::SplitRegion( const RegionType& region, std::vector<RegionType>& chunks )
+{
+  chunks.clear();
+  if(region.GetNumberOfPixels()==0)
+  {
+    return;
+  }
+  auto splitter = ImageRegionSplitterSlowDimension::New();
+  const unsigned int numberOfChunks = splitter->GetNumberOfSplits(region, QI_NUMBER_OF_CHUNKS);
+  for(unsigned int chunk=0; chunk<numberOfChunks; ++chunk)
+  {
+    RegionType chunkRegion = region;
+    splitter->GetSplit(chunk, numberOfChunks, chunkRegion);
+    chunks.push_back(chunkRegion);
+  }
+}
+
+//----------------------------------------------------------------------------
+/*
+AddLabelValue
+Adds one segmented voxel to the bounding box and moments of a label.
+
+*/
+template <class TImage, class TLabelImage>
+void
+QuantitativeIndicesComputationFilter<TImage, TLabelImage>
+::AddLabelValue( LabelStatistics& statistics, const IndexType& idx, double value, bool storeValue )
+{
+  if(statistics.Count==0)
+  {
+    statistics.LowerIndex = idx;
+    statistics.UpperIndex = idx;
+  }
+  for(unsigned int i=0; i<LabelImageType::ImageDimension; ++i)
+  {
+    if(idx[i]<statistics.LowerIndex[i]) statistics.LowerIndex[i]=idx[i];
+    if(idx[i]>statistics.UpperIndex[i]) statistics.UpperIndex[i]=idx[i];
+  }
+  ++statistics.Count;
+  statistics.Sum += value;
+  statistics.SumOfSquares += value*value;
+  // Welford update keeps the variance accurate without a second pass
+  double delta = value - statistics.RunningMean;
+  statistics.RunningMean += delta / statistics.Count;
+  statistics.RunningM2 += delta * (value - statistics.RunningMean);
+  if (value > statistics.Maximum)  {statistics.Maximum = value;}
+  if (value < statistics.Minimum)  {statistics.Minimum = value;}
+  if(storeValue)
+  {
+    statistics.Values.push_back(static_cast<PixelType>(value));
+  }
+}
+
+//----------------------------------------------------------------------------
+/*
+MergeLabelStatistics
+Adds the statistics of a later chunk to those of the earlier chunks. The
+variance terms are combined with the pairwise update of Chan et al. and
+the stored values are appended, keeping the order of a serial sweep.
+
+*/
+template <class TImage, class TLabelImage>
+void
+QuantitativeIndicesComputationFilter<TImage, TLabelImage>
+::MergeLabelStatistics( LabelStatistics& target, LabelStatistics&& source )
+{
+  if(source.Count==0)
+  {
+    return;
+  }
+  if(target.Count==0)
+  {
+    target = std::move(source);
+    return;
+  }
+  for(unsigned int i=0; i<LabelImageType::ImageDimension; ++i)
+  {
+    if(source.LowerIndex[i]<target.LowerIndex[i]) target.LowerIndex[i]=source.LowerIndex[i];
+    if(source.UpperIndex[i]>target.UpperIndex[i]) target.UpperIndex[i]=source.UpperIndex[i];
+  }
+  const double targetCount = target.Count;
+  const double sourceCount = source.Count;
+  const double count = targetCount + sourceCount;
+  const double delta = source.RunningMean - target.RunningMean;
+  target.RunningMean += delta * sourceCount / count;
+  target.RunningM2 += source.RunningM2 + delta * delta * targetCount * sourceCount / count;
+  target.Count += source.Count;
+  target.Sum += source.Sum;
+  target.SumOfSquares += source.SumOfSquares;
+  if (source.Maximum > target.Maximum)  {target.Maximum = source.Maximum;}
+  if (source.Minimum < target.Minimum)  {target.Minimum = source.Minimum;}
+  target.Values.insert(target.Values.end(), source.Values.begin(), source.Values.end());
+  source.Values.clear();
+  source.Values.shrink_to_fit();
+}
+
+//----------------------------------------------------------------------------
+/*
+SetLabelStatistics
+Takes over the bounding box, moments and stored values of the current
+label from ComputeLabelStatistics, so none of them is scanned for again.
+
+*/
+template <class TImage, class TLabelImage>
+void
+QuantitativeIndicesComputationFilter<TImage, TLabelImage>
+::SetLabelStatistics( LabelStatistics&& statistics )
+{
+  if(statistics.Count==0)
+  {
+    return;
+  }
+  SizeType size;
+  for(unsigned int i=0; i<LabelImageType::ImageDimension; ++i)
+  {
+    size[i] = statistics.UpperIndex[i]-statistics.LowerIndex[i]+1;
+  }
+  this->SetLabelRegion(RegionType(statistics.LowerIndex, size));
+
+  m_SegmentedVoxelCount = statistics.Count;
+  m_SegmentedValueSum = statistics.Sum;
+  m_MomentsAccumulated = true;
+  m_MinimumValue = statistics.Minimum;
+  m_MaximumValue = statistics.Maximum;
+  m_AverageValue = statistics.Sum / statistics.Count;
+  m_RMSValue = std::sqrt(statistics.SumOfSquares / statistics.Count);
+  m_Variance = statistics.RunningM2 / statistics.Count;
+
+  if(statistics.Values.size()==statistics.Count)
+  {
+    m_SegmentedValues = std::move(statistics.Values);
+    m_ListGenerated = true;
+  }
+}
+
+//----------------------------------------------------------------------------
+/*
+GetLabelRegion
+Returns the bounding box of the current label, scanning the label image
+the first time it is needed.
+
+*/
+template <class TImage, class TLabelImage>
+const typename QuantitativeIndicesComputationFilter<TImage, TLabelImage>
+::RegionType&
+QuantitativeIndicesComputationFilter<TImage, TLabelImage>
+::GetLabelRegion()
+{
+  if(!m_LabelRegionComputed)
+  {
+    this->ComputeLabelRegion();
+  }
+  return m_LabelRegion;
+}
+
+//----------------------------------------------------------------------------
+/*
+ComputeLabelRegion
+Determines the bounding box of the current label with a single scan of
+the label image. The region is empty if the label is not present.
+
+*/
+template <class TImage, class TLabelImage>
+void
+QuantitativeIndicesComputationFilter<TImage, TLabelImage>
+::ComputeLabelRegion()
+{
+  using LabelIteratorType = itk::ImageRegionConstIteratorWithIndex<LabelImageType>;
+
+  auto inputLabel = this->GetInputLabelImage();
+  const unsigned int dimension = LabelImageType::ImageDimension;
+
+  IndexType lowerIndex;
+  IndexType upperIndex;
+  lowerIndex.Fill(itk::NumericTraits<IndexValueType>::max());
+  upperIndex.Fill(itk::NumericTraits<IndexValueType>::NonpositiveMin());
+  bool labelFound = false;
+
+  LabelIteratorType lit(inputLabel, inputLabel->GetLargestPossibleRegion());
+  for(lit.GoToBegin(); !lit.IsAtEnd(); ++lit)
+  {
+    if(lit.Get() == m_CurrentLabel)
+    {
+      labelFound = true;
+      auto idx = lit.GetIndex();
+      for(unsigned int i=0; i<dimension; ++i)
+      {
+        if(idx[i]<lowerIndex[i]) lowerIndex[i]=idx[i];
+        if(idx[i]>upperIndex[i]) upperIndex[i]=idx[i];
+      }
+    }
+  }
+
+  SizeType size;
+  size.Fill(0);
+  if(labelFound)
+  {
+    for(unsigned int i=0; i<dimension; ++i)
+    {
+      size[i] = upperIndex[i]-lowerIndex[i]+1;
+    }
+  }
+  else{
+    lowerIndex = inputLabel->GetLargestPossibleRegion().GetIndex();
+  }
+  m_LabelRegion = RegionType(lowerIndex, size);
+  m_LabelRegionComputed = true;
+}
+
+//----------------------------------------------------------------------------
+/*
+GetPaddedLabelRegion
+Returns the bounding box of the current label padded by the given number
+of voxels and cropped to the image.
+
+*/
+template <class TImage, class TLabelImage>
+typename QuantitativeIndicesComputationFilter<TImage, TLabelImage>
+::RegionType
+QuantitativeIndicesComputationFilter<TImage, TLabelImage>
+::GetPaddedLabelRegion( const SizeType& pad )
+{
+  RegionType region = this->GetLabelRegion();
+  if(region.GetNumberOfPixels()==0)
+  {
+    return region;
+  }
+  region.PadByRadius(pad);
+  region.Crop(this->GetInputLabelImage()->GetLargestPossibleRegion());
+  return region;
 }
 
 //----------------------------------------------------------------------------
 /*
 CreateSegmentedValueList
+Collects the segmented values of every chunk in parallel and joins them in
+chunk order, i.e. in the order of a serial sweep.
 
 */
 template <class TImage, class TLabelImage>
@@ -132,26 +529,42 @@ QuantitativeIndicesComputationFilter<TImage, TLabelImage>
   auto inputImage = this->GetInputImage();
   auto inputLabel = this->GetInputLabelImage();
   
-  double d_maximumValue = itk::NumericTraits<double>::min();
+  double d_maximumValue = itk::NumericTraits<double>::NonpositiveMin();
   double d_minimumValue = itk::NumericTraits<double>::max();
 
   //Iterate through the image and label.  Determine values where the label is correct in the process.
-  LabelIteratorType laIt(inputLabel, inputLabel->GetLargestPossibleRegion());
-  laIt.GoToBegin();
-  InputIteratorType inIt(inputImage, inputImage->GetLargestPossibleRegion());
-  inIt.GoToBegin();
+  std::vector<RegionType> chunks;
+  this->SplitRegion(this->GetLabelRegion(), chunks);
+  std::vector<ValueListType> chunkValues(chunks.size());
+  this->GetMultiThreader()->ParallelizeArray(0, chunks.size(), [&](SizeValueType chunk)
+  {
+    LabelIteratorType laIt(inputLabel, chunks[chunk]);
+    InputIteratorType inIt(inputImage, chunks[chunk]);
+    for(laIt.GoToBegin(), inIt.GoToBegin(); !laIt.IsAtEnd(); ++laIt, ++inIt)
+    {
+      if (laIt.Get() == m_CurrentLabel)
+      {
+        chunkValues[chunk].push_back(inIt.Get());
+      }
+    }
+  }, nullptr);
 
-  while (!laIt.IsAtEnd() && !inIt.IsAtEnd())
+  SizeValueType numberOfValues = 0;
+  for(const auto& values : chunkValues)
   {
-    if (laIt.Get() == m_CurrentLabel)
+    numberOfValues += values.size();
+  }
+  m_SegmentedValues.reserve(numberOfValues);
+  for(auto& values : chunkValues)
+  {
+    for(const double curValue : values)
     {
-      double curValue = (double) inIt.Get();
       m_SegmentedValues.push_back(curValue);
       if (curValue > d_maximumValue)  {d_maximumValue = curValue;}
       if (curValue < d_minimumValue)  {d_minimumValue = curValue;}
     }
-    ++inIt;
-    ++laIt;
+    values.clear();
+    values.shrink_to_fit();
   }
 
   m_ListGenerated = true;
@@ -201,35 +614,39 @@ QuantitativeIndicesComputationFilter<TImage, TLabelImage>
   double sum3 = 0.0;
   double sum4 = 0.0;
 
+  //Nothing to do if the results are already known
+  if(m_MomentsCalculated && (m_QuarterBinsCalculated || !(m_RequestedFeatures & QuarterBinsFeature)))
+  {
+    return;
+  }
+
   auto inputImage = this->GetInputImage();
   auto spacing = inputImage->GetSpacing();
 
+  //The moments and quarter bins do not need the list unless it already exists
+  if(m_UseStreamingMoments && !m_ListGenerated)
+  {
+    this->CalculateMeanStreaming();
+    return;
+  }
+
   //Need to store all segmented values for some computations
   if(!m_ListGenerated)
   {
     this->CreateSegmentedValueList();
   }
+  //The quarter bins come with the same loop over the list
+  m_MomentsCalculated = true;
+  m_QuarterBinsCalculated = true;
   if(m_SegmentedValues.size()==0)
   {
-    m_AverageValue = std::numeric_limits<double>::quiet_NaN();
-    m_RMSValue = std::numeric_limits<double>::quiet_NaN();
-    m_SegmentedVolume = std::numeric_limits<double>::quiet_NaN();
-    m_TotalLesionGlycolysis = std::numeric_limits<double>::quiet_NaN();
-    m_Variance = std::numeric_limits<double>::quiet_NaN();
-    m_Gly1 = std::numeric_limits<double>::quiet_NaN();
-    m_Gly2 = std::numeric_limits<double>::quiet_NaN();
-    m_Gly3 = std::numeric_limits<double>::quiet_NaN();
-    m_Gly4 = std::numeric_limits<double>::quiet_NaN();
-    m_Q1 = std::numeric_limits<double>::quiet_NaN();
-    m_Q2 = std::numeric_limits<double>::quiet_NaN();
-    m_Q3 = std::numeric_limits<double>::quiet_NaN();
-    m_Q4 = std::numeric_limits<double>::quiet_NaN();
+    this->SetUndefinedMeanValues();
     return;
   }
 
   //Find the distribution within the range
   binSize = (m_MaximumValue-m_MinimumValue)*0.25;
-  for(const auto& curValue :  m_SegmentedValues)
+  for(const double curValue :  m_SegmentedValues)
   {
     d_rmsValue += curValue*curValue;
     if(curValue >= m_MinimumValue && curValue <= (m_MinimumValue + binSize)){d_q1++; sum1+=curValue;};
@@ -253,7 +670,7 @@ QuantitativeIndicesComputationFilter<TImage, TLabelImage>
   d_q3 = d_q3/voxelCount;
   d_q4 = d_q4/voxelCount;
 
-  for(const auto& curValue :  m_SegmentedValues)
+  for(const double curValue :  m_SegmentedValues)
 		d_variance += (curValue-d_averageValue) * (curValue-d_averageValue);
 
   d_variance /= (voxelCount);
@@ -275,6 +692,194 @@ QuantitativeIndicesComputationFilter<TImage, TLabelImage>
 
 }
 
+//----------------------------------------------------------------------------
+/*
+AccumulateMoments
+Streams once over the image and label to determine the voxel count,
+Minimum, Maximum, Average, RMS and Variance without storing the
+segmented values. The chunks are accumulated in parallel and merged in
+chunk order.
+
+*/
+template <class TImage, class TLabelImage>
+void
+QuantitativeIndicesComputationFilter<TImage, TLabelImage>
+::AccumulateMoments()
+{
+  using InputIteratorType = itk::ImageRegionConstIterator<ImageType>;
+  using LabelIteratorType = itk::ImageRegionConstIteratorWithIndex<LabelImageType>;
+
+  auto inputImage = this->GetInputImage();
+  auto inputLabel = this->GetInputLabelImage();
+
+  std::vector<RegionType> chunks;
+  this->SplitRegion(this->GetLabelRegion(), chunks);
+  std::vector<LabelStatistics> chunkStatistics(chunks.size());
+  this->GetMultiThreader()->ParallelizeArray(0, chunks.size(), [&](SizeValueType chunk)
+  {
+    LabelIteratorType laIt(inputLabel, chunks[chunk]);
+    InputIteratorType inIt(inputImage, chunks[chunk]);
+    for(laIt.GoToBegin(), inIt.GoToBegin(); !laIt.IsAtEnd(); ++laIt, ++inIt)
+    {
+      if (laIt.Get() == m_CurrentLabel)
+      {
+        AddLabelValue(chunkStatistics[chunk], laIt.GetIndex(), (double) inIt.Get(), false);
+      }
+    }
+  }, nullptr);
+
+  LabelStatistics statistics;
+  for(auto& partial : chunkStatistics)
+  {
+    MergeLabelStatistics(statistics, std::move(partial));
+  }
+
+  const SizeValueType voxelCount = statistics.Count;
+  m_SegmentedVoxelCount = voxelCount;
+  m_SegmentedValueSum = statistics.Sum;
+  m_MomentsAccumulated = true;
+  if(voxelCount==0)
+  {
+    m_MinimumValue = std::numeric_limits<double>::quiet_NaN();
+    m_MaximumValue = std::numeric_limits<double>::quiet_NaN();
+    this->SetUndefinedMeanValues();
+    return;
+  }
+  m_MinimumValue = statistics.Minimum;
+  m_MaximumValue = statistics.Maximum;
+  m_AverageValue = statistics.Sum / voxelCount;
+  m_RMSValue = std::sqrt(statistics.SumOfSquares / voxelCount);
+  m_Variance = statistics.RunningM2 / voxelCount;
+}
+
+//----------------------------------------------------------------------------
+/*
+CalculateMeanStreaming
+Same results as CalculateMean, but streams over the image instead of
+storing the segmented values. The quarter bins depend on the minimum and
+maximum, so a second pass over the image is needed for them.
+
+*/
+template <class TImage, class TLabelImage>
+void
+QuantitativeIndicesComputationFilter<TImage, TLabelImage>
+::CalculateMeanStreaming()
+{
+  using InputIteratorType = itk::ImageRegionConstIterator<ImageType>;
+  using LabelIteratorType = itk::ImageRegionConstIterator<LabelImageType>;
+
+  if(!m_MomentsAccumulated)
+  {
+    this->AccumulateMoments();
+  }
+  m_MomentsCalculated = true;
+  if(m_SegmentedVoxelCount==0)
+  {
+    m_QuarterBinsCalculated = true;
+    this->SetUndefinedMeanValues();
+    return;
+  }
+
+  auto inputImage = this->GetInputImage();
+  auto inputLabel = this->GetInputLabelImage();
+  auto spacing = inputImage->GetSpacing();
+  double voxelCount = m_SegmentedVoxelCount;
+  double voxelVolume = (spacing[0] * spacing[1] * spacing[2]);
+  m_SegmentedVolume = voxelCount*voxelVolume;
+
+  //The volume and TLG only need the count and sum, skip the second pass if
+  //the quarter bins are not requested
+  if(!(m_RequestedFeatures & QuarterBinsFeature))
+  {
+    m_TotalLesionGlycolysis = m_SegmentedValueSum*voxelVolume;
+    m_Gly1 = std::numeric_limits<double>::quiet_NaN();
+    m_Gly2 = std::numeric_limits<double>::quiet_NaN();
+    m_Gly3 = std::numeric_limits<double>::quiet_NaN();
+    m_Gly4 = std::numeric_limits<double>::quiet_NaN();
+    m_Q1 = std::numeric_limits<double>::quiet_NaN();
+    m_Q2 = std::numeric_limits<double>::quiet_NaN();
+    m_Q3 = std::numeric_limits<double>::quiet_NaN();
+    m_Q4 = std::numeric_limits<double>::quiet_NaN();
+    return;
+  }
+
+  double d_q1 = 0.0;
+  double d_q2 = 0.0;
+  double d_q3 = 0.0;
+  double d_q4 = 0.0;
+  double sum1 = 0.0;
+  double sum2 = 0.0;
+  double sum3 = 0.0;
+  double sum4 = 0.0;
+
+  //Find the distribution within the range. Every chunk counts its own
+  //bins, they are added up in chunk order.
+  double binSize = (m_MaximumValue-m_MinimumValue)*0.25;
+  std::vector<RegionType> chunks;
+  this->SplitRegion(this->GetLabelRegion(), chunks);
+  std::vector< std::array<double,8> > chunkBins(chunks.size());
+  this->GetMultiThreader()->ParallelizeArray(0, chunks.size(), [&](SizeValueType chunk)
+  {
+    std::array<double,8>& bins = chunkBins[chunk];
+    bins.fill(0.0);
+    LabelIteratorType laIt(inputLabel, chunks[chunk]);
+    InputIteratorType inIt(inputImage, chunks[chunk]);
+    for(laIt.GoToBegin(), inIt.GoToBegin(); !laIt.IsAtEnd(); ++laIt, ++inIt)
+    {
+      if (laIt.Get() == m_CurrentLabel)
+      {
+        double curValue = (double) inIt.Get();
+        if(curValue >= m_MinimumValue && curValue <= (m_MinimumValue + binSize)){bins[0]++; bins[4]+=curValue;};
+        if(curValue > (m_MinimumValue+binSize) && curValue <= (m_MinimumValue+2*binSize)){bins[1]++; bins[5]+=curValue;};
+        if(curValue > (m_MinimumValue+2*binSize) && curValue <= (m_MinimumValue+3*binSize)){bins[2]++; bins[6]+=curValue;};
+        if(curValue > (m_MinimumValue+3*binSize) && curValue <= (m_MinimumValue+4*binSize)){bins[3]++; bins[7]+=curValue;};
+      }
+    }
+  }, nullptr);
+  for(const auto& bins : chunkBins)
+  {
+    d_q1 += bins[0]; d_q2 += bins[1]; d_q3 += bins[2]; d_q4 += bins[3];
+    sum1 += bins[4]; sum2 += bins[5]; sum3 += bins[6]; sum4 += bins[7];
+  }
+
+  m_Gly1 = sum1*voxelVolume;
+  m_Gly2 = sum2*voxelVolume;
+  m_Gly3 = sum3*voxelVolume;
+  m_Gly4 = sum4*voxelVolume;
+  m_TotalLesionGlycolysis = m_Gly1 + m_Gly2 + m_Gly3 + m_Gly4;
+  m_Q1 = d_q1/voxelCount;
+  m_Q2 = d_q2/voxelCount;
+  m_Q3 = d_q3/voxelCount;
+  m_Q4 = d_q4/voxelCount;
+  m_QuarterBinsCalculated = true;
+}
+
+//----------------------------------------------------------------------------
+/*
+SetUndefinedMeanValues
+Sets all values determined by CalculateMean to NaN (empty label).
+
+*/
+template <class TImage, class TLabelImage>
+void
+QuantitativeIndicesComputationFilter<TImage, TLabelImage>
+::SetUndefinedMeanValues()
+{
+  m_AverageValue = std::numeric_limits<double>::quiet_NaN();
+  m_RMSValue = std::numeric_limits<double>::quiet_NaN();
+  m_SegmentedVolume = std::numeric_limits<double>::quiet_NaN();
+  m_TotalLesionGlycolysis = std::numeric_limits<double>::quiet_NaN();
+  m_Variance = std::numeric_limits<double>::quiet_NaN();
+  m_Gly1 = std::numeric_limits<double>::quiet_NaN();
+  m_Gly2 = std::numeric_limits<double>::quiet_NaN();
+  m_Gly3 = std::numeric_limits<double>::quiet_NaN();
+  m_Gly4 = std::numeric_limits<double>::quiet_NaN();
+  m_Q1 = std::numeric_limits<double>::quiet_NaN();
+  m_Q2 = std::numeric_limits<double>::quiet_NaN();
+  m_Q3 = std::numeric_limits<double>::quiet_NaN();
+  m_Q4 = std::numeric_limits<double>::quiet_NaN();
+}
+
 //----------------------------------------------------------------------------
 /*
 CalculateQuartiles
@@ -294,11 +899,25 @@ QuantitativeIndicesComputationFilter<TImage, TLabelImage>
   double d_thirdQuartileValue = 0.0;
   double d_upperAdjacentValue = 0.0;
 
+  if(m_QuartilesCalculated)
+  {
+    return;
+  }
+  m_QuartilesCalculated = true;
+
+  //The histogram is only used when the exact list is not available anyway
+  if(m_UseApproximateQuartiles && !m_ListGenerated)
+  {
+    this->CalculateQuartilesApproximate();
+    return;
+  }
+
   //Need to store all segmented values for some computations
   if(!m_ListGenerated)  // list is already generated
   {
     this->CreateSegmentedValueList();
   }
+  m_AchievedQuartileErrorBound = 0.0;
   if(m_SegmentedValues.size()==0)
   {
     m_MedianValue = std::numeric_limits<double>::quiet_NaN();
@@ -308,39 +927,71 @@ QuantitativeIndicesComputationFilter<TImage, TLabelImage>
     return;
   }
 
-  //Sort the values
-  sort(m_SegmentedValues.begin(), m_SegmentedValues.end());
-  int segmentedValuesSize = m_SegmentedValues.size();
-	std::vector<double>::const_iterator listIt = m_SegmentedValues.begin();
+  //Select the order statistics needed for the quartiles instead of sorting
+  //the whole list. The ranks are partitioned in ascending order so every
+  //selection only has to look at the values above the previous one.
+  SizeValueType segmentedValuesSize = m_SegmentedValues.size();
+  std::vector<SizeValueType> ranks;
+  if(segmentedValuesSize % 2 == 0)
+  {
+    ranks.push_back(segmentedValuesSize/2-1);
+  }
+  ranks.push_back(segmentedValuesSize/2);
+  if(segmentedValuesSize % 4 == 0)
+  {
+    ranks.push_back(segmentedValuesSize/4-1);
+    ranks.push_back(segmentedValuesSize/4);
+    ranks.push_back(segmentedValuesSize*3/4-1);
+    ranks.push_back(segmentedValuesSize*3/4);
+  }
+  else{
+    ranks.push_back(segmentedValuesSize/4);
+    ranks.push_back(segmentedValuesSize*3/4);
+  }
+  std::sort(ranks.begin(), ranks.end());
+  ranks.erase(std::unique(ranks.begin(), ranks.end()), ranks.end());
+  auto lowerIt = m_SegmentedValues.begin();
+  for(const auto& rank : ranks)
+  {
+    auto nthIt = m_SegmentedValues.begin() + rank;
+    std::nth_element(lowerIt, nthIt, m_SegmentedValues.end());
+    lowerIt = nthIt + 1;
+  }
+
   //Determine quartiles
-	if(segmentedValuesSize % 2 == 0)
-	{
-	  d_medianValue = (m_SegmentedValues[segmentedValuesSize/2-1] + m_SegmentedValues[segmentedValuesSize/2])*0.5;
-	}
-	else{
-	  d_medianValue = m_SegmentedValues[segmentedValuesSize/2];
-	}
-	if(segmentedValuesSize % 4 == 0)
-	{
-	  d_firstQuartileValue = (m_SegmentedValues[segmentedValuesSize/4-1] + m_SegmentedValues[segmentedValuesSize/4])*0.5;
-	  d_thirdQuartileValue = (m_SegmentedValues[segmentedValuesSize*0.75-1] + m_SegmentedValues[segmentedValuesSize*0.75])*0.5;
-	}
-	else{
-	  d_firstQuartileValue = m_SegmentedValues[segmentedValuesSize/4];
-	  d_thirdQuartileValue = m_SegmentedValues[segmentedValuesSize*3/4];
-	}
-
-  // Find upper adjacent value
+  if(segmentedValuesSize % 2 == 0)
+  {
+    d_medianValue = (static_cast<double>(m_SegmentedValues[segmentedValuesSize/2-1]) + m_SegmentedValues[segmentedValuesSize/2])*0.5;
+  }
+  else{
+    d_medianValue = m_SegmentedValues[segmentedValuesSize/2];
+  }
+  if(segmentedValuesSize % 4 == 0)
+  {
+    d_firstQuartileValue = (static_cast<double>(m_SegmentedValues[segmentedValuesSize/4-1]) + m_SegmentedValues[segmentedValuesSize/4])*0.5;
+    d_thirdQuartileValue = (static_cast<double>(m_SegmentedValues[segmentedValuesSize*3/4-1]) + m_SegmentedValues[segmentedValuesSize*3/4])*0.5;
+  }
+  else{
+    d_firstQuartileValue = m_SegmentedValues[segmentedValuesSize/4];
+    d_thirdQuartileValue = m_SegmentedValues[segmentedValuesSize*3/4];
+  }
+
+  // Find upper adjacent value (largest value below Q3+1.5*IQR).
+  // Everything below the third quartile rank is no larger than the value at
+  // that rank, so only the values from that rank upwards have to be scanned.
+  // When IQR > 0 the value at that rank is at most Q3+IQR, so it is always
+  // below the fence and seeds the search.
   double IQR = d_thirdQuartileValue - d_firstQuartileValue;
-  double d_maximumValue = m_SegmentedValues[segmentedValuesSize-1];
-  listIt = m_SegmentedValues.begin();
-  if(IQR!=0){
-    while(listIt != m_SegmentedValues.end()){
-      if(*listIt < (d_thirdQuartileValue+1.5*IQR)){ d_upperAdjacentValue = *listIt; };
-      listIt++;
-    }
+  double upperFence = d_thirdQuartileValue+1.5*IQR;
+  SizeValueType upperRank = ranks.back();
+  double d_maximumValue = m_SegmentedValues[upperRank];
+  d_upperAdjacentValue = m_SegmentedValues[upperRank];
+  for(auto listIt = m_SegmentedValues.begin() + upperRank; listIt != m_SegmentedValues.end(); ++listIt)
+  {
+    if(*listIt > d_maximumValue){ d_maximumValue = *listIt; }
+    if(*listIt < upperFence && *listIt > d_upperAdjacentValue){ d_upperAdjacentValue = *listIt; }
   }
-  else{ d_upperAdjacentValue = d_maximumValue; }
+  if(IQR==0){ d_upperAdjacentValue = d_maximumValue; }
 
   //Set the class variables to the values we've determined.
   m_MedianValue = d_medianValue;
@@ -350,6 +1001,133 @@ QuantitativeIndicesComputationFilter<TImage, TLabelImage>
 }
 
 
+//----------------------------------------------------------------------------
+/*
+CalculateQuartilesApproximate
+Same results as CalculateQuartiles, within the requested error bound.
+The segmented values are counted in a histogram with a fixed maximum
+number of bins. Every order statistic is taken as the center of the bin
+containing its rank, so it is off by at most half a bin width. The upper
+adjacent value is the exact largest value below the fence computed from
+the approximate quartiles.
+
+*/
+template <class TImage, class TLabelImage>
+void
+QuantitativeIndicesComputationFilter<TImage, TLabelImage>
+::CalculateQuartilesApproximate()
+{
+  using InputIteratorType = itk::ImageRegionConstIterator<ImageType>;
+  using LabelIteratorType = itk::ImageRegionConstIterator<LabelImageType>;
+
+  //The histogram range comes from the streamed minimum and maximum
+  if(!m_MomentsAccumulated)
+  {
+    this->AccumulateMoments();
+  }
+  if(m_SegmentedVoxelCount==0)
+  {
+    m_MedianValue = std::numeric_limits<double>::quiet_NaN();
+    m_FirstQuartileValue = std::numeric_limits<double>::quiet_NaN();
+    m_ThirdQuartileValue = std::numeric_limits<double>::quiet_NaN();
+    m_UpperAdjacentValue = std::numeric_limits<double>::quiet_NaN();
+    m_AchievedQuartileErrorBound = std::numeric_limits<double>::quiet_NaN();
+    return;
+  }
+
+  auto inputImage = this->GetInputImage();
+  auto inputLabel = this->GetInputLabelImage();
+
+  //A bin center is within half a bin width of every value in the bin
+  double range = m_MaximumValue - m_MinimumValue;
+  SizeValueType numberOfBins = 1;
+  double binWidth = 0.0;
+  if(range > 0)
+  {
+    numberOfBins = QI_MAX_QUARTILE_HISTOGRAM_BINS;
+    if(m_QuartileErrorBound > 0 && range/(2*m_QuartileErrorBound) < numberOfBins)
+    {
+      numberOfBins = std::max<SizeValueType>(1, std::ceil(range/(2*m_QuartileErrorBound)));
+    }
+    binWidth = range/numberOfBins;
+  }
+  std::vector<SizeValueType> histogram(numberOfBins, 0);
+
+  const RegionType& labelRegion = this->GetLabelRegion();
+  LabelIteratorType laIt(inputLabel, labelRegion);
+  laIt.GoToBegin();
+  InputIteratorType inIt(inputImage, labelRegion);
+  inIt.GoToBegin();
+  while (!laIt.IsAtEnd() && !inIt.IsAtEnd())
+  {
+    if (laIt.Get() == m_CurrentLabel)
+    {
+      SizeValueType bin = 0;
+      if(binWidth > 0)
+      {
+        bin = std::min<SizeValueType>(((double) inIt.Get() - m_MinimumValue)/binWidth, numberOfBins-1);
+      }
+      ++histogram[bin];
+    }
+    ++inIt;
+    ++laIt;
+  }
+
+  auto valueAtRank = [&](SizeValueType rank) -> double
+  {
+    SizeValueType cumulativeCount = 0;
+    for(SizeValueType bin=0; bin<numberOfBins; ++bin)
+    {
+      cumulativeCount += histogram[bin];
+      if(cumulativeCount > rank)
+      {
+        double center = m_MinimumValue + (bin+0.5)*binWidth;
+        return std::min(std::max(center, m_MinimumValue), m_MaximumValue);
+      }
+    }
+    return m_MaximumValue;
+  };
+
+  //Determine quartiles using the same rules as the exact calculation
+  SizeValueType segmentedValuesSize = m_SegmentedVoxelCount;
+  if(segmentedValuesSize % 2 == 0)
+  {
+    m_MedianValue = (valueAtRank(segmentedValuesSize/2-1) + valueAtRank(segmentedValuesSize/2))*0.5;
+  }
+  else{
+    m_MedianValue = valueAtRank(segmentedValuesSize/2);
+  }
+  if(segmentedValuesSize % 4 == 0)
+  {
+    m_FirstQuartileValue = (valueAtRank(segmentedValuesSize/4-1) + valueAtRank(segmentedValuesSize/4))*0.5;
+    m_ThirdQuartileValue = (valueAtRank(segmentedValuesSize*3/4-1) + valueAtRank(segmentedValuesSize*3/4))*0.5;
+  }
+  else{
+    m_FirstQuartileValue = valueAtRank(segmentedValuesSize/4);
+    m_ThirdQuartileValue = valueAtRank(segmentedValuesSize*3/4);
+  }
+  m_AchievedQuartileErrorBound = 0.5*binWidth;
+
+  // Find upper adjacent value with one more streaming pass
+  double IQR = m_ThirdQuartileValue - m_FirstQuartileValue;
+  if(IQR==0)
+  {
+    m_UpperAdjacentValue = m_MaximumValue;
+    return;
+  }
+  double upperFence = m_ThirdQuartileValue+1.5*IQR;
+  double d_upperAdjacentValue = m_MinimumValue;
+  for(laIt.GoToBegin(), inIt.GoToBegin(); !laIt.IsAtEnd() && !inIt.IsAtEnd(); ++laIt, ++inIt)
+  {
+    if (laIt.Get() == m_CurrentLabel)
+    {
+      double curValue = (double) inIt.Get();
+      if(curValue < upperFence && curValue > d_upperAdjacentValue){ d_upperAdjacentValue = curValue; }
+    }
+  }
+  m_UpperAdjacentValue = d_upperAdjacentValue;
+}
+
 //----------------------------------------------------------------------------
 /*
 CalculateSAM
@@ -369,8 +1147,11 @@ QuantitativeIndicesComputationFilter<TImage, TLabelImage>
   double d_averageValue = 0.0;
   double d_segmentedVolume = 0.0;
 
-  using InputIteratorType = itk::ImageRegionConstIterator<ImageType>;
-  using LabelIteratorType = itk::ImageRegionConstIterator<LabelImageType>;
+  if(m_SAMCalculated)
+  {
+    return;
+  }
+  m_SAMCalculated = true;
 
   auto inputImage = this->GetInputImage();
   auto inputLabel = this->GetInputLabelImage();
@@ -378,68 +1159,165 @@ QuantitativeIndicesComputationFilter<TImage, TLabelImage>
   auto spacing = inputImage->GetSpacing();
   double voxelSize = spacing[0] * spacing[1] * spacing[2];
 
-  InputIteratorType inIt(inputImage, inputImage->GetLargestPossibleRegion());
-  inIt.GoToBegin();
-
-  if(!m_ListGenerated)
+  if(m_UseStreamingMoments && !m_ListGenerated)
   {
-    this->CreateSegmentedValueList();
+    //Only the mean and voxel count of the object are needed
+    if(!m_MomentsAccumulated)
+    {
+      this->AccumulateMoments();
+    }
+    d_segmentedVolume = m_SegmentedVoxelCount;
+    d_averageValue = m_AverageValue;
   }
-  if(m_SegmentedValues.size()==0)
+  else
+  {
+    if(!m_ListGenerated)
+    {
+      this->CreateSegmentedValueList();
+    }
+    for(const double curValue :  m_SegmentedValues)
+    {
+      d_averageValue += curValue;
+      d_segmentedVolume += 1;
+    }
+    if(d_segmentedVolume>0)
+    {
+      d_averageValue /= d_segmentedVolume;
+    }
+  }
+  if(d_segmentedVolume==0)
   {
     m_SAMValue = std::numeric_limits<double>::quiet_NaN();
     m_SAMBackground = std::numeric_limits<double>::quiet_NaN();
     return;
   }
-  for(const auto& curValue :  m_SegmentedValues)
-  {
-    d_averageValue += curValue;
-    d_segmentedVolume += 1;
-  }
-
-  d_averageValue /= d_segmentedVolume;
 
-  //Dilate region and collect new values
-  std::list<double> dilatedRegionValues;
+  //Collect the values of the shell a radius 2 ball dilation would add to the
+  //object. Every shell voxel lies within the kernel of an object voxel that
+  //has a face neighbour outside the object, so only those boundary voxels
+  //spread the kernel. The shell can only reach the label bounding box plus the
+  //radius, and a mask over that box keeps voxels from being counted twice.
   using KernelType = itk::BinaryBallStructuringElement<LabelType,3>;
   KernelType ballElement;
   typename KernelType::SizeValueType radius = 2;
   ballElement.SetRadius(radius);
   ballElement.CreateStructuringElement();
-  using DilaterType = itk::DilateObjectMorphologyImageFilter<LabelImageType,LabelImageType,KernelType>;
-  auto dilater = DilaterType::New();
-  dilater->SetObjectValue(m_CurrentLabel);
-  dilater->SetKernel(ballElement);
-  dilater->SetInput(inputLabel);
-  try{
-      dilater->Update();
+  std::vector<typename KernelType::OffsetType> kernelOffsets;
+  for(unsigned int k=0; k<ballElement.Size(); ++k)
+  {
+    if(ballElement[k])
+    {
+      kernelOffsets.push_back(ballElement.GetOffset(k));
     }
-  catch(itk::ExceptionObject & e){
-      std::cerr << "Exception caught updating dilater!" << std::endl << e << std::endl;          
+  }
+
+  SizeType samPad;
+  samPad.Fill(radius);
+  const RegionType samRegion = this->GetPaddedLabelRegion(samPad);
+  const IndexType samStart = samRegion.GetIndex();
+  const SizeType samSize = samRegion.GetSize();
+  std::vector<unsigned char> shellMask(samRegion.GetNumberOfPixels(), 0);
+
+  //First find the boundary voxels of every chunk of the padded box in
+  //parallel. Then every chunk adds up the shell voxels inside it, spread from
+  //the boundary voxels of the chunks close enough to reach it. The chunks
+  //write to disjoint parts of the mask and their sums are added in chunk
+  //order.
+  std::vector<RegionType> chunks;
+  this->SplitRegion(samRegion, chunks);
+  std::vector< std::vector<IndexType> > chunkBoundaries(chunks.size());
+  std::vector<double> chunkShellSums(chunks.size(), 0.0);
+  std::vector<double> chunkShellCounts(chunks.size(), 0.0);
+  const RegionType& labelRegion = this->GetLabelRegion();
+  using LabelIndexIteratorType = itk::ImageRegionConstIteratorWithIndex<LabelImageType>;
+  this->GetMultiThreader()->ParallelizeArray(0, chunks.size(), [&](SizeValueType chunk)
+  {
+    RegionType objectRegion = chunks[chunk];
+    if(!objectRegion.Crop(labelRegion))
+    {
+      return;
     }
-  LabelIteratorType dilateIt(dilater->GetOutput(), inputLabel->GetLargestPossibleRegion());
-  for( dilateIt.GoToBegin(), inIt.GoToBegin(); !inIt.IsAtEnd(); ++inIt, ++dilateIt)
+    LabelIndexIteratorType laIt(inputLabel, objectRegion);
+    for(laIt.GoToBegin(); !laIt.IsAtEnd(); ++laIt)
     {
-      if(dilateIt.Get() == m_CurrentLabel)
+      if(laIt.Get() != m_CurrentLabel)
+      {
+        continue;
+      }
+      const IndexType idx = laIt.GetIndex();
+      bool onBoundary = false;
+      for(unsigned int i=0; i<3 && !onBoundary; ++i)
+      {
+        for(int step=-1; step<=1 && !onBoundary; step+=2)
         {
-          dilatedRegionValues.push_back((double) inIt.Get());
+          IndexType neighbor = idx;
+          neighbor[i] += step;
+          onBoundary = !samRegion.IsInside(neighbor) || inputLabel->GetPixel(neighbor) != m_CurrentLabel;
         }
+      }
+      if(onBoundary)
+      {
+        chunkBoundaries[chunk].push_back(idx);
+      }
     }
+  }, nullptr);
 
-  double dilatedSize = (double) dilatedRegionValues.size();
-  for(const auto& curValue :  dilatedRegionValues)
-    d_SAM += curValue;
-  d_SAM = d_SAM / dilatedSize;
-  d_SAMBackground = (d_SAM*dilatedSize-d_averageValue*d_segmentedVolume)/(dilatedSize-d_segmentedVolume);
-  d_SAM = (d_averageValue-d_SAMBackground)*d_segmentedVolume*voxelSize;
+  this->GetMultiThreader()->ParallelizeArray(0, chunks.size(), [&](SizeValueType chunk)
+  {
+    const RegionType& shellRegion = chunks[chunk];
+    for(unsigned int sourceChunk=0; sourceChunk<chunks.size(); ++sourceChunk)
+    {
+      RegionType reach = chunks[sourceChunk];
+      reach.PadByRadius(samPad);
+      if(chunkBoundaries[sourceChunk].empty() || !reach.Crop(shellRegion))
+      {
+        continue;
+      }
+      for(const auto& idx : chunkBoundaries[sourceChunk])
+      {
+        for(const auto& offset : kernelOffsets)
+        {
+          const IndexType shellIdx = idx + offset;
+          if(!shellRegion.IsInside(shellIdx) || inputLabel->GetPixel(shellIdx) == m_CurrentLabel)
+          {
+            continue;
+          }
+          const SizeValueType maskPos = (shellIdx[0]-samStart[0])
+            + samSize[0]*((shellIdx[1]-samStart[1]) + samSize[1]*(shellIdx[2]-samStart[2]));
+          if(!shellMask[maskPos])
+          {
+            shellMask[maskPos] = 1;
+            chunkShellSums[chunk] += (double) inputImage->GetPixel(shellIdx);
+            chunkShellCounts[chunk] += 1;
+          }
+        }
+      }
+    }
+  }, nullptr);
+
+  double shellSum = 0.0;
+  double shellCount = 0.0;
+  for(unsigned int chunk=0; chunk<chunks.size(); ++chunk)
+  {
+    shellSum += chunkShellSums[chunk];
+    shellCount += chunkShellCounts[chunk];
+  }
+
+  if(shellCount==0)
+  {
+    //The object fills the whole image, there is no background to compare to
+    d_SAMBackground = std::numeric_limits<double>::quiet_NaN();
+    d_SAM = std::numeric_limits<double>::quiet_NaN();
+  }
+  else
+  {
+    d_SAMBackground = shellSum/shellCount;
+    d_SAM = (d_averageValue-d_SAMBackground)*d_segmentedVolume*voxelSize;
+  }
 
   //Set the class variables to the values we've determined.
   m_SAMValue = d_SAM;
   m_SAMBackground = d_SAMBackground;
-  
-  //std::cout << inputLabel << std::endl;
-  //std::cout << "dilatedRegionValues.size()="<<dilatedRegionValues.size() << std::endl;
-
 }
 
 
@@ -456,12 +1334,23 @@ QuantitativeIndicesComputationFilter<TImage, TLabelImage>
 ::CalculatePeak()
 {
 //std::cout << "CalculatePeak()\n";
+  if(m_PeakCalculated)
+  {
+    return;
+  }
+  m_PeakCalculated = true;
+
   using PeakFilterType = itk::PeakIntensityFilter<ImageType,LabelImageType>;
   auto peakFilter = PeakFilterType::New();
+  // same thread limits as this filter
+  peakFilter->SetMultiThreader( this->GetMultiThreader() );
+  peakFilter->SetNumberOfWorkUnits( this->GetNumberOfWorkUnits() );
   peakFilter->SetInputImage( this->GetInputImage() );
   peakFilter->SetInputLabelImage( this->GetInputLabelImage() );
   peakFilter->SetCurrentLabel( m_CurrentLabel );
+  peakFilter->SetLabelRegion( this->GetLabelRegion() );
   peakFilter->SetSphereVolume( 1000 ); 
+  peakFilter->SetKernelCacheDirectory( m_PeakKernelCacheDirectory );
   //peakFilter->SetSamplingFactor( 20 ); //TODO remove after adding exact weights to itkPeakIntensityFilter
   //peakFilter->SetUseApproximateKernel(true); //TODO remove after adding exact weights to itkPeakIntensityFilter
   //peakFilter->SetUseInteriorOnly( false );
@@ -482,6 +1371,8 @@ QuantitativeIndicesComputationFilter<TImage, TLabelImage>
 ::PrintSelf(std::ostream& os, Indent indent) const
 {
   Superclass::PrintSelf(os,indent);
+  os << indent << "CurrentLabel: " << m_CurrentLabel << std::endl;
+  os << indent << "RequestedFeatures: " << m_RequestedFeatures << std::endl;
 }
 
 } // namespace
@@ -3,6 +3,10 @@
 
 #include "itkMeshSource.h"
 
+#include <map>
+#include <string>
+#include <vector>
+
 namespace itk
 {
 
@@ -20,6 +24,8 @@ public:
   using ImagePointer = typename ImageType::Pointer;
   using ImageConstPointer = typename ImageType::ConstPointer;
   using PixelType = typename ImageType::PixelType;
+  /** Values of the region of interest, stored in the precision of the image */
+  using ValueListType = std::vector<PixelType>;
 
   using LabelImageType = TLabelImage;
   using LabelImagePointer = typename LabelImageType::Pointer;
@@ -27,6 +33,9 @@ public:
   using LabelType = typename LabelImageType::PixelType;
 
   using PointType = typename ImageType::PointType;
+  using RegionType = typename LabelImageType::RegionType;
+  using IndexType = typename LabelImageType::IndexType;
+  using SizeType = typename LabelImageType::SizeType;
 
   ITK_DISALLOW_COPY_AND_ASSIGN(QuantitativeIndicesComputationFilter);
 
@@ -43,9 +52,32 @@ public:
   LabelImageConstPointer GetInputLabelImage() const;
 
   //Set and Get macros for the various values
-  itkSetMacro(CurrentLabel, LabelType);
+  void SetCurrentLabel( LabelType label );
   itkGetMacro(CurrentLabel, LabelType);
 
+  /** Features that can be requested, combined as a bit mask */
+  enum FeatureType : unsigned int
+  {
+    /** Mean, RMS, variance, minimum, maximum, volume and TLG */
+    MomentsFeature = 1,
+    /** Glycolysis and distribution in each quarter of the range */
+    QuarterBinsFeature = 2,
+    /** First quartile, median, third quartile and upper adjacent value */
+    QuartilesFeature = 4,
+    /** SAM and SAM background */
+    SAMFeature = 8,
+    /** Peak value and location */
+    PeakFeature = 16,
+    AllFeatures = 31
+  };
+
+  /** Features computed by Update(). Only the passes these features need are
+   * run, e.g. CalculateMean skips the quarter bins if they are not
+   * requested. Every result is computed at most once until the inputs or
+   * the label change. */
+  itkSetMacro(RequestedFeatures, unsigned int);
+  itkGetMacro(RequestedFeatures, unsigned int);
+
   itkGetMacro(MaximumValue, double);
   itkGetMacro(AverageValue, double);
   itkGetMacro(RMSValue, double);
@@ -70,6 +102,67 @@ public:
   itkGetMacro(Q3, double);
   itkGetMacro(Q4, double);
 
+  /** Set to true to compute the moments and quarter bins by streaming over the
+   * image instead of storing the list of segmented values. The list is still
+   * generated when quartiles are requested. */
+  itkSetMacro(UseStreamingMoments, bool);
+  itkGetMacro(UseStreamingMoments, bool);
+  itkBooleanMacro(UseStreamingMoments);
+
+  /** Set to true to compute the quartiles and upper adjacent value from a
+   * fixed-memory histogram instead of the list of segmented values. */
+  itkSetMacro(UseApproximateQuartiles, bool);
+  itkGetMacro(UseApproximateQuartiles, bool);
+  itkBooleanMacro(UseApproximateQuartiles);
+
+  /** Maximum absolute error (in image units) of the approximate quartiles */
+  itkSetMacro(QuartileErrorBound, double);
+  itkGetMacro(QuartileErrorBound, double);
+
+  /** Absolute error bound achieved by the last quartile calculation (0 if exact) */
+  itkGetMacro(AchievedQuartileErrorBound, double);
+
+  /** Directory where the peak kernels are kept between runs (empty to only
+   * cache them within the process) */
+  itkSetMacro(PeakKernelCacheDirectory, std::string);
+  itkGetMacro(PeakKernelCacheDirectory, std::string);
+
+  /** Bounding box of the current label. It is determined on first use and
+   * restricts all subsequent passes over the images. Setting it skips the
+   * scan, e.g. when the caller already knows the extent of the label. Set
+   * it after the label, changing the label discards it. */
+  void SetLabelRegion( const RegionType& region );
+  const RegionType& GetLabelRegion();
+
+  /** Bounding box, moments and (optionally) values of one label, as gathered
+   * by ComputeLabelStatistics. */
+  struct LabelStatistics
+  {
+    IndexType LowerIndex;
+    IndexType UpperIndex;
+    SizeValueType Count{ 0 };
+    double Sum{ 0.0 };
+    double SumOfSquares{ 0.0 };
+    double RunningMean{ 0.0 };
+    double RunningM2{ 0.0 };
+    double Minimum{ NumericTraits<double>::max() };
+    double Maximum{ NumericTraits<double>::NonpositiveMin() };
+    ValueListType Values;
+  };
+  using LabelStatisticsMapType = std::map<LabelType, LabelStatistics>;
+
+  /** Gathers the statistics of every positive label in a single sweep over
+   * the images. The values are only stored if storeValues is set. At most
+   * numberOfThreads threads are used (0 for the ITK default). */
+  static void ComputeLabelStatistics( const ImageType* image, const LabelImageType* labelImage,
+                                      bool storeValues, LabelStatisticsMapType& statistics,
+                                      unsigned int numberOfThreads = 0 );
+
+  /** Uses statistics gathered by ComputeLabelStatistics for the current
+   * label instead of scanning the images for the bounding box, the moments
+   * and (if stored) the list of values. Set them after the label. */
+  void SetLabelStatistics( LabelStatistics&& statistics );
+
   void CalculateMean();
   void CalculateQuartiles();
   void CalculatePeak();
@@ -81,11 +174,24 @@ protected:
   void PrintSelf(std::ostream& os, Indent indent) const override;
 
   void GenerateData() override;
+  void ComputeLabelRegion();
+  RegionType GetPaddedLabelRegion( const SizeType& pad );
   void CreateSegmentedValueList();
+  void AccumulateMoments();
+  void CalculateMeanStreaming();
+  void CalculateQuartilesApproximate();
+  void SetUndefinedMeanValues();
+  void ResetCalculatedValues();
+
+  static void SplitRegion( const RegionType& region, std::vector<RegionType>& chunks );
+  static void AddLabelValue( LabelStatistics& statistics, const IndexType& idx, double value, bool storeValue );
+  static void MergeLabelStatistics( LabelStatistics& target, LabelStatistics&& source );
 
 private:
   /** The label to calculate indices for. */
-  LabelType m_CurrentLabel;
+  LabelType m_CurrentLabel{};
+  /** Bit mask of the features to compute */
+  unsigned int m_RequestedFeatures{ AllFeatures };
 
   /** The maximum segmented value.  */
   double m_MaximumValue;
@@ -134,10 +240,39 @@ private:
   /** SAM mean background. */
   double m_SAMBackground;
 
+  /** Bounding box of the current label */
+  RegionType m_LabelRegion;
+  /** Flag indicating if the bounding box of the label is known */
+  bool m_LabelRegionComputed{ false };
+
+  /** Number of segmented voxels found while streaming */
+  SizeValueType m_SegmentedVoxelCount{ 0 };
+  /** Sum of the segmented values found while streaming */
+  double m_SegmentedValueSum{ 0.0 };
+  /** Flag indicating if the streamed moments have been accumulated */
+  bool m_MomentsAccumulated{ false };
+  /** Set to true to avoid storing the list of segmented values when possible */
+  bool m_UseStreamingMoments{ false };
+  /** Set to true to approximate the quartiles with a histogram */
+  bool m_UseApproximateQuartiles{ false };
+  /** Requested maximum absolute error of the approximate quartiles */
+  double m_QuartileErrorBound{ 0.001 };
+  /** Achieved maximum absolute error of the quartiles */
+  double m_AchievedQuartileErrorBound{ 0.0 };
+  /** Directory of the on-disk peak kernel cache */
+  std::string m_PeakKernelCacheDirectory;
+
+  /** Flags indicating which results have already been calculated */
+  bool m_MomentsCalculated{ false };
+  bool m_QuarterBinsCalculated{ false };
+  bool m_QuartilesCalculated{ false };
+  bool m_SAMCalculated{ false };
+  bool m_PeakCalculated{ false };
+
   /** Flag indicating if list has been generated */
   bool m_ListGenerated{ false };
   /** List of values in region of interest */
-  std::vector<double> m_SegmentedValues;
+  ValueListType m_SegmentedValues;
 };
 
 } // end namespace itk
@@ -24,17 +24,42 @@ class PETVolumeSegmentStatisticsPlugin(SegmentStatisticsPluginBase):
         'peak':'Peak'}
   
   def createLabelNodeFromSegment(self, segmentationNode, segmentID, grayscaleNode):
-    import vtkSegmentationCorePython as vtkSegmentationCore    
-    # see https://github.com/QIICR/QuantitativeReporting/blob/master/QuantitativeReporting.py#L847
-    labelNode = slicer.vtkMRMLLabelMapVolumeNode()
-    
-    segmentationsLogic = slicer.modules.segmentations.logic()
-    labelMap = slicer.vtkOrientedImageData()
-    segmentationNode.GetBinaryLabelmapRepresentation(segmentID, labelMap)
-    if not segmentationsLogic.CreateLabelmapVolumeFromOrientedImageData(labelMap, labelNode):
-      return None
-    labelNode.SetName("{}_label".format(segmentID))
-    return labelNode
+    """Label map of the segment on the grid of grayscaleNode, in the scratch node of
+    QuantitativeIndicesToolLogic that is not in the scene. None if the segment is empty."""
+    from QuantitativeIndicesTool import QuantitativeIndicesToolLogic
+    return QuantitativeIndicesToolLogic().exportSegmentsToLabelmap(grayscaleNode, segmentationNode, [segmentID])
+
+  def getBatchSegmentIDs(self, segmentationNode, segmentID):
+    """Segments to compute together with segmentID. SegmentStatisticsLogic computes the
+    statistics of the segments one by one, in the order of getSegmentIDs (or of the
+    visible ones); when segmentID is the first of its labelmap layer in that order, a
+    pass over all segments is starting and the segments of that layer are returned.
+    Segments of the same layer do not overlap, so they can share one label map."""
+    segmentIds = vtk.vtkStringArray()
+    displayNode = segmentationNode.GetDisplayNode()
+    if self.getParameterNode().GetParameter('visibleSegmentsOnly') == 'True' and displayNode:
+      displayNode.GetVisibleSegmentIDs(segmentIds)
+    else:
+      segmentationNode.GetSegmentation().GetSegmentIDs(segmentIds)
+    segmentation = segmentationNode.GetSegmentation()
+    layer = segmentation.GetLayerIndex(segmentID)
+    layerSegmentIDs = [segmentIds.GetValue(i) for i in range(segmentIds.GetNumberOfValues())
+                       if segmentation.GetLayerIndex(segmentIds.GetValue(i)) == layer]
+    if not layerSegmentIDs or layerSegmentIDs[0] != segmentID:
+      return [segmentID]
+    return layerSegmentIDs
+
+  def computeBatch(self, logic, grayscaleNode, segmentationNode, segmentIDs, features):
+    """Compute the features of several segments with one label map export and one CLI
+    run, and cache them for the following computeStatistics calls. Returns the values
+    by segment ID of the segments that are not empty."""
+    results = {}
+    for segmentID, values in logic.runOnSegments(grayscaleNode, segmentationNode, segmentIDs, features).items():
+      if not any(value == value for value in values.values()): # all NaN: empty segment
+        continue
+      logic.resultCache.put(logic.getResultCacheKey(grayscaleNode, segmentationNode, segmentID, features), values)
+      results[segmentID] = values
+    return results
 
   def computeStatistics(self, segmentID):
     import vtkSegmentationCorePython as vtkSegmentationCore
@@ -53,35 +78,34 @@ class PETVolumeSegmentStatisticsPlugin(SegmentStatisticsPluginBase):
 
     if grayscaleNode is None or grayscaleNode.GetImageData() is None:
       return {}
-    
-    labelNode = self.createLabelNodeFromSegment( segmentationNode, segmentID, grayscaleNode )
-    if not labelNode or not labelNode.GetImageData() or labelNode.GetImageData().GetDimensions()[0]==0: # empty segmentation
-      return {}
-    slicer.mrmlScene.AddNode(labelNode)
-    resultMap = {}
-    try:
+
+    # results of the same volume, segment voxels and features are shared with PET-IndiC
+    from QuantitativeIndicesTool import QuantitativeIndicesToolLogic
+    logic = QuantitativeIndicesToolLogic()
+    features = [self.key2cliFeatureName[key] for key in requestedKeys]
+    cacheKey = logic.getResultCacheKey(grayscaleNode, segmentationNode, segmentID, features)
+    resultMap = logic.resultCache.get(cacheKey)
+    if resultMap is None:
+      batchSegmentIDs = self.getBatchSegmentIDs(segmentationNode, segmentID)
+      if len(batchSegmentIDs) > 1:
+        resultMap = self.computeBatch(logic, grayscaleNode, segmentationNode, batchSegmentIDs, features).get(segmentID)
+    if resultMap is None:
+      labelNode = self.createLabelNodeFromSegment( segmentationNode, segmentID, grayscaleNode )
+      if not labelNode: # empty segmentation
+        return {}
       parameters = {}
       parameters['Grayscale_Image'] = grayscaleNode.GetID()
-      parameters['Label_Image'] = labelNode.GetID()
+      parameters['Label_Image'] = labelNode
       parameters['Label_Value'] = 1
       for key in requestedKeys:
         cliFeatureName = self.key2cliFeatureName[key]
         parameters[cliFeatureName] = 'true'
-        
-      qiModule = slicer.modules.quantitativeindicescli
-      cliNode = None
-      cliNode = slicer.cli.run(qiModule,cliNode,parameters,wait_for_completion=True)
-    
-      for i in range(0,cliNode.GetNumberOfParametersInGroup(3)):
-        newResult = cliNode.GetParameterDefault(3,i)
-        if (newResult != '--'):
-          feature = cliNode.GetParameterName(3,i)
-          feature = feature.replace('_s','')
-          resultMap[feature]=float(newResult)
-      
-    finally:
-      slicer.mrmlScene.RemoveNode(labelNode)
-                          
+
+      cliNode = logic.runWithParameters(parameters)
+      resultMap = logic.getResultsFromNode(cliNode)
+      slicer.mrmlScene.RemoveNode(cliNode)
+      logic.resultCache.put(cacheKey, resultMap)
+
     statistics = {}
     for key in requestedKeys:
       cliFeatureName = self.key2cliFeatureName[key]
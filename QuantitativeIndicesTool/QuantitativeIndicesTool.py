@@ -258,6 +258,11 @@ class QuantitativeIndicesToolWidget(ScriptedLoadableModuleWidget):
     self.calculateButton.enabled = False
     self.featuresFormLayout.addRow(self.calculateButton)
 
+    self.calculateAllButton = qt.QPushButton("Calculate all segments")
+    self.calculateAllButton.toolTip = "Calculate quantitative features for all segments of the segmentation at once."
+    self.calculateAllButton.enabled = False
+    self.featuresFormLayout.addRow(self.calculateAllButton)
+
     #
     # Results Frame
     #
@@ -280,6 +285,7 @@ class QuantitativeIndicesToolWidget(ScriptedLoadableModuleWidget):
 
     # connections
     self.calculateButton.connect('clicked(bool)', self.onCalculateButton)
+    self.calculateAllButton.connect('clicked(bool)', self.onCalculateAllButton)
     self.grayscaleSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.onGrayscaleSelect)
     self.segmentationSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.onSegmentationSelect)
     self.segmentSelector.connect('currentIndexChanged(int)', self.onSegmentSelect)
@@ -320,6 +326,26 @@ class QuantitativeIndicesToolWidget(ScriptedLoadableModuleWidget):
       bool(self.segmentationNode) and
       self.segmentSelector.currentIndex >= 0
     )
+    self.calculateAllButton.enabled = (
+      bool(self.grayscaleNode) and
+      bool(self.segmentationNode) and
+      self.segmentSelector.count > 0
+    )
+
+  def selectedIndices(self):
+    """CLI parameter names of the checked features"""
+    checkBoxes = [('Mean', self.MeanCheckBox), ('Std_Deviation', self.StdDevCheckBox),
+                  ('Min', self.MinCheckBox), ('Max', self.MaxCheckBox), ('RMS', self.RMSCheckBox),
+                  ('Volume', self.VolumeCheckBox), ('First_Quartile', self.Quart1CheckBox),
+                  ('Median', self.MedianCheckBox), ('Third_Quartile', self.Quart3CheckBox),
+                  ('Upper_Adjacent', self.UpperAdjacentCheckBox), ('TLG', self.TLGCheckBox),
+                  ('Glycolysis_Q1', self.Gly1CheckBox), ('Glycolysis_Q2', self.Gly2CheckBox),
+                  ('Glycolysis_Q3', self.Gly3CheckBox), ('Glycolysis_Q4', self.Gly4CheckBox),
+                  ('Q1_Distribution', self.Q1CheckBox), ('Q2_Distribution', self.Q2CheckBox),
+                  ('Q3_Distribution', self.Q3CheckBox), ('Q4_Distribution', self.Q4CheckBox),
+                  ('SAM', self.SAMCheckBox), ('SAM_Background', self.SAMBGCheckBox),
+                  ('Peak', self.PeakCheckBox)]
+    return [name for name, checkBox in checkBoxes if checkBox.checked]
 
   def onSelectAllButton(self):
     self.MeanCheckBox.checked = True
@@ -382,16 +408,6 @@ class QuantitativeIndicesToolWidget(ScriptedLoadableModuleWidget):
       return False
     return True
 
-  def _exportSegmentToLabelMap(self, segmentationNode, segmentID, referenceVolumeNode):
-    """Export a single segment to a temporary label map volume (label value = 1)."""
-    labelNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'temp_qi_label')
-    segmentIds = vtk.vtkStringArray()
-    segmentIds.InsertNextValue(segmentID)
-    slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(
-        segmentationNode, segmentIds, labelNode, referenceVolumeNode,
-        slicer.vtkSegmentation.EXTENT_REFERENCE_GEOMETRY)
-    return labelNode
-
   def onCalculateButton(self):
     if not self.volumesAreValid():
       qt.QMessageBox.warning(slicer.util.mainWindow(),
@@ -403,26 +419,48 @@ class QuantitativeIndicesToolWidget(ScriptedLoadableModuleWidget):
     slicer.app.processEvents()
 
     segmentID = self.segmentSelector.currentData
-    labelNode = self._exportSegmentToLabelMap(self.segmentationNode, segmentID, self.grayscaleNode)
-    try:
-      newNode = self.logic.run(self.grayscaleNode, labelNode, None, 1,
-                          self.MeanCheckBox.checked, self.StdDevCheckBox.checked,
-                          self.MinCheckBox.checked, self.MaxCheckBox.checked,
-                          self.Quart1CheckBox.checked, self.MedianCheckBox.checked,
-                          self.Quart3CheckBox.checked, self.UpperAdjacentCheckBox.checked,
-                          self.Q1CheckBox.checked, self.Q2CheckBox.checked,
-                          self.Q3CheckBox.checked, self.Q4CheckBox.checked,
-                          self.Gly1CheckBox.checked, self.Gly2CheckBox.checked,
-                          self.Gly3CheckBox.checked, self.Gly4CheckBox.checked,
-                          self.TLGCheckBox.checked, self.SAMCheckBox.checked,
-                          self.SAMBGCheckBox.checked, self.RMSCheckBox.checked,
-                          self.PeakCheckBox.checked, self.VolumeCheckBox.checked)
-    finally:
-      slicer.mrmlScene.RemoveNode(labelNode)
+    labelNode = self.logic.exportSegmentsToLabelmap(self.grayscaleNode, self.segmentationNode, [segmentID])
+    if not labelNode:
+      self.calculateButton.text = "Calculate"
+      qt.QMessageBox.warning(slicer.util.mainWindow(),
+          "Quantitative Indices", "The selected segment is empty.")
+      return
+    newNode = self.logic.run(self.grayscaleNode, labelNode, None, 1,
+                        self.MeanCheckBox.checked, self.StdDevCheckBox.checked,
+                        self.MinCheckBox.checked, self.MaxCheckBox.checked,
+                        self.Quart1CheckBox.checked, self.MedianCheckBox.checked,
+                        self.Quart3CheckBox.checked, self.UpperAdjacentCheckBox.checked,
+                        self.Q1CheckBox.checked, self.Q2CheckBox.checked,
+                        self.Q3CheckBox.checked, self.Q4CheckBox.checked,
+                        self.Gly1CheckBox.checked, self.Gly2CheckBox.checked,
+                        self.Gly3CheckBox.checked, self.Gly4CheckBox.checked,
+                        self.TLGCheckBox.checked, self.SAMCheckBox.checked,
+                        self.SAMBGCheckBox.checked, self.RMSCheckBox.checked,
+                        self.PeakCheckBox.checked, self.VolumeCheckBox.checked)
 
     self.writeResults(newNode)
     self.calculateButton.text = "Calculate"
 
+  def onCalculateAllButton(self):
+    if not self.grayscaleNode or not self.grayscaleNode.GetImageData() or not self.segmentationNode:
+      qt.QMessageBox.warning(slicer.util.mainWindow(),
+          "Quantitative Indices", "Please select a valid volume and segmentation.")
+      return
+
+    self.calculateAllButton.text = "Working..."
+    self.calculateAllButton.repaint()
+    slicer.app.processEvents()
+
+    if not self.tableNode:
+      self.tableNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode','Quantitative Indices Table')
+    segmentIDs = [self.segmentSelector.itemData(i) for i in range(self.segmentSelector.count)]
+    try:
+      self.logic.runOnSegments(self.grayscaleNode, self.segmentationNode, segmentIDs,
+                               self.selectedIndices(), self.tableNode)
+    finally:
+      self.calculateAllButton.text = "Calculate all segments"
+    self.setMeasurementsTable(self.tableNode)
+
   def writeResults(self, cliNode):
     """Read CLI output and populate the results table."""
     if not self.tableNode:
@@ -458,14 +496,860 @@ class QuantitativeIndicesToolWidget(ScriptedLoadableModuleWidget):
     self.software_version = cliNode.GetParameterDefault(0, 0)
     slicer.mrmlScene.RemoveNode(cliNode)
 
+#
+# QuantitativeIndicesServer
+#
+
+class QuantitativeIndicesServer(object):
+  """Client of QuantitativeIndicesCLI running in server mode. The server keeps the
+  grayscale volumes and peak kernels loaded between calculations, so only the label
+  map is written for each one. A grayscale volume is only written again when it
+  has been modified. The server keeps the most recently used volumes and
+  releases those whose file was deleted."""
+
+  def __init__(self, executable):
+    self.executable = executable
+    self.process = None
+    self.parameters = {}
+    self.volumeFiles = {}
+    self.tempDir = os.path.join(slicer.app.temporaryPath, 'QuantitativeIndicesServer')
+
+  def start(self):
+    """Start the server, returns False if it cannot run"""
+    import subprocess
+    import xml.etree.ElementTree as ElementTree
+    try:
+      description = subprocess.check_output([self.executable, '--xml'], universal_newlines=True)
+      self.parameters = self._parseParameters(ElementTree.fromstring(description.strip()))
+      if not os.path.exists(self.tempDir):
+        os.makedirs(self.tempDir)
+      self.process = subprocess.Popen([self.executable, '--server'], stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                      universal_newlines=True, bufsize=1)
+      if not self.process.stdout.readline().startswith('QI_SERVER_READY'):
+        self.stop()
+        return False
+    except (OSError, subprocess.CalledProcessError, ElementTree.ParseError) as e:
+      print('Quantitative indices server could not be started: ' + str(e))
+      self.stop()
+      return False
+    return True
+
+  def stop(self):
+    if self.process:
+      try:
+        self.process.stdin.write('QUIT\n')
+        self.process.stdin.flush()
+        self.process.wait(5)
+      except Exception:
+        self.process.kill()
+    self.process = None
+    for fileName in [f for (t, f) in self.volumeFiles.values()]:
+      if os.path.exists(fileName):
+        os.remove(fileName)
+    self.volumeFiles = {}
+
+  def isRunning(self):
+    return self.process is not None and self.process.poll() is None
+
+  def run(self, cliNode, parameters):
+    """Run one calculation and store its parameters and results in cliNode, as
+    slicer.cli.run would. Returns False if the calculation failed."""
+    try:
+      arguments = self._arguments(parameters)
+      self.process.stdin.write('\t'.join(arguments) + '\n')
+      self.process.stdin.flush()
+      results = {}
+      while True:
+        line = self.process.stdout.readline()
+        if not line:
+          raise IOError('the server stopped')
+        line = line.rstrip('\n')
+        if line.startswith('QI_END'):
+          status = int(line.split()[1])
+          break
+        name, separator, value = line.partition(' = ')
+        if separator:
+          results[name.strip()] = value.strip()
+    except (IOError, OSError, ValueError) as e:
+      print('Quantitative indices server failed: ' + str(e))
+      self.stop()
+      return False
+    if status != 0:
+      return False
+    for name, value in parameters.items():
+      if isinstance(value, slicer.vtkMRMLNode):
+        value = value.GetID() or ''
+      cliNode.SetParameterAsString(name, str(value))
+    for name, value in results.items():
+      cliNode.SetParameterAsString(name, value)
+    cliNode.SetStatus(cliNode.Completed)
+    return True
+
+  def _parseParameters(self, description):
+    """Flags of the CLI parameters by name, from its XML description"""
+    parameters = {}
+    for group in description.iter('parameters'):
+      for element in group:
+        name = element.findtext('name')
+        if not name or element.findtext('channel') == 'output':
+          continue
+        flag = None
+        if element.findtext('longflag'):
+          flag = '--' + element.findtext('longflag').strip().lstrip('-')
+        elif element.findtext('flag'):
+          flag = '-' + element.findtext('flag').strip().lstrip('-')
+        index = element.findtext('index')
+        parameters[name] = {'type': element.tag, 'flag': flag,
+                            'index': int(index) if index is not None else None}
+    return parameters
+
+  def _arguments(self, parameters):
+    """Command line arguments of a calculation"""
+    arguments = []
+    indexed = {}
+    for name, value in parameters.items():
+      parameter = self.parameters.get(name)
+      if parameter is None:
+        raise ValueError('unknown parameter ' + name)
+      if parameter['type'] == 'image':
+        value = self._volumeFile(value)
+      elif parameter['type'] == 'boolean':
+        if str(value).lower() == 'true':
+          arguments.append(parameter['flag'])
+        continue
+      if parameter['index'] is not None:
+        indexed[parameter['index']] = str(value)
+      else:
+        arguments += [parameter['flag'], str(value)]
+    return arguments + [indexed[index] for index in sorted(indexed)]
+
+  def _volumeFile(self, nodeID):
+    """Write the volume to a file the server can read. Label maps are written
+    every time; other volumes only when they were modified, to a file named by
+    the node and its modification counter. The previous file of a volume, and
+    the files of volumes no longer in the scene, are deleted, which makes the
+    server release their images."""
+    node = slicer.mrmlScene.GetNodeByID(nodeID) if isinstance(nodeID, str) else nodeID
+    if not node or not node.GetImageData():
+      raise ValueError('no image data in ' + str(nodeID))
+    for removedID in [i for i in self.volumeFiles if not slicer.mrmlScene.GetNodeByID(i)]:
+      if os.path.exists(self.volumeFiles[removedID][1]):
+        os.remove(self.volumeFiles[removedID][1])
+      del self.volumeFiles[removedID]
+    if node.IsA('vtkMRMLLabelMapVolumeNode'):
+      fileName = os.path.join(self.tempDir, 'label.nrrd')
+    else:
+      modifiedTime = max(node.GetMTime(), node.GetImageData().GetMTime())
+      previous = self.volumeFiles.get(node.GetID())
+      if previous and previous[0] == modifiedTime:
+        return previous[1]
+      if previous and os.path.exists(previous[1]):
+        os.remove(previous[1])
+      fileName = os.path.join(self.tempDir, '{0}_{1}.nrrd'.format(node.GetID(), modifiedTime))
+      self.volumeFiles[node.GetID()] = (modifiedTime, fileName)
+    storageNode = slicer.vtkMRMLVolumeArchetypeStorageNode()
+    storageNode.SetFileName(fileName)
+    storageNode.SetUseCompression(0)
+    if not storageNode.WriteData(node):
+      raise IOError('could not write ' + fileName)
+    return fileName
+
+#
+# QuantitativeIndicesNumPyEngine
+#
+
+class QuantitativeIndicesNumPyEngine(object):
+  """Computes the indices of QuantitativeIndicesCLI with NumPy, directly on the
+  voxel array of the grayscale volume and the labelmap array of a segment, with
+  the definitions of the CLI. No process is started and nothing is written to
+  disk. The label array covers part of the grid of the image, starting at
+  labelStart, and is cropped to its non-zero voxels before anything is computed."""
+
+  # names of the CLI parameters of the indices, in the order of the CLI flags
+  indexNames = ['Mean', 'Std_Deviation', 'Min', 'Max', 'RMS', 'Volume',
+                'First_Quartile', 'Median', 'Third_Quartile', 'Upper_Adjacent',
+                'TLG', 'Glycolysis_Q1', 'Glycolysis_Q2', 'Glycolysis_Q3', 'Glycolysis_Q4',
+                'Q1_Distribution', 'Q2_Distribution', 'Q3_Distribution', 'Q4_Distribution',
+                'SAM', 'SAM_Background', 'Peak']
+  # the same names in the order of the CLI outputs
+  outputNames = ['Mean', 'Min', 'Max', 'Peak', 'Volume', 'TLG', 'Std_Deviation',
+                 'First_Quartile', 'Median', 'Third_Quartile', 'Upper_Adjacent', 'RMS',
+                 'Glycolysis_Q1', 'Glycolysis_Q2', 'Glycolysis_Q3', 'Glycolysis_Q4',
+                 'Q1_Distribution', 'Q2_Distribution', 'Q3_Distribution', 'Q4_Distribution',
+                 'SAM', 'SAM_Background']
+
+  # volume of the peak sphere in mm^3, and the radius of the SAM shell in voxels
+  peakSphereVolume = 1000.0
+  samRadius = 2
+
+  # normalized peak kernels by voxel spacing
+  peakKernels = {}
+
+  @classmethod
+  def compute(cls, imageArray, spacing, labelArray, labelStart=(0, 0, 0), indices=None):
+    """Indices of the non-zero voxels of labelArray as a dict by CLI parameter
+    name, in the units the CLI reports them in. imageArray and labelArray are
+    indexed (k, j, i) as returned by slicer.util.arrayFromVolume, spacing is
+    (x, y, z) and labelStart is the (k, j, i) index of the first voxel of
+    labelArray. All indices are computed if indices is None."""
+    import numpy as np
+    indices = cls.indexNames if indices is None else [name for name in cls.indexNames if name in indices]
+    results = dict((name, float('nan')) for name in indices)
+
+    mask, lower = cls.cropMask(labelArray, labelStart)
+    if mask is None:
+      return results
+
+    valueType = cls.valueType(imageArray)
+    box = tuple(slice(l, l + s) for l, s in zip(lower, mask.shape))
+    values = imageArray[box][mask].astype(valueType).astype(np.float64)
+    spacingKJI = [float(s) for s in reversed(spacing)]
+    voxelVolume = spacingKJI[0]*spacingKJI[1]*spacingKJI[2]
+    count = values.size
+    total = values.sum()
+    mean = total/count
+
+    if 'Mean' in results:
+      results['Mean'] = mean
+    if 'Std_Deviation' in results:
+      results['Std_Deviation'] = np.sqrt(np.mean((values - mean)**2))
+    if 'RMS' in results:
+      results['RMS'] = np.sqrt(np.dot(values, values)/count)
+    minimum = values.min()
+    maximum = values.max()
+    if 'Min' in results:
+      results['Min'] = minimum
+    if 'Max' in results:
+      results['Max'] = maximum
+    if 'Volume' in results:
+      results['Volume'] = 0.001*count*voxelVolume
+    if 'TLG' in results:
+      results['TLG'] = 0.001*total*voxelVolume
+
+    # quarter bins of the range, with the bounds of the CLI
+    binNames = [('Glycolysis_Q%d' % (q+1), 'Q%d_Distribution' % (q+1)) for q in range(4)]
+    if any(name in results for names in binNames for name in names):
+      binCounts, binSums = cls._quarterBins(values, minimum, maximum)
+      for q, (glycolysisName, distributionName) in enumerate(binNames):
+        if glycolysisName in results:
+          results[glycolysisName] = 0.001*binSums[q]*voxelVolume
+        if distributionName in results:
+          results[distributionName] = 100.0*binCounts[q]/count
+
+    quartileNames = ['First_Quartile', 'Median', 'Third_Quartile', 'Upper_Adjacent']
+    if any(name in results for name in quartileNames):
+      results.update((name, value) for name, value in zip(quartileNames, cls._quartiles(values)) if name in results)
+
+    if 'SAM' in results or 'SAM_Background' in results:
+      r = cls.samRadius
+      shellSum, shellCount = cls.shellSum(imageArray, valueType, mask, lower,
+                                          [max(0, l - r) for l in lower],
+                                          [min(n, l + s + r) for l, s, n in zip(lower, mask.shape, imageArray.shape)])
+      background = shellSum/shellCount if shellCount else float('nan')
+      if 'SAM_Background' in results:
+        results['SAM_Background'] = background
+      if 'SAM' in results:
+        results['SAM'] = 0.001*(mean - background)*count*voxelVolume
+
+    if 'Peak' in results:
+      peaks = cls.placementPeaks(imageArray, valueType, spacingKJI, mask, lower,
+                                 lower, [l + s for l, s in zip(lower, mask.shape)])
+      results['Peak'] = cls.bestPeak(peaks)
+
+    return dict((name, float(value)) for name, value in results.items())
+
+  @staticmethod
+  def cropMask(labelArray, labelStart=(0, 0, 0)):
+    """Non-zero voxels of labelArray as a boolean array cropped to their bounding
+    box, and the (k, j, i) index of its first voxel. (None, None) if there are none."""
+    import numpy as np
+    mask = np.asarray(labelArray) != 0
+    lower = []
+    upper = []
+    for axis in range(3):
+      otherAxes = tuple(a for a in range(3) if a != axis)
+      present = np.flatnonzero(mask.any(axis=otherAxes))
+      if present.size == 0:
+        return None, None
+      lower.append(int(labelStart[axis]) + int(present[0]))
+      upper.append(int(labelStart[axis]) + int(present[-1]) + 1)
+    mask = mask[tuple(slice(l - int(s), u - int(s)) for l, u, s in zip(lower, upper, labelStart))]
+    return mask, lower
+
+  @staticmethod
+  def valueType(imageArray):
+    """Type the CLI reads the image as: float, unless it is stored as double"""
+    import numpy as np
+    return np.float64 if imageArray.dtype == np.float64 else np.float32
+
+  @staticmethod
+  def _quarterBins(values, minimum, maximum):
+    """Number and sum of the values in each quarter of [minimum, maximum], with
+    the bounds of the CLI: the first bin is closed, the others open below"""
+    import numpy as np
+    binSize = (maximum - minimum)*0.25
+    counts = np.zeros(4, dtype=np.int64)
+    sums = np.zeros(4)
+    for q in range(4):
+      if q == 0:
+        inBin = (values >= minimum) & (values <= minimum + binSize)
+      else:
+        inBin = (values > minimum + q*binSize) & (values <= minimum + (q+1)*binSize)
+      counts[q] = np.count_nonzero(inBin)
+      sums[q] = values[inBin].sum()
+    return counts, sums
+
+  @staticmethod
+  def _quartiles(values, isSorted=False):
+    """First quartile, median, third quartile and upper adjacent value, selecting
+    only the order statistics they need unless values is already sorted"""
+    import numpy as np
+    n = values.size
+    if isSorted:
+      ordered = values
+    else:
+      ranks = set([n//2, n//4, n*3//4])
+      if n % 2 == 0:
+        ranks.add(n//2 - 1)
+      if n % 4 == 0:
+        ranks.update([n//4 - 1, n*3//4 - 1])
+      ranks = sorted(r for r in ranks if r >= 0)
+      ordered = np.partition(values, ranks)
+    middle = lambda lowerRank: (ordered[lowerRank] + ordered[lowerRank + 1])*0.5
+    median = middle(n//2 - 1) if n % 2 == 0 else ordered[n//2]
+    if n % 4 == 0:
+      firstQuartile = middle(n//4 - 1)
+      thirdQuartile = middle(n*3//4 - 1)
+    else:
+      firstQuartile = ordered[n//4]
+      thirdQuartile = ordered[n*3//4]
+    # largest value below Q3+1.5*IQR
+    iqr = thirdQuartile - firstQuartile
+    if iqr == 0:
+      upperAdjacent = ordered[-1] if isSorted else values.max()
+    elif isSorted:
+      upperAdjacent = ordered[np.searchsorted(ordered, thirdQuartile + 1.5*iqr) - 1]
+    else:
+      upperAdjacent = values[values < thirdQuartile + 1.5*iqr].max()
+    return firstQuartile, median, thirdQuartile, upperAdjacent
+
+  @staticmethod
+  def _maskRegion(mask, maskLower, lower, upper):
+    """mask, whose first voxel is at maskLower, on the region [lower, upper) of
+    the image grid; false outside of it"""
+    import numpy as np
+    region = np.zeros([u - l for l, u in zip(lower, upper)], dtype=bool)
+    source = []
+    target = []
+    for axis in range(3):
+      first = max(lower[axis], maskLower[axis])
+      last = min(upper[axis], maskLower[axis] + mask.shape[axis])
+      if first >= last:
+        return region
+      source.append(slice(first - maskLower[axis], last - maskLower[axis]))
+      target.append(slice(first - lower[axis], last - lower[axis]))
+    region[tuple(target)] = mask[tuple(source)]
+    return region
+
+  @classmethod
+  def shellSum(cls, imageArray, valueType, mask, maskLower, lower, upper):
+    """Sum and number of the voxels of the SAM shell in the region [lower, upper)
+    of the image: the voxels a ball dilation adds to the mask"""
+    import numpy as np
+    r = cls.samRadius
+    # the ball of itk::BinaryBallStructuringElement: |offset| <= r + 0.5
+    grid = np.arange(-r, r + 1)
+    offsets = [(k, j, i) for k in grid for j in grid for i in grid if k*k + j*j + i*i <= (r + 0.5)**2]
+    padded = cls._maskRegion(mask, maskLower, [l - r for l in lower], [u + r for u in upper])
+    shape = [u - l for l, u in zip(lower, upper)]
+    shell = np.zeros(shape, dtype=bool)
+    for k, j, i in offsets:
+      shell |= padded[r + k:r + k + shape[0], r + j:r + j + shape[1], r + i:r + i + shape[2]]
+    shell &= ~padded[r:r + shape[0], r:r + shape[1], r:r + shape[2]]
+    image = imageArray[tuple(slice(l, u) for l, u in zip(lower, upper))]
+    shellValues = image[shell].astype(valueType).astype(np.float64)
+    return shellValues.sum(), shellValues.size
+
+  @classmethod
+  def placementPeaks(cls, imageArray, valueType, spacingKJI, mask, maskLower, lower, upper):
+    """Mean of the image in a 1 cc sphere placed on each voxel of the region
+    [lower, upper), as in itkPeakIntensityFilter. NaN where the voxel is not in
+    the mask or the sphere does not lie entirely inside the image and the mask."""
+    import numpy as np
+    kernel = cls.getPeakKernel(spacingKJI)
+    sphereRadius = (cls.peakSphereVolume*0.75/np.pi)**(1.0/3.0)
+    radius = [(s - 1)//2 for s in kernel.shape]
+    footprint = kernel > 0
+    shape = [u - l for l, u in zip(lower, upper)]
+    peaks = np.full(shape, np.nan)
+
+    # the kernel reaches past the region by its radius; the image is extended
+    # by repeating its edge voxels and the mask is taken as foreground outside
+    # the image
+    regionLower = [l - r for l, r in zip(lower, radius)]
+    regionUpper = [u + r for u, r in zip(upper, radius)]
+    region = [np.arange(l, u) for l, u in zip(regionLower, regionUpper)]
+    label = cls._maskRegion(mask, maskLower, regionLower, regionUpper).astype(np.float64)
+    outside = [(c < 0) | (c >= n) for c, n in zip(region, imageArray.shape)]
+    label[outside[0], :, :] = 1
+    label[:, outside[1], :] = 1
+    label[:, :, outside[2]] = 1
+
+    # valid placements: the sphere fits in the image and the mask
+    valid = label[tuple(slice(r, r + s) for r, s in zip(radius, shape))] > 0
+    for axis, (l, u) in enumerate(zip(lower, upper)):
+      position = (np.arange(l, u) + 0.5)*spacingKJI[axis]
+      fits = (position - sphereRadius >= 0) & (position + sphereRadius < imageArray.shape[axis]*spacingKJI[axis])
+      valid &= fits.reshape([-1 if a == axis else 1 for a in range(3)])
+    if valid.any():
+      coverage = cls._convolve(label, footprint.astype(np.float64))
+      valid &= coverage > np.count_nonzero(footprint) - 0.5
+    if not valid.any():
+      return peaks
+
+    image = imageArray[np.ix_(*[np.clip(c, 0, n - 1) for c, n in zip(region, imageArray.shape)])]
+    image = image.astype(valueType).astype(np.float64)
+    peaks[valid] = cls._convolve(image, kernel)[valid]
+    return peaks
+
+  @staticmethod
+  def bestPeak(peaks):
+    """Peak of the segment from the placements of placementPeaks: the largest
+    value in single precision, as compared by the CLI, taking the value of the
+    first such placement in scan order"""
+    import numpy as np
+    values = peaks[~np.isnan(peaks)]
+    if values.size == 0:
+      return float('nan')
+    keys = values.astype(np.float32)
+    return values[np.flatnonzero(keys == keys.max())[0]]
+
+  @staticmethod
+  def _convolve(array, kernel):
+    """Valid part of the convolution of array with a symmetric kernel, via FFT"""
+    import numpy as np
+    shape = [a + k - 1 for a, k in zip(array.shape, kernel.shape)]
+    spectrum = np.fft.rfftn(array, shape, axes=(0, 1, 2))*np.fft.rfftn(kernel, shape, axes=(0, 1, 2))
+    full = np.fft.irfftn(spectrum, shape, axes=(0, 1, 2))
+    return full[tuple(slice(k - 1, a) for a, k in zip(array.shape, kernel.shape))]
+
+  @classmethod
+  def getPeakKernel(cls, spacingKJI):
+    """Peak kernel for the voxel spacing (k, j, i): the fraction of every voxel
+    inside the 1 cc sphere centered on the middle voxel, normalized to sum to
+    one. The weights are those of itkPeakIntensityFilter::BuildPeakKernel."""
+    import numpy as np
+    key = tuple(float(s) for s in spacingKJI)
+    if key in cls.peakKernels:
+      return cls.peakKernels[key]
+    r = (cls.peakSphereVolume*0.75/np.pi)**(1.0/3.0)
+    # weights of one octant, from the center voxel outwards
+    octantSize = [int(np.ceil(r/s)) + 1 for s in key]
+    octant = np.zeros(octantSize)
+    for k in range(octantSize[0]):
+      for j in range(octantSize[1]):
+        for i in range(octantSize[2]):
+          octant[k, j, i] = cls._voxelVolume(r, i*key[2], j*key[1], k*key[0], key[2], key[1], key[0])
+    # mirror the octant; the center voxels were only half computed in each axis
+    kernelRadius = [int(np.ceil(r/s - 0.5)) for s in key]
+    index = [np.abs(np.arange(-kr, kr + 1)) for kr in kernelRadius]
+    kernel = octant[np.ix_(*index)]
+    for axis, axisIndex in enumerate(index):
+      kernel *= np.where(axisIndex == 0, 2.0, 1.0).reshape([-1 if a == axis else 1 for a in range(3)])
+    kernel /= kernel.sum()
+    cls.peakKernels[key] = kernel
+    return kernel
+
+  @classmethod
+  def _voxelVolume(cls, r, x, y, z, spx, spy, spz):
+    """Fraction of the voxel centered at (x, y, z) inside the sphere of radius r
+    centered at the origin, counting only the part in the positive octant"""
+    import math
+    corners = [(x-0.5*spx, y-0.5*spy, z-0.5*spz), (x+0.5*spx, y-0.5*spy, z-0.5*spz),
+               (x-0.5*spx, y+0.5*spy, z-0.5*spz), (x-0.5*spx, y-0.5*spy, z+0.5*spz),
+               (x+0.5*spx, y-0.5*spy, z+0.5*spz), (x-0.5*spx, y+0.5*spy, z+0.5*spz),
+               (x+0.5*spx, y+0.5*spy, z-0.5*spz), (x+0.5*spx, y+0.5*spy, z+0.5*spz)]
+    corners = [[max(c, 0.0) for c in corner] for corner in corners]
+    if sum(c*c for c in corners[0]) >= r*r:
+      return 0.0
+    sphereVolume = (4*math.pi/3)*r**3
+    v = [cls._fCorner(r, a, b, c)*sphereVolume for a, b, c in corners]
+    return (v[0]-v[1]-v[2]-v[3]+v[4]+v[5]+v[6]-v[7])/(spx*spy*spz)
+
+  @staticmethod
+  def _fEdge(r, a, b):
+    """Volume fraction of a sphere intersecting two faces and an edge of a box"""
+    import math
+    if a*a + b*b >= r*r:
+      return 0.0
+    if a == 0 and b == 0:
+      return 0.25
+    ahat = a/r
+    bhat = b/r
+    xhat = math.sqrt(1 - ahat**2 - bhat**2)
+    # atan2(p, q) is atan(p/q) for q >= 0, including q == 0
+    return (1/(4*math.pi))*(2*ahat*bhat*xhat + 2*math.atan2(bhat*xhat, ahat)
+                            + 2*math.atan2(ahat*xhat, bhat)
+                            - (3*bhat - bhat**3)*math.atan2(xhat, ahat)
+                            - (3*ahat - ahat**3)*math.atan2(xhat, bhat))
+
+  @classmethod
+  def _fCorner(cls, r, a, b, c):
+    """Volume fraction of a sphere intersecting three faces and a corner of a box"""
+    import math
+    if a*a + b*b + c*c >= r*r:
+      return 0.0
+    if a == 0 and b == 0 and c == 0:
+      return 0.125
+    fEdge = cls._fEdge(r, a, b)
+    ahat = a/r
+    bhat = b/r
+    chat = c/r
+    Ahat = math.sqrt(1 - ahat**2 - chat**2)
+    Bhat = math.sqrt(1 - bhat**2 - chat**2)
+    return 0.5*fEdge - 0.125*(1/math.pi)*(6*ahat*bhat*chat - 2*ahat*Ahat*chat
+                                          - 2*bhat*Bhat*chat
+                                          - (3*bhat - bhat**3)*math.atan2(chat, Bhat)
+                                          - (3*ahat - ahat**3)*math.atan2(chat, Ahat)
+                                          + (3*chat - chat**3)*(math.atan2(Ahat, ahat) - math.atan2(bhat, Bhat))
+                                          + 2*(math.atan2(chat*ahat, Ahat) + math.atan2(chat*bhat, Bhat)))
+
+class QuantitativeIndicesIncrementalEngine(object):
+  """Keeps the indices of segments up to date while they are edited, with the
+  definitions of QuantitativeIndicesNumPyEngine. For every segment it keeps the
+  mask and mergeable accumulators of its voxels: count, sum, mean and sum of
+  squared deviations (merged with Chan's formulas, like the running M2 of the
+  CLI), the sorted values (minimum, maximum and quartiles), count and sum of the
+  quarter bins, sum and count of the SAM shell and the peak of every sphere
+  placement. An update compares the new mask to the kept one and only adds and
+  removes the voxels that changed; the SAM shell and the placements are only
+  recomputed around them. The state of a segment is rebuilt when the image
+  changed or when most of the segment changed, and the quarter bins are
+  recomputed when the minimum or maximum changed. Only the states of the
+  segments updated most recently are kept.
+
+  A build, and the first SAM shell or peaks of a state, process the whole
+  bounding box of the segment. Interactive callers can limit the work done in
+  their thread (see update) and calculate the indices otherwise when it would
+  be exceeded."""
+
+  # share of the segment voxels that may change before the state is rebuilt
+  maximumChangedFraction = 0.5
+  # voxels of the bounding box (of the segment, or of the changed voxels for an
+  # update) processed when the work is limited
+  maximumLimitedVoxels = 64**3
+  # number of segments whose state is kept
+  maximumNumberOfStates = 8
+
+  def __init__(self):
+    import collections
+    self.states = collections.OrderedDict()
+
+  def reset(self, key=None):
+    """Forget the state of a segment, or of all segments if key is None"""
+    if key is None:
+      self.states.clear()
+    else:
+      self.states.pop(key, None)
+
+  def resetNode(self, nodeID, segmentID=None):
+    """Forget the states of the segments of a volume or segmentation node, or
+    only those of segmentID"""
+    for key in [key for key in self.states if nodeID in key[:2] and segmentID in (None, key[2])]:
+      del self.states[key]
+
+  def update(self, key, imageArray, spacing, labelArray, labelStart=(0, 0, 0), indices=None, imageModifiedTime=None,
+             limitWork=False):
+    """Indices of the non-zero voxels of labelArray as returned by
+    QuantitativeIndicesNumPyEngine.compute, updating the state kept under key
+    (e.g. the IDs of the volume and segment). imageModifiedTime identifies the
+    content of imageArray, the state is rebuilt when it changes. With limitWork,
+    None is returned instead when more than maximumLimitedVoxels would be
+    processed: when the state has to be built or rebuilt, when the SAM shell or
+    peaks are asked for the first time, or when the changed voxels span more."""
+    engine = QuantitativeIndicesNumPyEngine
+    indices = engine.indexNames if indices is None else [name for name in engine.indexNames if name in indices]
+    mask, lower = engine.cropMask(labelArray, labelStart)
+    image = (imageModifiedTime, imageArray.shape, imageArray.dtype.str, tuple(float(s) for s in spacing))
+    state = self.states.get(key)
+    if mask is None:
+      self.states.pop(key, None)
+      return dict((name, float('nan')) for name in indices)
+    maximumVoxels = self.maximumLimitedVoxels if limitWork else None
+    if maximumVoxels is not None and mask.size > maximumVoxels and (
+        state is None or state['image'] != image or
+        (state['shell'] is None and ('SAM' in indices or 'SAM_Background' in indices)) or
+        (state['peaks'] is None and 'Peak' in indices)):
+      return None
+    if state is None or state['image'] != image:
+      state = self._build(imageArray, image, mask, lower)
+    else:
+      state = self._update(state, imageArray, mask, lower, maximumVoxels)
+      if state is None:
+        return None
+    self.states[key] = state
+    self.states.move_to_end(key)
+    while len(self.states) > self.maximumNumberOfStates:
+      self.states.popitem(last=False)
+    return self._results(state, imageArray, indices)
+
+  def _build(self, imageArray, image, mask, lower):
+    """State of a segment computed from all of its voxels"""
+    import numpy as np
+    engine = QuantitativeIndicesNumPyEngine
+    valueType = engine.valueType(imageArray)
+    box = tuple(slice(l, l + s) for l, s in zip(lower, mask.shape))
+    values = np.sort(imageArray[box][mask].astype(valueType).astype(np.float64))
+    mean = values.mean()
+    state = {'image': image, 'valueType': valueType, 'mask': mask, 'lower': lower,
+             'count': values.size, 'sum': values.sum(), 'mean': mean, 'm2': np.dot(values - mean, values - mean),
+             'sortedValues': values, 'shell': None, 'peaks': None}
+    self._updateQuarterBins(state)
+    return state
+
+  def _update(self, state, imageArray, mask, lower, maximumVoxels=None):
+    """State of a segment after its mask changed, from the voxels that changed.
+    Returns None, leaving the state unchanged, if the changed voxels or a
+    rebuild would process more than maximumVoxels."""
+    import numpy as np
+    engine = QuantitativeIndicesNumPyEngine
+    oldMask = state['mask']
+    oldLower = state['lower']
+
+    # the changed voxels, in the bounding box of both masks
+    unionLower = [min(l, o) for l, o in zip(lower, oldLower)]
+    unionUpper = [max(l + s, o + t) for l, s, o, t in zip(lower, mask.shape, oldLower, oldMask.shape)]
+    before = engine._maskRegion(oldMask, oldLower, unionLower, unionUpper)
+    after = engine._maskRegion(mask, lower, unionLower, unionUpper)
+    changed, changedLower = engine.cropMask(before ^ after, unionLower)
+    if changed is None:
+      state['mask'] = mask
+      state['lower'] = lower
+      return state
+    if np.count_nonzero(changed) > self.maximumChangedFraction*max(state['count'], np.count_nonzero(mask)):
+      if maximumVoxels is not None and mask.size > maximumVoxels:
+        return None
+      return self._build(imageArray, state['image'], mask, lower)
+    if maximumVoxels is not None and changed.size > maximumVoxels:
+      return None
+    changedUpper = [l + s for l, s in zip(changedLower, changed.shape)]
+    changedBox = tuple(slice(l - u, l - u + s) for l, u, s in zip(changedLower, unionLower, changed.shape))
+    before = before[changedBox]
+    after = after[changedBox]
+    image = imageArray[tuple(slice(l, u) for l, u in zip(changedLower, changedUpper))]
+    image = image.astype(state['valueType']).astype(np.float64)
+    added = np.sort(image[after & ~before])
+    removed = np.sort(image[before & ~after])
+
+    # moments and order statistics
+    state['count'], state['mean'], state['m2'] = self._removeMoments(state['count'], state['mean'], state['m2'], removed)
+    state['count'], state['mean'], state['m2'] = self._addMoments(state['count'], state['mean'], state['m2'], added)
+    state['sum'] += added.sum() - removed.sum()
+    values = state['sortedValues']
+    if removed.size:
+      # equal values are removed from consecutive positions
+      duplicates = np.arange(removed.size) - np.searchsorted(removed, removed)
+      values = np.delete(values, np.searchsorted(values, removed) + duplicates)
+    if added.size:
+      values = np.insert(values, np.searchsorted(values, added), added)
+    state['sortedValues'] = values
+    if (values[0], values[-1]) != state['range']:
+      self._updateQuarterBins(state)
+    else:
+      addedCounts, addedSums = engine._quarterBins(added, *state['range'])
+      removedCounts, removedSums = engine._quarterBins(removed, *state['range'])
+      state['binCounts'] += addedCounts - removedCounts
+      state['binSums'] += addedSums - removedSums
+
+    # the shell and the placements only change near the changed voxels
+    if state['shell'] is not None:
+      r = engine.samRadius
+      windowLower = [max(0, l - r) for l in changedLower]
+      windowUpper = [min(n, u + r) for u, n in zip(changedUpper, imageArray.shape)]
+      oldSum, oldCount = engine.shellSum(imageArray, state['valueType'], oldMask, oldLower, windowLower, windowUpper)
+      newSum, newCount = engine.shellSum(imageArray, state['valueType'], mask, lower, windowLower, windowUpper)
+      state['shell'] = (state['shell'][0] + newSum - oldSum, state['shell'][1] + newCount - oldCount)
+    if state['peaks'] is not None:
+      spacingKJI = list(reversed(state['image'][3]))
+      radius = [(s - 1)//2 for s in engine.getPeakKernel(spacingKJI).shape]
+      upper = [l + s for l, s in zip(lower, mask.shape)]
+      windowLower = [max(l, c - r) for l, c, r in zip(lower, changedLower, radius)]
+      windowUpper = [min(u, c + r) for u, c, r in zip(upper, changedUpper, radius)]
+      peaks = np.full(mask.shape, np.nan)
+      oldPeaks = state['peaks']
+      overlapLower = [max(l, o) for l, o in zip(lower, oldLower)]
+      overlapUpper = [min(u, o + s) for u, o, s in zip(upper, oldLower, oldPeaks.shape)]
+      if all(l < u for l, u in zip(overlapLower, overlapUpper)):
+        peaks[tuple(slice(l - b, u - b) for l, u, b in zip(overlapLower, overlapUpper, lower))] = \
+          oldPeaks[tuple(slice(l - b, u - b) for l, u, b in zip(overlapLower, overlapUpper, oldLower))]
+      if all(l < u for l, u in zip(windowLower, windowUpper)):
+        peaks[tuple(slice(l - b, u - b) for l, u, b in zip(windowLower, windowUpper, lower))] = \
+          engine.placementPeaks(imageArray, state['valueType'], spacingKJI, mask, lower, windowLower, windowUpper)
+      state['peaks'] = peaks
+
+    state['mask'] = mask
+    state['lower'] = lower
+    return state
+
+  @staticmethod
+  def _addMoments(count, mean, m2, values):
+    """Count, mean and sum of squared deviations after adding values (Chan et al.)"""
+    if values.size == 0:
+      return count, mean, m2
+    valuesMean = values.mean()
+    valuesM2 = ((values - valuesMean)**2).sum()
+    total = count + values.size
+    delta = valuesMean - mean
+    return total, mean + delta*values.size/total, m2 + valuesM2 + delta*delta*count*values.size/total
+
+  @staticmethod
+  def _removeMoments(count, mean, m2, values):
+    """Count, mean and sum of squared deviations after removing values, the
+    inverse of _addMoments"""
+    if values.size == 0:
+      return count, mean, m2
+    remaining = count - values.size
+    if remaining <= 0:
+      return 0, 0.0, 0.0
+    valuesMean = values.mean()
+    valuesM2 = ((values - valuesMean)**2).sum()
+    remainingMean = mean - (valuesMean - mean)*values.size/remaining
+    delta = valuesMean - remainingMean
+    return remaining, remainingMean, max(0.0, m2 - valuesM2 - delta*delta*remaining*values.size/count)
+
+  def _updateQuarterBins(self, state):
+    """Recompute the quarter bins for the range of the sorted values"""
+    values = state['sortedValues']
+    state['range'] = (values[0], values[-1])
+    state['binCounts'], state['binSums'] = QuantitativeIndicesNumPyEngine._quarterBins(values, *state['range'])
+
+  def _results(self, state, imageArray, indices):
+    """Indices of a segment from its state, as returned by QuantitativeIndicesNumPyEngine.compute.
+    The SAM shell and the placements are only computed once they are asked for."""
+    import numpy as np
+    engine = QuantitativeIndicesNumPyEngine
+    results = dict((name, float('nan')) for name in indices)
+    spacingKJI = list(reversed(state['image'][3]))
+    voxelVolume = spacingKJI[0]*spacingKJI[1]*spacingKJI[2]
+    count = state['count']
+    mean = state['sum']/count
+    minimum, maximum = state['range']
+
+    if 'Mean' in results:
+      results['Mean'] = mean
+    if 'Std_Deviation' in results:
+      results['Std_Deviation'] = np.sqrt(state['m2']/count)
+    if 'RMS' in results:
+      results['RMS'] = np.sqrt(state['m2']/count + state['mean']**2)
+    if 'Min' in results:
+      results['Min'] = minimum
+    if 'Max' in results:
+      results['Max'] = maximum
+    if 'Volume' in results:
+      results['Volume'] = 0.001*count*voxelVolume
+    if 'TLG' in results:
+      results['TLG'] = 0.001*state['sum']*voxelVolume
+    for q in range(4):
+      if 'Glycolysis_Q%d' % (q+1) in results:
+        results['Glycolysis_Q%d' % (q+1)] = 0.001*state['binSums'][q]*voxelVolume
+      if 'Q%d_Distribution' % (q+1) in results:
+        results['Q%d_Distribution' % (q+1)] = 100.0*state['binCounts'][q]/count
+
+    quartileNames = ['First_Quartile', 'Median', 'Third_Quartile', 'Upper_Adjacent']
+    if any(name in results for name in quartileNames):
+      quartiles = engine._quartiles(state['sortedValues'], isSorted=True)
+      results.update((name, value) for name, value in zip(quartileNames, quartiles) if name in results)
+
+    mask = state['mask']
+    lower = state['lower']
+    upper = [l + s for l, s in zip(lower, mask.shape)]
+    if 'SAM' in results or 'SAM_Background' in results:
+      if state['shell'] is None:
+        r = engine.samRadius
+        state['shell'] = engine.shellSum(imageArray, state['valueType'], mask, lower,
+                                         [max(0, l - r) for l in lower],
+                                         [min(n, u + r) for u, n in zip(upper, imageArray.shape)])
+      shellSum, shellCount = state['shell']
+      background = shellSum/shellCount if shellCount else float('nan')
+      if 'SAM_Background' in results:
+        results['SAM_Background'] = background
+      if 'SAM' in results:
+        results['SAM'] = 0.001*(mean - background)*count*voxelVolume
+
+    if 'Peak' in results:
+      if state['peaks'] is None:
+        state['peaks'] = engine.placementPeaks(imageArray, state['valueType'], spacingKJI, mask, lower, lower, upper)
+      results['Peak'] = engine.bestPeak(state['peaks'])
+
+    return dict((name, float(value)) for name, value in results.items())
+
+class QuantitativeIndicesResultCache(object):
+  """Least recently used cache of the indices of segments, by a key that identifies
+  the image, the segment voxels and the requested indices (see
+  QuantitativeIndicesToolLogic.getResultCacheKey). Entries are evicted when the
+  estimated memory of all entries exceeds memoryBudget bytes."""
+
+  def __init__(self, memoryBudget=4*1024*1024):
+    import collections
+    self.memoryBudget = memoryBudget
+    self.entries = collections.OrderedDict()
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key):
+    """Copy of the values cached for key, None if there are none"""
+    entry = self.entries.get(key)
+    if entry is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self.entries.move_to_end(key)
+    return dict(entry[0])
+
+  def put(self, key, values):
+    """Cache a dict of values by index name for key"""
+    if key in self.entries:
+      self.size -= self.entries.pop(key)[1]
+    size = self._entrySize(key, values)
+    if size > self.memoryBudget:
+      return
+    self.entries[key] = (dict(values), size)
+    self.size += size
+    while self.size > self.memoryBudget:
+      self.size -= self.entries.popitem(last=False)[1][1]
+
+  def clear(self):
+    self.entries.clear()
+    self.size = 0
+
+  @staticmethod
+  def _entrySize(key, values):
+    """Estimated memory of an entry in bytes"""
+    import sys
+    size = sys.getsizeof(key) + sum(sys.getsizeof(part) for part in key)
+    size += sys.getsizeof(values) + sum(sys.getsizeof(name) + sys.getsizeof(value) for name, value in values.items())
+    return size
+
 #
 # QuantitativeIndicesToolLogic
 #
 
 class QuantitativeIndicesToolLogic(ScriptedLoadableModuleLogic):
 
+  # the server is shared by all logic instances, so volumes stay loaded
+  server = None
+  serverUnavailable = False
+  # the results are cached for all logic instances, e.g. PET-IndiC and the SegmentStatistics plugin
+  resultCache = QuantitativeIndicesResultCache()
+  # label map node the segments are exported to, never kept in the scene
+  scratchLabelNode = None
+
   def __init__(self, parent = None):
     ScriptedLoadableModuleLogic.__init__(self, parent)
+    self.useServer = True
+    self.incrementalEngine = QuantitativeIndicesIncrementalEngine()
 
   def hasImageData(self,volumeNode):
     if not volumeNode:
@@ -478,13 +1362,14 @@ class QuantitativeIndicesToolLogic(ScriptedLoadableModuleLogic):
 
   def run(self,inputVolume,labelVolume,cliNode,labelValue=1,mean=False,stddev=False,minimum=False,maximum=False,
           quart1=False,median=False,quart3=False,adj=False,q1=False,q2=False,q3=False,q4=False,gly1=False,
-          gly2=False,gly3=False,gly4=False,tlg=False,sam=False,samBG=False,rms=False,peak=False,volume=False):
-    """Run the CLI with a grayscale volume and label map."""
-    qiModule = slicer.modules.quantitativeindicescli
-
+          gly2=False,gly3=False,gly4=False,tlg=False,sam=False,samBG=False,rms=False,peak=False,volume=False,
+          callback=None):
+    """Run the CLI with a grayscale volume and label map. The label map does not have
+    to be in the scene. If callback is given the CLI runs in the background, see
+    runWithParametersAsync."""
     parameters = {}
     parameters['Grayscale_Image'] = inputVolume.GetID()
-    parameters['Label_Image'] = labelVolume.GetID()
+    parameters['Label_Image'] = labelVolume
     parameters['Label_Value'] = str(labelValue)
     if(mean):
       parameters['Mean'] = 'true'
@@ -528,12 +1413,111 @@ class QuantitativeIndicesToolLogic(ScriptedLoadableModuleLogic):
       parameters['RMS'] = 'true'
     if(peak):
       parameters['Peak'] = 'true'
+      parameters['Peak_Kernel_Cache_Directory'] = self.getPeakKernelCacheDirectory()
     if(volume):
       parameters['Volume'] = 'true'
 
-    newCLINode = slicer.cli.run(qiModule,cliNode,parameters,wait_for_completion=True)
+    if callback:
+      return self.runWithParametersAsync(parameters, callback, cliNode)
+    return self.runWithParameters(parameters, cliNode)
+
+  def runWithParameters(self, parameters, cliNode=None):
+    """Run the CLI with a dict of parameters and return the CLI node holding the
+    results. When Slicer loaded the CLI as a shared library it runs inside the
+    Slicer process and receives the volumes from memory. Otherwise the CLI server
+    is used when it is available, or the CLI is run as a separate process. Volumes
+    can be given as nodes that are not in the scene; the server reads them without
+    the scene, slicer.cli.run only while they are added to it (which scene
+    observers see). The returned CLI node is in the scene and should be removed
+    by the caller once its results were read."""
+    qiModule = slicer.modules.quantitativeindicescli
+    server = self.getServer() if self.useServer and not self.runsInProcess() else None
+    if server:
+      if cliNode is None:
+        cliNode = slicer.cli.createNode(qiModule)
+      if server.run(cliNode, parameters):
+        return cliNode
+    addedNodes = self._addNodesToScene(parameters)
+    try:
+      newCLINode = slicer.cli.run(qiModule,cliNode,parameters,wait_for_completion=True)
+    finally:
+      self._removeNodesFromScene(addedNodes)
     return newCLINode
 
+  def runWithParametersAsync(self, parameters, callback, cliNode=None):
+    """Start the CLI in the background and return its CLI node. callback(cliNode) is
+    called once the run has ended, also when it failed or was cancelled with
+    cliNode.Cancel(), so the status has to be checked. The input volumes must not
+    be removed or modified before then. Volumes given as nodes that are not in the
+    scene are added to it until the run has ended."""
+    qiModule = slicer.modules.quantitativeindicescli
+    addedNodes = self._addNodesToScene(parameters)
+    try:
+      cliNode = slicer.cli.run(qiModule, cliNode, parameters, wait_for_completion=False)
+    except Exception:
+      self._removeNodesFromScene(addedNodes)
+      raise
+    observerTags = []
+    def onStatusModified(caller, event):
+      if cliNode.IsBusy():
+        return
+      for tag in observerTags:
+        cliNode.RemoveObserver(tag)
+      del observerTags[:]
+      self._removeNodesFromScene(addedNodes)
+      callback(cliNode)
+    observerTags.append(cliNode.AddObserver(slicer.vtkMRMLCommandLineModuleNode.StatusModifiedEvent, onStatusModified))
+    return cliNode
+
+  def _addNodesToScene(self, parameters):
+    """Add the nodes among the parameters that are not in the scene, hidden, so that
+    slicer.cli.run finds them. Returns the added nodes."""
+    addedNodes = []
+    for value in parameters.values():
+      if isinstance(value, slicer.vtkMRMLNode) and value.GetScene() is None:
+        value.SetHideFromEditors(True)
+        value.SetSaveWithScene(False)
+        slicer.mrmlScene.AddNode(value)
+        addedNodes.append(value)
+    return addedNodes
+
+  def _removeNodesFromScene(self, nodes):
+    for node in nodes:
+      if node.GetScene():
+        slicer.mrmlScene.RemoveNode(node)
+
+  def runsInProcess(self):
+    """True if Slicer loaded the CLI as a shared library (when the "Prefer
+    executable CLIs" application setting is off)"""
+    executable = slicer.modules.quantitativeindicescli.path
+    return os.path.splitext(executable)[1].lower() in ['.so', '.dll', '.dylib']
+
+  def getServer(self):
+    """The CLI server shared by the logic instances, started on first use. None
+    if the CLI cannot run as a server (e.g. when built as a shared library)."""
+    cls = QuantitativeIndicesToolLogic
+    if cls.server and cls.server.isRunning():
+      return cls.server
+    if cls.serverUnavailable:
+      return None
+    executable = slicer.modules.quantitativeindicescli.path
+    if (not executable or not os.path.isfile(executable) or not os.access(executable, os.X_OK)
+        or self.runsInProcess()):
+      cls.serverUnavailable = True
+      return None
+    cls.server = QuantitativeIndicesServer(executable)
+    if not cls.server.start():
+      cls.server = None
+      cls.serverUnavailable = True
+    return cls.server
+
+  def getPeakKernelCacheDirectory(self):
+    """Directory where the CLI keeps the peak kernels between runs"""
+    cacheDir = os.path.join(slicer.app.cachePath, 'QuantitativeIndices', 'PeakKernels')
+    if not os.path.exists(cacheDir):
+      os.makedirs(cacheDir)
+    return cacheDir
+
   def runOnSegment(self, inputVolume, segmentationNode, segmentID, cliNode=None,
                    mean=False, stddev=False, minimum=False, maximum=False,
                    quart1=False, median=False, quart3=False, adj=False,
@@ -541,24 +1525,242 @@ class QuantitativeIndicesToolLogic(ScriptedLoadableModuleLogic):
                    gly1=False, gly2=False, gly3=False, gly4=False,
                    tlg=False, sam=False, samBG=False, rms=False,
                    peak=False, volume=False):
-    """Convenience method: export segment to temp label map, run CLI, clean up."""
-    labelNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'temp_qi_export')
+    """Convenience method: export segment to the scratch label map, run CLI. None if
+    the segment is empty."""
+    labelNode = self.exportSegmentsToLabelmap(inputVolume, segmentationNode, [segmentID])
+    if not labelNode:
+      return None
+    return self.run(inputVolume, labelNode, cliNode, labelValue=1,
+                    mean=mean, stddev=stddev, minimum=minimum, maximum=maximum,
+                    quart1=quart1, median=median, quart3=quart3, adj=adj,
+                    q1=q1, q2=q2, q3=q3, q4=q4,
+                    gly1=gly1, gly2=gly2, gly3=gly3, gly4=gly4,
+                    tlg=tlg, sam=sam, samBG=samBG, rms=rms,
+                    peak=peak, volume=volume)
+
+  def computeIndices(self, inputVolume, segmentationNode, segmentID, indices=None):
+    """Compute the indices of a segment with QuantitativeIndicesNumPyEngine, without
+    running the CLI. Returns a dict of the values by CLI parameter name (e.g.
+    'Mean', 'Std_Deviation'), all indices if indices is None."""
+    labelArray, labelStart = self.getSegmentLabelmapArray(inputVolume, segmentationNode, segmentID)
+    imageArray = slicer.util.arrayFromVolume(inputVolume)
+    if labelArray is None:
+      labelArray, labelStart = imageArray[:0, :0, :0], (0, 0, 0)
+    return QuantitativeIndicesNumPyEngine.compute(imageArray, inputVolume.GetSpacing(),
+                                                  labelArray, labelStart, indices)
+
+  def computeIndicesIncrementally(self, inputVolume, segmentationNode, segmentID, indices=None, limitWork=False):
+    """Compute the indices of a segment like computeIndices, keeping its state in
+    self.incrementalEngine so that the next call for the segment only processes
+    the voxels that changed in the meantime. With limitWork, returns None instead
+    of building the state or processing a large change (see
+    QuantitativeIndicesIncrementalEngine.update)."""
+    key = (inputVolume.GetID(), segmentationNode.GetID(), segmentID)
+    labelArray, labelStart = self.getSegmentLabelmapArray(inputVolume, segmentationNode, segmentID)
+    imageArray = slicer.util.arrayFromVolume(inputVolume)
+    if labelArray is None:
+      labelArray, labelStart = imageArray[:0, :0, :0], (0, 0, 0)
+    return self.incrementalEngine.update(key, imageArray, inputVolume.GetSpacing(), labelArray, labelStart,
+                                         indices, inputVolume.GetImageData().GetMTime(), limitWork)
+
+  def getResultCacheKey(self, inputVolume, segmentationNode, segmentID, indices):
+    """Key of the results of a segment in resultCache: the volume with its image
+    modification time and geometry, a hash of the binary labelmap of the segment
+    with its geometry, the transforms of both nodes and the requested indices"""
+    import hashlib
+    from vtk.util import numpy_support
+    labelmap = slicer.vtkOrientedImageData()
+    segmentationNode.GetBinaryLabelmapRepresentation(segmentID, labelmap)
+    digest = hashlib.blake2b(digest_size=16)
+    labelmapToWorld = vtk.vtkMatrix4x4()
+    labelmap.GetImageToWorldMatrix(labelmapToWorld)
+    digest.update(repr((labelmap.GetExtent(), [labelmapToWorld.GetElement(r, c) for r in range(3) for c in range(4)])).encode())
+    if not labelmap.IsEmpty() and labelmap.GetPointData().GetScalars() is not None:
+      digest.update(numpy_support.vtk_to_numpy(labelmap.GetPointData().GetScalars()))
+    ijkToRAS = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix(ijkToRAS)
+    transforms = tuple((node.GetID(), node.GetMTime()) if node else None
+                       for node in (inputVolume.GetParentTransformNode(), segmentationNode.GetParentTransformNode()))
+    return (inputVolume.GetID(), inputVolume.GetImageData().GetMTime(),
+            tuple(ijkToRAS.GetElement(r, c) for r in range(3) for c in range(4)),
+            digest.digest(), transforms, tuple(sorted(indices)))
+
+  def getResultsFromNode(self, cliNode):
+    """Values of the outputs of a CLI run as a dict by CLI parameter name"""
+    results = {}
+    for i in range(cliNode.GetNumberOfParametersInGroup(3)):
+      value = cliNode.GetParameterDefault(3, i)
+      if value != '--':
+        results[cliNode.GetParameterName(3, i).replace('_s', '')] = float(value)
+    return results
+
+  def getSegmentLabelmapArray(self, inputVolume, segmentationNode, segmentID):
+    """Binary labelmap of a segment on the voxel grid of inputVolume as an array
+    (k, j, i) and the (k, j, i) index of its first voxel in the volume. The array
+    only covers the extent of the segment. (None, None) if the segment is empty."""
+    labelmap = slicer.vtkOrientedImageData()
+    segmentationNode.GetBinaryLabelmapRepresentation(segmentID, labelmap)
+    return self._getLabelmapArrayOnVolumeGrid(inputVolume, segmentationNode, labelmap)
+
+  def _getLabelmapArrayOnVolumeGrid(self, inputVolume, segmentationNode, labelmap):
+    """Labelmap of segmentationNode resampled to the voxel grid of inputVolume, as an
+    array over its extent inside the volume and the (k, j, i) index of its first voxel"""
+    from vtk.util import numpy_support
+    if labelmap.IsEmpty():
+      return None, None
+
+    # resample to the grid of the volume, through the transforms of both nodes
+    reference = slicer.vtkOrientedImageData()
+    ijkToRAS = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix(ijkToRAS)
+    reference.SetImageToWorldMatrix(ijkToRAS)
+    reference.SetExtent(inputVolume.GetImageData().GetExtent())
+    segmentationToVolume = None
+    if segmentationNode.GetParentTransformNode() != inputVolume.GetParentTransformNode():
+      segmentationToVolume = vtk.vtkGeneralTransform()
+      slicer.vtkMRMLTransformNode.GetTransformBetweenNodes(segmentationNode.GetParentTransformNode(),
+                                                          inputVolume.GetParentTransformNode(), segmentationToVolume)
+    resampled = slicer.vtkOrientedImageData()
+    slicer.vtkOrientedImageDataResample.ResampleOrientedImageToReferenceOrientedImage(
+        labelmap, reference, resampled, False, False, segmentationToVolume)
+
+    # keep the part inside the volume
+    extent = resampled.GetExtent()
+    volumeExtent = inputVolume.GetImageData().GetExtent()
+    lower = [max(extent[2*a], volumeExtent[2*a]) for a in range(3)]
+    upper = [min(extent[2*a+1], volumeExtent[2*a+1]) for a in range(3)]
+    if any(l > u for l, u in zip(lower, upper)) or resampled.GetPointData().GetScalars() is None:
+      return None, None
+    dimensions = resampled.GetDimensions()
+    labelArray = numpy_support.vtk_to_numpy(resampled.GetPointData().GetScalars())
+    labelArray = labelArray.reshape(dimensions[::-1])
+    labelArray = labelArray[lower[2]-extent[4]:upper[2]-extent[4]+1,
+                            lower[1]-extent[2]:upper[1]-extent[2]+1,
+                            lower[0]-extent[0]:upper[0]-extent[0]+1]
+    labelStart = (lower[2]-volumeExtent[4], lower[1]-volumeExtent[2], lower[0]-volumeExtent[0])
+    return labelArray, labelStart
+
+  def exportSegmentsToLabelmap(self, inputVolume, segmentationNode, segmentIDs, labelNode=None):
+    """Label map volume node of segments on the voxel grid of inputVolume, for the CLI:
+    segmentIDs[i] gets the label value i+1 and where segments overlap, the voxels belong
+    to the segment listed last. The node is not added to the scene. If labelNode is None
+    the scratch node shared by the logic instances is filled, so its image is reused by
+    the next export and it only holds the segments until then. None if the segments
+    have no voxels in the volume."""
+    from vtk.util import numpy_support
+    cls = QuantitativeIndicesToolLogic
     segmentIds = vtk.vtkStringArray()
-    segmentIds.InsertNextValue(segmentID)
-    slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(
-        segmentationNode, segmentIds, labelNode, inputVolume,
-        slicer.vtkSegmentation.EXTENT_REFERENCE_GEOMETRY)
-    try:
-      result = self.run(inputVolume, labelNode, cliNode, labelValue=1,
-                        mean=mean, stddev=stddev, minimum=minimum, maximum=maximum,
-                        quart1=quart1, median=median, quart3=quart3, adj=adj,
-                        q1=q1, q2=q2, q3=q3, q4=q4,
-                        gly1=gly1, gly2=gly2, gly3=gly3, gly4=gly4,
-                        tlg=tlg, sam=sam, samBG=samBG, rms=rms,
-                        peak=peak, volume=volume)
-    finally:
-      slicer.mrmlScene.RemoveNode(labelNode)
-    return result
+    for segmentID in segmentIDs:
+      segmentIds.InsertNextValue(segmentID)
+    merged = slicer.vtkOrientedImageData()
+    if not segmentationNode.GenerateMergedLabelmapForAllSegments(
+        merged, slicer.vtkSegmentation.EXTENT_UNION_OF_EFFECTIVE_SEGMENTS, None, segmentIds):
+      return None
+    labelArray, labelStart = self._getLabelmapArrayOnVolumeGrid(inputVolume, segmentationNode, merged)
+    if labelArray is None or not labelArray.any():
+      return None
+
+    if labelNode is None:
+      if cls.scratchLabelNode is None:
+        cls.scratchLabelNode = slicer.vtkMRMLLabelMapVolumeNode()
+        cls.scratchLabelNode.SetName('QuantitativeIndicesScratchLabel')
+        cls.scratchLabelNode.SetHideFromEditors(True)
+        cls.scratchLabelNode.SetSaveWithScene(False)
+      labelNode = cls.scratchLabelNode
+    # the label map covers the whole volume, so the CLI uses the grid of the volume
+    dimensions = inputVolume.GetImageData().GetDimensions()
+    imageData = labelNode.GetImageData()
+    if (imageData is None or imageData.GetDimensions() != dimensions
+        or imageData.GetScalarType() != vtk.VTK_SHORT):
+      imageData = vtk.vtkImageData()
+      imageData.SetDimensions(dimensions)
+      imageData.AllocateScalars(vtk.VTK_SHORT, 1)
+      labelNode.SetAndObserveImageData(imageData)
+    voxels = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(dimensions[::-1])
+    voxels.fill(0)
+    voxels[tuple(slice(start, start + size) for start, size in zip(labelStart, labelArray.shape))] = labelArray
+    imageData.Modified()
+    ijkToRAS = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix(ijkToRAS)
+    labelNode.SetIJKToRASMatrix(ijkToRAS)
+    return labelNode
+
+  def runOnSegments(self, inputVolume, segmentationNode, segmentIDs, indices=None, tableNode=None):
+    """Calculate the indices of several segments with one label map export and one
+    CLI run, in CSV mode. Returns a dict by segment ID of dicts of the values by
+    CLI parameter name (all indices if indices is None). Where segments overlap,
+    the voxels belong to the segment listed last. If tableNode is given, it is
+    filled with one row per segment."""
+    import csv
+    indices = QuantitativeIndicesNumPyEngine.indexNames if indices is None else list(indices)
+    results = dict((segmentID, dict((name, float('nan')) for name in indices)) for segmentID in segmentIDs)
+    if not segmentIDs or not indices:
+      if tableNode:
+        self.writeSegmentsTable(tableNode, inputVolume, segmentationNode, results, indices)
+      return results
+
+    # segment number i gets the label value i+1
+    labelNode = self.exportSegmentsToLabelmap(inputVolume, segmentationNode, segmentIDs)
+    if not labelNode:
+      if tableNode:
+        self.writeSegmentsTable(tableNode, inputVolume, segmentationNode, results, indices)
+      return results
+    csvFileName = os.path.join(slicer.app.temporaryPath, 'QuantitativeIndices_{0}.csv'.format(os.getpid()))
+    if os.path.exists(csvFileName):
+      os.remove(csvFileName)
+    parameters = {}
+    parameters['Grayscale_Image'] = inputVolume.GetID()
+    parameters['Label_Image'] = labelNode
+    parameters['returnCSV'] = 'true'
+    parameters['CSVFile'] = csvFileName
+    for name in indices:
+      parameters[name] = 'true'
+    if 'Peak' in indices:
+      parameters['Peak_Kernel_Cache_Directory'] = self.getPeakKernelCacheDirectory()
+    cliNode = self.runWithParameters(parameters)
+    slicer.mrmlScene.RemoveNode(cliNode)
+
+    # rows of the labels present: the label value followed by the indices
+    if os.path.exists(csvFileName):
+      with open(csvFileName) as csvFile:
+        rows = [row for row in csv.reader(csvFile) if row]
+      os.remove(csvFileName)
+      header = rows[0] if rows else []
+      for row in rows[1:]:
+        labelValue = int(row[0])
+        if labelValue < 1 or labelValue > len(segmentIDs):
+          continue
+        values = results[segmentIDs[labelValue-1]]
+        for name, value in zip(header[1:], row[1:]):
+          if name in values:
+            values[name] = float(value)
+    else:
+      print('Quantitative indices of the segments could not be calculated')
+
+    if tableNode:
+      self.writeSegmentsTable(tableNode, inputVolume, segmentationNode, results, indices)
+    return results
+
+  def writeSegmentsTable(self, tableNode, inputVolume, segmentationNode, results, indices):
+    """Fill tableNode with one row per segment of the results of runOnSegments"""
+    imageUnits = self.getImageUnits(inputVolume)
+    tableWasModified = tableNode.StartModify()
+    tableNode.RemoveAllColumns()
+    tableNode.AddColumn().SetName("Segment")
+    for name in indices:
+      feature = name.replace('_', ' ')
+      tableNode.AddColumn(vtk.vtkDoubleArray()).SetName(feature)
+      tableNode.SetColumnUnitLabel(feature, self.getUnitsForIndex(imageUnits, feature))
+    segmentation = segmentationNode.GetSegmentation()
+    for segmentID, values in results.items():
+      row = tableNode.AddEmptyRow()
+      segment = segmentation.GetSegment(segmentID)
+      tableNode.GetTable().GetColumn(0).SetValue(row, segment.GetName() if segment else segmentID)
+      for column, name in enumerate(indices):
+        tableNode.GetTable().GetColumn(column+1).SetValue(row, values[name])
+    tableNode.SetUseColumnNameAsColumnHeader(True)
+    tableNode.Modified()
+    tableNode.EndModify(tableWasModified)
 
   def getImageUnits(self, imageNode):
     """Search for units in the image node attributes or voxel value units"""
@@ -600,6 +1802,12 @@ class QuantitativeIndicesToolTest(ScriptedLoadableModuleTest):
     self.setUp()
     self.test_QuantitativeIndicesTool1()
     self.tearDown()
+    self.setUp()
+    self.test_QuantitativeIndicesTool2()
+    self.tearDown()
+    self.setUp()
+    self.test_QuantitativeIndicesTool3()
+    self.tearDown()
 
   def doCleanups(self):
     self.tearDown()
@@ -711,12 +1919,142 @@ class QuantitativeIndicesToolTest(ScriptedLoadableModuleTest):
           'TLG':337.106}
         self._verifyResults(widget.tableNode, values)
 
+        self.delayDisplay('Calculating measurements for all segments')
+        widget.onCalculateAllButton()
+        table = widget.tableNode
+        self.assertEqual(table.GetNumberOfRows(), 3)
+        for row, values in enumerate([{'Mean':3.67861, 'Peak':17.335, 'Volume':96.9882, 'TLG':356.782},
+                                      {'Mean':3.49592, 'Peak':19.2768, 'Volume':96.4284, 'TLG':337.106}]):
+          for index, value in values.items():
+            self.assertTrue(abs(float(table.GetCellText(row, table.GetColumnIndex(index)))-value)<0.01)
+
+        self.delayDisplay('Test passed!')
+
+    except Exception as e:
+      import traceback
+      traceback.print_exc()
+      self.delayDisplay('Test caused exception!\n' + str(e))
+      raise
+
+  def test_QuantitativeIndicesTool2(self):
+    """Compare the indices of the NumPy engine with those of the CLI."""
+    try:
+      with DICOMUtils.TemporaryDICOMDatabase(self.tempDicomDatabaseDir) as db:
+        self.assertTrue(db.isOpen)
+
+        self.delayDisplay('Loading PET DICOM dataset (including download if necessary)')
+        petNode = self.loadTestData()
+
+        self.delayDisplay('Creating segmentations')
+        segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
+        segmentationNode.CreateDefaultDisplayNodes()
+        segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(petNode)
+        segmentGeometries = [[30,-54,232,-980], [30,-41,232,-1065], [50,112,232,-1264], [8,-54,232,-980]]
+        segmentIDs = []
+        for segmentGeometry in segmentGeometries:
+          sphereSource = vtk.vtkSphereSource()
+          sphereSource.SetRadius(segmentGeometry[0])
+          sphereSource.SetCenter(segmentGeometry[1], segmentGeometry[2], segmentGeometry[3])
+          sphereSource.Update()
+          segmentIDs.append(segmentationNode.AddSegmentFromClosedSurfaceRepresentation(sphereSource.GetOutput(),
+              segmentationNode.GetSegmentation().GenerateUniqueSegmentID("Test")))
+
+        logic = QuantitativeIndicesToolLogic()
+        allIndices = dict((name, True) for name in ['mean', 'stddev', 'minimum', 'maximum',
+          'quart1', 'median', 'quart3', 'adj', 'q1', 'q2', 'q3', 'q4', 'gly1', 'gly2', 'gly3', 'gly4',
+          'tlg', 'sam', 'samBG', 'rms', 'peak', 'volume'])
+        for segmentID in segmentIDs:
+          self.delayDisplay('Comparing the indices of ' + segmentID)
+          cliNode = logic.runOnSegment(petNode, segmentationNode, segmentID, **allIndices)
+          values = logic.computeIndices(petNode, segmentationNode, segmentID)
+          self.assertEqual(len(values), 22)
+          for name, value in values.items():
+            # the CLI writes 6 significant digits
+            reference = float(cliNode.GetParameterAsString(name + '_s'))
+            if reference != reference:
+              self.assertTrue(value != value, name)
+            else:
+              self.assertTrue(abs(value-reference) <= 1e-5*max(1.0, abs(reference)), name)
+          slicer.mrmlScene.RemoveNode(cliNode)
+
+        self.delayDisplay('Test passed!')
+
+    except Exception as e:
+      import traceback
+      traceback.print_exc()
+      self.delayDisplay('Test caused exception!\n' + str(e))
+      raise
+
+  def test_QuantitativeIndicesTool3(self):
+    """Compare the incremental updates with full calculations while a segment is
+    repeatedly erased and painted."""
+    try:
+      with DICOMUtils.TemporaryDICOMDatabase(self.tempDicomDatabaseDir) as db:
+        self.assertTrue(db.isOpen)
+
+        self.delayDisplay('Loading PET DICOM dataset (including download if necessary)')
+        petNode = self.loadTestData()
+
+        segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
+        segmentationNode.CreateDefaultDisplayNodes()
+        segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(petNode)
+        sphereSource = vtk.vtkSphereSource()
+        sphereSource.SetRadius(30)
+        sphereSource.SetCenter(-54, 232, -980)
+        sphereSource.Update()
+        segmentID = segmentationNode.AddSegmentFromClosedSurfaceRepresentation(sphereSource.GetOutput(),
+            segmentationNode.GetSegmentation().GenerateUniqueSegmentID("Test"))
+
+        logic = QuantitativeIndicesToolLogic()
+        self.delayDisplay('Comparing incremental updates with full calculations')
+        logic.computeIndicesIncrementally(petNode, segmentationNode, segmentID)
+        labelArray = slicer.util.arrayFromSegmentBinaryLabelmap(segmentationNode, segmentID, petNode)
+        original = labelArray.copy()
+        k, j, i = [int(c.mean()) for c in labelArray.nonzero()]
+        iMax = int(labelArray.nonzero()[2].max())
+        labelArray[k-1:k+2, j-3:j+3, :i] = 0 # erase a slab
+        strokes = [labelArray.copy()]
+        labelArray[k-2:k+2, j-2:j+2, iMax-2:iMax+6] = 1 # paint past the border
+        strokes.append(labelArray.copy())
+        strokes.append(original)
+        # the accumulators are merged over many strokes, the error must not grow
+        for stroke in 5*strokes:
+          slicer.util.updateSegmentBinaryLabelmapFromArray(stroke, segmentationNode, segmentID, petNode)
+          values = logic.computeIndicesIncrementally(petNode, segmentationNode, segmentID)
+          references = logic.computeIndices(petNode, segmentationNode, segmentID)
+          for name, reference in references.items():
+            if reference != reference:
+              self.assertTrue(values[name] != values[name], name)
+            else:
+              self.assertTrue(abs(values[name]-reference) <= 1e-9*max(1.0, abs(reference)), name)
+
+        self.delayDisplay('Forgetting the state of removed segments')
+        self.assertEqual(len(logic.incrementalEngine.states), 1)
+        logic.incrementalEngine.resetNode(segmentationNode.GetID(), segmentID)
+        self.assertEqual(len(logic.incrementalEngine.states), 0)
+
+        self.delayDisplay('Limiting the work of an update')
+        logic.incrementalEngine.maximumLimitedVoxels = 64
+        slicer.util.updateSegmentBinaryLabelmapFromArray(original, segmentationNode, segmentID, petNode)
+        self.assertIsNone(logic.computeIndicesIncrementally(petNode, segmentationNode, segmentID, limitWork=True))
+        self.assertEqual(len(logic.incrementalEngine.states), 0) # not built
+        logic.computeIndicesIncrementally(petNode, segmentationNode, segmentID)
+        labelArray = original.copy()
+        labelArray[k-1:k+1, j-1:j+1, iMax-1:iMax+3] = 1 # small stroke
+        slicer.util.updateSegmentBinaryLabelmapFromArray(labelArray, segmentationNode, segmentID, petNode)
+        values = logic.computeIndicesIncrementally(petNode, segmentationNode, segmentID, limitWork=True)
+        self.assertIsNotNone(values)
+        self.assertAlmostEqual(values['Mean'], logic.computeIndices(petNode, segmentationNode, segmentID)['Mean'])
+        slicer.util.updateSegmentBinaryLabelmapFromArray(strokes[0], segmentationNode, segmentID, petNode)
+        self.assertIsNone(logic.computeIndicesIncrementally(petNode, segmentationNode, segmentID, limitWork=True))
+
         self.delayDisplay('Test passed!')
 
     except Exception as e:
       import traceback
       traceback.print_exc()
       self.delayDisplay('Test caused exception!\n' + str(e))
+      raise
 
   def _verifyResults(self, resultsTable, referenceMeasurements={}):
     assert(resultsTable!=None)
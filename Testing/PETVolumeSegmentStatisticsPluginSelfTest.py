@@ -177,7 +177,27 @@ class PETVolumeSegmentStatisticsPluginSelfTestTest(ScriptedLoadableModuleTest):
         self.delayDisplay('Calculating measurements')
         segStatLogic.getParameterNode().SetParameter("Segmentation", segmentationNode.GetID())
         segStatLogic.getParameterNode().SetParameter("ScalarVolume", petNode.GetID())
-        segStatLogic.computeStatistics()
+        from QuantitativeIndicesTool import QuantitativeIndicesToolLogic
+        # the segments do not overlap, so they can share a layer and are computed in one batch
+        segmentationNode.GetSegmentation().CollapseBinaryLabelmaps()
+        self.assertEqual(segmentationNode.GetSegmentation().GetNumberOfLayers(), 1)
+        resultCache = QuantitativeIndicesToolLogic.resultCache
+        resultCache.clear()
+        cacheHits, cacheMisses = resultCache.hits, resultCache.misses
+        batchRuns = []
+        runOnSegments = QuantitativeIndicesToolLogic.runOnSegments
+        def recordBatchRun(logic, inputVolume, segmentationNode, segmentIDs, *args, **kwargs):
+          batchRuns.append(list(segmentIDs))
+          return runOnSegments(logic, inputVolume, segmentationNode, segmentIDs, *args, **kwargs)
+        QuantitativeIndicesToolLogic.runOnSegments = recordBatchRun
+        try:
+          segStatLogic.computeStatistics()
+        finally:
+          QuantitativeIndicesToolLogic.runOnSegments = runOnSegments
+        # one CLI run for all segments; the other two segments are served from the cache
+        self.assertEqual(batchRuns, [['Test', 'Test_1', 'Test_2']])
+        self.assertEqual(resultCache.misses - cacheMisses, 1)
+        self.assertEqual(resultCache.hits - cacheHits, 2)
         stats = segStatLogic.getStatistics()
         resultsTableNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode')
         segStatLogic.exportToTable(resultsTableNode)
@@ -225,12 +245,26 @@ class PETVolumeSegmentStatisticsPluginSelfTestTest(ScriptedLoadableModuleTest):
         self.assertTrue( abs(stats["Test_2","PETVolumeSegmentStatisticsPlugin.SAM_BG"]-2.121)<0.0001 )
         self.assertTrue( abs(stats["Test","PETVolumeSegmentStatisticsPlugin.peak"]-17.335)<0.0001 )
 
+        self.delayDisplay('Checking that per-segment runs leave no CLI node in the scene')
+        plugin = [p for p in segStatLogic.plugins if p.__class__.__name__ == 'PETVolumeSegmentStatisticsPlugin'][0]
+        resultCache.clear()
+        cliNodeCount = slicer.mrmlScene.GetNumberOfNodesByClass('vtkMRMLCommandLineModuleNode')
+        plugin.getBatchSegmentIDs = lambda segmentationNode, segmentID: [segmentID]
+        try:
+          segStatLogic.computeStatistics()
+        finally:
+          del plugin.getBatchSegmentIDs
+        self.assertEqual(slicer.mrmlScene.GetNumberOfNodesByClass('vtkMRMLCommandLineModuleNode'), cliNodeCount)
+        stats = segStatLogic.getStatistics()
+        self.assertTrue( abs(stats["Test","PETVolumeSegmentStatisticsPlugin.peak"]-17.335)<0.0001 )
+
         self.delayDisplay('Test passed!')
 
     except Exception as e:
       import traceback
       traceback.print_exc()
       self.delayDisplay('Test caused exception!\n' + str(e),self.delayMs*2)
+      raise
 
   def _verifyResults(self, table, referenceMeasurements={}):
     self.assertTrue(table.columnCount==3)